@@ -2,8 +2,31 @@
 """NRPE Plugin for checking Kubernetes API."""
 
 import argparse
+import asyncio
+import base64
+import cProfile
+import calendar
+import collections
+import contextlib
+import contextvars
+import functools
+import io
 import json
+import math
+import multiprocessing
+import operator
+import os
+import re
+import socket
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import zipfile
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 import urllib3
 
@@ -19,102 +42,2880 @@ NAGIOS_STATUS = {
     NAGIOS_STATUS_UNKNOWN: "UNKNOWN",
 }
 
+# checks selectable with --check (or aggregated with --checks)
+CHECK_CHOICES = [
+    "health",
+    "nodes",
+    "workloads",
+    "events",
+    "metrics",
+    "utilisation",
+    "services",
+    "storage",
+    "quotas",
+    "capacity",
+    "leases",
+    "skew",
+    "certificates",
+]
+
+# Nagios statuses, from the least to the most severe
+STATUS_SEVERITY = [
+    NAGIOS_STATUS_OK,
+    NAGIOS_STATUS_UNKNOWN,
+    NAGIOS_STATUS_WARNING,
+    NAGIOS_STATUS_CRITICAL,
+]
+
+# number of items requested per page from list endpoints
+LIST_PAGE_LIMIT = 500
+# bytes of a raw list page searched for its continue token, ahead of its items
+PAGE_HEAD_SIZE = 4096
+CONTINUE_RE = re.compile(rb'"continue":\s*"([^"]*)"')
+
+# directory, writable by the nagios user, used to keep state between runs
+STATE_DIR = "/var/lib/nagios/kubernetes-service-checks"
+
+# failing health components only alerting Warning, any other one is Critical
+HEALTH_WARNING_COMPONENTS = ("poststarthook/", "informer-sync")
+
+# histograms scraped from /metrics, with the label their buckets are grouped by
+METRICS_HISTOGRAMS = {
+    "apiserver_request_duration_seconds_bucket": "verb",
+    "etcd_request_duration_seconds_bucket": "operation",
+}
+METRICS_INFLIGHT = "apiserver_current_inflight_requests"
+METRICS_REJECTED = "apiserver_flowcontrol_rejected_requests_total"
+# long running requests whose duration says nothing about apiserver latency
+METRICS_IGNORED_VERBS = ("WATCH", "CONNECT")
+METRICS_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# multipliers of the Kubernetes resource quantity suffixes
+QUANTITY_RE = re.compile(r"^([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)([a-zA-Z]*)$")
+QUANTITY_SUFFIXES = {
+    "": 1,
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+}
+
+# number of NotReady nodes listed by name, the others are counted by group
+NODES_LISTED = 10
+# node labels the NotReady nodes are counted by
+NODE_ROLE_PREFIX = "node-role.kubernetes.io/"
+NODE_ZONE_LABEL = "topology.kubernetes.io/zone"
+
+# node heartbeat Leases, renewed by the kubelets every 10s
+NODE_LEASES_PATH = "/apis/coordination.k8s.io/v1/namespaces/kube-node-lease/leases"
+
+# minor versions a kubelet may be older than the apiserver, never newer
+SKEW_MAX_MINOR = 3
+# seconds the kubelet versions saved by the nodes check are reused by the
+# skew check, which then lists no nodes; they only change on upgrades
+NODE_VERSIONS_MAX_AGE = 900
+VERSION_RE = re.compile(r"^v?(\d+)\.(\d+)")
+
+# seconds a CertificateSigningRequest may stay pending, and namespaces whose
+# TLS Secrets are checked for their certificates expiry
+CSR_PENDING_AGE = 3600
+CERTIFICATES_NAMESPACES = ["kube-system"]
+PEM_CERTIFICATE_RE = re.compile(
+    rb"-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----", re.DOTALL
+)
+
+# label linking an EndpointSlice to the Service it belongs to
+SERVICE_NAME_LABEL = "kubernetes.io/service-name"
+# number of Services without ready endpoints listed by name
+SERVICES_LISTED = 10
+
+# pods holding node resources, as counted by the scheduler
+CAPACITY_POD_SELECTOR = "status.phase!=Succeeded,status.phase!=Failed"
+
+# seconds a claim may stay Pending, while its volume is provisioned
+STORAGE_PENDING_AGE = 900
+
+# seconds the apiserver keeps an incremental watch open before closing it
+WATCH_TIMEOUT = 2
+
+# requests in flight at once, and seconds each check has to complete
+ENGINE_CONCURRENCY = 8
+CHECK_TIMEOUT = 10
+
+# archive member holding the request index of recorded responses
+ARCHIVE_INDEX = "index.json"
+
+# comma separated profiling modes (timings, cprofile, tracemalloc), for NRPE
+PROFILE_ENV = "KSC_PROFILE"
+PROFILE_MODES = ["cprofile", "tracemalloc"]
+# number of profile dumps kept in the profile directory
+PROFILE_KEEP = 20
+
+# bytes of plugin output Nagios keeps, longer messages are truncated
+NAGIOS_OUTPUT_LIMIT = 8192
+NAGIOS_TRUNCATED = " ..."
+
+
+class KubernetesAPIError(Exception):
+    """Raised when the kube-api-server returns an unexpected response."""
+
+
+class ResourceVersionExpired(KubernetesAPIError):
+    """Raised when a watch resourceVersion was compacted away (410 Gone)."""
+
+
+class CheckTimeout(Exception):
+    """Raised in a check whose deadline has expired, to stop its requests."""
+
+
+class CheckResult(tuple):
+    """Result of a check, a (status, message) pair carrying structured details.
+
+    It unpacks as the (status, message) tuple returned by every check, the
+    Nagios output being derived from it, while the JSON output also reports
+    the findings, the counts and timings of its performance data, and the
+    flags of the run.
+    """
+
+    def __new__(cls, status, message, findings=(), flags=None, checks=None):
+        """Create the result.
+
+        :param status: Nagios status code
+        :param message: Message describing the status, with its perfdata
+        :param findings: list of dicts, one per item found at fault
+        :param flags: dict of run flags (e.g. cached or resumed data)
+        :param checks: dict of check name to CheckResult, when aggregated
+        """
+        result = super().__new__(cls, (status, message))
+        result.findings = list(findings)
+        result.flags = dict(flags or {})
+        result.checks = dict(checks or {})
+        return result
+
+    status = property(operator.itemgetter(0))
+    message = property(operator.itemgetter(1))
+
+    @classmethod
+    def of(cls, result):
+        """Get a check result, possibly a plain (status, message), as a CheckResult."""
+        return result if isinstance(result, cls) else cls(*result)
+
+    def as_dict(self, check=None):
+        """Get the result as a JSON serializable dict.
+
+        :param check: Name of the check the result is from
+        """
+        message, perfdata = split_perfdata(self.message)
+        values = {label: _perfdata_value(value) for label, value in perfdata.items()}
+        result = {
+            "check": check,
+            "status": NAGIOS_STATUS[self.status],
+            "code": self.status,
+            "message": message,
+            "counts": {k: v for k, v in values.items() if not k.startswith("time_")},
+            "timings": {k[5:]: v for k, v in values.items() if k.startswith("time_")},
+            "findings": self.findings,
+            "flags": self.flags,
+        }
+        if self.checks:
+            result["checks"] = [
+                CheckResult.of(child).as_dict(name)
+                for name, child in self.checks.items()
+            ]
+        return result
+
+
+def _perfdata_value(value):
+    """Get the number of a perfdata value such as '95.0%;85;95' or '0.01s'."""
+    match = re.match(r"[-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?", value)
+    return float(match.group()) if match else None
+
+
+class Timings:
+    """Cumulative wall-clock time spent in each phase of a check."""
+
+    def __init__(self):
+        """Initialize the phases, shared by the threads of the check."""
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        """Check whether timings are recorded."""
+        return True
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to the phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def perfdata(self):
+        """Get the phase timings as Nagios performance data."""
+        return {
+            "time_{}".format(name): "{:.6f}s".format(elapsed)
+            for name, elapsed in self.phases.items()
+        }
+
+
+class NoTimings:
+    """Stand-in for Timings when they are disabled, at the cost of a call."""
+
+    _block = contextlib.nullcontext()
+
+    def __bool__(self):
+        """Check whether timings are recorded."""
+        return False
+
+    def phase(self, name):
+        """Do nothing around the block."""
+        return self._block
+
+
+# timings of the check running in the current context
+TIMINGS = contextvars.ContextVar("timings", default=NoTimings())
+
+
+def timed(phase):
+    """Time a block as a phase of the running check, when timings are enabled."""
+    return TIMINGS.get().phase(phase)
+
+
+# run flags of the check running in the current context
+FLAGS = contextvars.ContextVar("flags", default=None)
+
+
+def flag(name, value=True):
+    """Set a run flag of the running check, reported by the JSON output."""
+    flags = FLAGS.get()
+    if flags is not None:
+        flags[name] = value
+
+
+# monotonic deadline of the check running in the current context
+DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+
+def check_deadline():
+    """Get the seconds left to the running check, stopping it once expired.
+
+    :returns: remaining seconds, None when the check has no deadline
+    :raises CheckTimeout: when the deadline has expired
+    """
+    deadline = DEADLINE.get()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise CheckTimeout("Check deadline expired")
+    return remaining
+
 
 def nagios_exit(status, message):
     """Return the check status in Nagios preferred format.
 
-    :param status: Nagios Check status code (in [0, 1, 2, 3])
-    :param message: Message describing the status
-    :return: sys.exit("{status_string}: {message}")
+    :param status: Nagios Check status code (in [0, 1, 2, 3])
+    :param message: Message describing the status
+    :return: sys.exit("{status_string}: {message}")
+    """
+    assert status in NAGIOS_STATUS, "Invalid Nagios status code"
+    print(nagios_output(status, message))  # nagios requires print to stdout, no stderr
+    sys.exit(status)
+
+
+def _truncate(text, size):
+    """Cut a text to at most size bytes of UTF-8, marking the cut."""
+    data = text.encode()
+    if len(data) <= size:
+        return text
+    cut = data[: max(size - len(NAGIOS_TRUNCATED), 0)]
+    return cut.decode(errors="ignore") + NAGIOS_TRUNCATED
+
+
+def nagios_output(status, message, limit=NAGIOS_OUTPUT_LIMIT):
+    """Format a check result as Nagios plugin output of at most limit bytes.
+
+    Long messages, such as lists of thousands of nodes, are truncated
+    rather than overflowing the NRPE buffer; the performance data of the
+    first line is kept whole and the long output lines get what is left.
+
+    :param status: Nagios Check status code
+    :param message: Message describing the status
+    :param limit: Maximum size of the output, in bytes
+    """
+    first, _, long_output = str(message).partition("\n")
+    text, _, perfdata = first.partition(" | ")
+    prefix = "{}: ".format(NAGIOS_STATUS[status])
+    suffix = " | " + perfdata if perfdata else ""
+    budget = limit - len(prefix.encode()) - len(suffix.encode())
+    text = _truncate(text, budget)
+    output = prefix + text + suffix
+    budget -= len(text.encode()) + 1
+    if long_output and budget > len(NAGIOS_TRUNCATED):
+        output += "\n" + _truncate(long_output, budget)
+    return output
+
+
+def save_result(path, result, check=None):
+    """Atomically write a check result, as JSON, for downstream aggregation.
+
+    :param path: Path to the result file
+    :param result: CheckResult, or (status, message)
+    :param check: Name of the check the result is from
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".ksc-result.")
+    with os.fdopen(fd, "w") as f:
+        json.dump(dict(CheckResult.of(result).as_dict(check), timestamp=time.time()), f)
+    os.replace(tmp_path, path)
+
+
+def with_perfdata(message, perfdata):
+    """Append Nagios performance data to a check message.
+
+    :param message: Check message
+    :param perfdata: dict of label to value, the value including its unit
+                     and optional ;warn;crit thresholds (e.g. "95%;85;95")
+    """
+    return "{} | {}".format(
+        message, " ".join("{}={}".format(label, v) for label, v in perfdata.items())
+    )
+
+
+def split_perfdata(message):
+    """Split a check message from its performance data.
+
+    :returns: (message, dict of label to value)
+    """
+    message, _, perfdata = str(message).partition(" | ")
+    return message, dict(item.split("=", 1) for item in perfdata.split() if "=" in item)
+
+
+def http_pool(disable_ssl, **pool_kwargs):
+    """Return a urllib3 PoolManager for talking to the kube-api-server.
+
+    :param disable_ssl: Disables SSL Host Key verification
+    :param pool_kwargs: Extra keyword arguments passed to the PoolManager
+    """
+    if disable_ssl:
+        # perform check without SSL verification
+        return urllib3.PoolManager(
+            cert_reqs="CERT_NONE", assert_hostname=False, **pool_kwargs
+        )
+    return urllib3.PoolManager(**pool_kwargs)
+
+
+def _time_connection(http, url, timings, timeout=None):
+    """Time the name resolution and the TCP and TLS setup of a new connection.
+
+    The connection is returned to its pool, so the request timed next
+    reuses it and its own phase is down to the apiserver latency and
+    transfer.
+    """
+    pool = http.connection_from_url(url)
+    try:
+        conn = pool._get_conn(timeout=timeout)
+    except urllib3.exceptions.EmptyPoolError:
+        # the request reports the failure
+        return
+    try:
+        if conn.sock is None:
+            with timings.phase("dns"):
+                socket.getaddrinfo(conn.host, conn.port, type=socket.SOCK_STREAM)
+            with timings.phase("connect"):
+                conn.connect()
+    except OSError:
+        # the request reports the failure
+        pass
+    finally:
+        pool._put_conn(conn)
+
+
+def api_request(http, url, client_token, **kwargs):
+    """GET a kube-api-server URL, timing the request when timings are enabled.
+
+    The request, including its wait for a free connection of the pool, is
+    bounded by what is left of the deadline of the running check, and not
+    sent at all once it has expired.
+
+    :param http: urllib3 PoolManager shared between requests
+    :param url: Full URL of the endpoint
+    :param client_token: Token for authenticating with the kube-api
+    :param kwargs: Extra keyword arguments passed to the request
+    :raises CheckTimeout: when the deadline of the running check has expired
+    """
+    remaining = check_deadline()
+    if remaining is not None:
+        kwargs.setdefault("timeout", urllib3.Timeout(total=remaining))
+        kwargs.setdefault("pool_timeout", remaining)
+    timings = TIMINGS.get()
+    if timings and hasattr(http, "connection_from_url"):
+        # replayed responses make no connection
+        _time_connection(http, url, timings, remaining)
+    with timings.phase("request"):
+        return http.request(
+            "GET",
+            url,
+            headers={"Authorization": "Bearer {}".format(client_token)},
+            **kwargs,
+        )
+
+
+@contextlib.contextmanager
+def released(resp):
+    """Return the connection of a streamed response to its pool after a block.
+
+    A response left unread, on an error, is closed first, its connection
+    being unusable until it reconnects.
+    """
+    try:
+        yield resp
+    except BaseException:
+        resp.close()
+        raise
+    finally:
+        resp.release_conn()
+
+
+def list_resources(http, url, client_token, fields=None):
+    """Yield every item of a Kubernetes list endpoint, one page at a time.
+
+    Pages are requested with `limit` and followed through the `continue`
+    token, so only a single page is held in memory at any time.
+
+    :param http: urllib3 PoolManager shared between requests
+    :param url: Full URL of the list endpoint
+    :param client_token: Token for authenticating with the kube-api
+    :param fields: Extra query parameters (e.g. fieldSelector)
+    :raises KubernetesAPIError: on any non 200 response
+    """
+    query = dict(fields or {}, limit=LIST_PAGE_LIMIT)
+    while True:
+        resp = api_request(http, url, client_token, fields=query)
+        if resp.status != 200:
+            raise KubernetesAPIError(
+                "Unexpected HTTP Response code ({})".format(resp.status)
+            )
+        with timed("parse"):
+            page = json.loads(resp.data)
+        yield from page.get("items") or []
+        token = page.get("metadata", {}).get("continue")
+        if not token:
+            return
+        query["continue"] = token
+
+
+def _page_continue(data):
+    """Get the continue token of a raw list page without parsing its items.
+
+    The apiserver writes the list metadata ahead of the items, so the token
+    is found in the head of the page; the whole page is only parsed when
+    the list metadata is not found there.
+    """
+    head = data[:PAGE_HEAD_SIZE]
+    metadata, items = head.find(b'"metadata"'), head.find(b'"items"')
+    if 0 <= metadata < items:
+        match = CONTINUE_RE.search(head, metadata, items)
+        return match.group(1).decode() if match else None
+    return json.loads(data).get("metadata", {}).get("continue")
+
+
+def list_pages(http, url, client_token, fields=None):
+    """Yield the raw bytes of every page of a Kubernetes list endpoint.
+
+    Like list_resources(), but leaving the pages to be parsed by the caller,
+    e.g. on worker processes with CheckEngine.map_pages().
+
+    :param http: urllib3 PoolManager shared between requests
+    :param url: Full URL of the list endpoint
+    :param client_token: Token for authenticating with the kube-api
+    :param fields: Extra query parameters (e.g. fieldSelector)
+    :raises KubernetesAPIError: on any non 200 response
+    """
+    query = dict(fields or {}, limit=LIST_PAGE_LIMIT)
+    while True:
+        resp = api_request(http, url, client_token, fields=query)
+        if resp.status != 200:
+            raise KubernetesAPIError(
+                "Unexpected HTTP Response code ({})".format(resp.status)
+            )
+        yield resp.data
+        token = _page_continue(resp.data)
+        if not token:
+            return
+        query["continue"] = token
+
+
+def iter_lines(resp, chunk_size=65536):
+    """Yield the lines of a streamed (preload_content=False) response.
+
+    Reading the chunks is timed as the request phase, and the processing of
+    their lines by the caller as the parse phase.
+
+    :param resp: urllib3 HTTPResponse requested with preload_content=False
+    :param chunk_size: Number of bytes read from the socket at a time
+    """
+    pending = b""
+    chunks = iter(resp.stream(chunk_size))
+    while True:
+        check_deadline()
+        with timed("request"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        with timed("parse"):
+            yield from lines
+    if pending:
+        with timed("parse"):
+            yield pending
+
+
+class ResponseArchive:
+    """Record the apiserver responses of a run, or replay them offline.
+
+    The response bodies are stored in a zip archive, one deflated member per
+    request, indexed by the request method, path and query. The address and
+    client token are left out, so an archive recorded on a cluster replays
+    anywhere, with no network, through the unchanged checks.
+    """
+
+    def __init__(self, path, http=None):
+        """Open the archive.
+
+        :param path: Path to the archive
+        :param http: urllib3 PoolManager the recorded requests are sent with,
+                     None to replay the archive
+        """
+        self.http = http
+        self.lock = threading.Lock()
+        self.zip = zipfile.ZipFile(path, "w" if http else "r", zipfile.ZIP_DEFLATED)
+        self.index = {} if http else json.loads(self.zip.read(ARCHIVE_INDEX))
+
+    def __getattr__(self, name):
+        """Delegate the connection management to the recording pool."""
+        return getattr(self.__dict__["http"], name)
+
+    @staticmethod
+    def request_key(method, url, fields=None):
+        """Get the key a request is recorded under, without its address."""
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        query += sorted((k, str(v)) for k, v in (fields or {}).items())
+        return "{} {}?{}".format(method, parts.path, urllib.parse.urlencode(query))
+
+    def request(self, method, url, fields=None, preload_content=True, **kwargs):
+        """Send and record a request, or get its recorded response.
+
+        :returns: urllib3 HTTPResponse
+        :raises KubernetesAPIError: when replaying a request never recorded
+        """
+        key = self.request_key(method, url, fields)
+        if self.http:
+            resp = self.http.request(method, url, fields=fields, **kwargs)
+            data, status = resp.data, resp.status
+            with self.lock:
+                if key not in self.index:
+                    name = "{:06d}".format(len(self.index))
+                    self.zip.writestr(name, data)
+                    self.index[key] = {"name": name, "status": status}
+        else:
+            entry = self.index.get(key)
+            if entry is None:
+                raise KubernetesAPIError("No recorded response for {}".format(key))
+            with self.lock:
+                data, status = self.zip.read(entry["name"]), entry["status"]
+        return urllib3.HTTPResponse(
+            body=io.BytesIO(data), status=status, preload_content=preload_content
+        )
+
+    def clear(self):
+        """Close the archive, writing the index of the recorded requests."""
+        with self.lock:
+            if self.http:
+                self.zip.writestr(ARCHIVE_INDEX, json.dumps(self.index, indent=1))
+                self.http.clear()
+            self.zip.close()
+
+
+class CheckEngine:
+    """Shared execution core of the checks.
+
+    A single asyncio event loop drives every check and the requests they
+    fan out. Requests go through one PoolManager, which keeps a pool of
+    connections per endpoint, and at most `concurrency` of them are in
+    flight at once, so a check fetching several resources takes about as
+    long as its slowest request. Each check runs against its own deadline
+    and reports UNKNOWN when it expires.
+
+    urllib3 being blocking, the checks and requests run on worker threads,
+    which cannot be interrupted: an expired check is abandoned, and stops at
+    its next request, page or streamed chunk, each request being bounded by
+    what is left of the deadline.
+    """
+
+    def __init__(
+        self,
+        disable_ssl,
+        concurrency=ENGINE_CONCURRENCY,
+        timeout=None,
+        timings=False,
+        profile_dir=None,
+        record=None,
+        replay=None,
+        processes=0,
+    ):
+        """Initialize the event loop, connection pools and workers.
+
+        :param disable_ssl: Disables SSL Host Key verification
+        :param concurrency: Maximum number of requests in flight at once
+        :param timeout: Seconds each check has to complete, None for no deadline
+        :param timings: Append the phase timings of each check to its perfdata
+        :param profile_dir: Directory to dump a cProfile of each check to
+        :param record: Path to an archive to record the responses to
+        :param replay: Path to an archive to replay the responses from
+        :param processes: Number of worker processes parsing the list pages,
+                          0 to parse them in-process
+        """
+        self.timeout = timeout
+        self.timings = timings
+        self.profile_dir = profile_dir
+        # requests wait for a free connection, none beyond the concurrency
+        self.http = http_pool(
+            disable_ssl,
+            maxsize=concurrency,
+            block=True,
+            timeout=urllib3.Timeout(total=timeout),
+        )
+        if record or replay:
+            self.http = ResponseArchive(record or replay, None if replay else self.http)
+        self.loop = asyncio.new_event_loop()
+        self.requests = ThreadPoolExecutor(max_workers=concurrency)
+        self.checks = ThreadPoolExecutor(max_workers=len(CHECK_CHOICES))
+        self.memo = {}
+        self.memo_lock = threading.Lock()
+        self.processes = processes
+        self.pool = None
+
+    def __enter__(self):
+        """Use the engine for the duration of a block."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Release the loop, workers and connections of the engine."""
+        self.close()
+
+    def close(self):
+        """Release the loop, workers and connections of the engine."""
+        self.requests.shutdown(wait=False)
+        self.checks.shutdown(wait=False)
+        if self.pool:
+            # at most the pages handed to the workers are left to parse
+            self.pool.shutdown(wait=True)
+        self.loop.close()
+        self.http.clear()
+
+    @classmethod
+    @contextlib.contextmanager
+    def shared(cls, engine, disable_ssl):
+        """Use the engine a check is run by, or a private one for a direct call."""
+        if engine:
+            yield engine
+            return
+        with cls(disable_ssl) as engine:
+            yield engine
+
+    def memoise(self, key, func, *args):
+        """Call a function once per engine, sharing its result between checks.
+
+        Checks asking for a result still being fetched wait for it rather
+        than fetching it again.
+
+        :param key: Hashable key of the result
+        :raises: the exception raised by the function, to every caller
+        """
+        with self.memo_lock:
+            future = self.memo.get(key)
+            fetch = future is None
+            if fetch:
+                future = self.memo[key] = Future()
+        flag("{}_cached".format(key[0]), not fetch)
+        if fetch:
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def map_pages(self, func, pages):
+        """Apply a function to raw list pages, on the worker processes if any.
+
+        Pages are handed to the workers as they are received, so the next
+        page downloads while the previous ones are parsed, and only the
+        compact results of the function come back to the check.
+
+        :param func: Module level function taking the raw bytes of a page
+        :param pages: Iterable of raw list pages, e.g. from list_pages()
+        :returns: iterator over the results, in page order
+        """
+        if not self.processes:
+            for page in pages:
+                with timed("parse"):
+                    result = func(page)
+                yield result
+            return
+        with self.memo_lock:
+            if self.pool is None:
+                # not forked from this process and its threads, but from a
+                # server process having only imported the parsing functions
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([func.__module__])
+                self.pool = ProcessPoolExecutor(self.processes, mp_context=context)
+        pending = collections.deque()
+        for page in pages:
+            pending.append(self.pool.submit(func, page))
+            # bound the pages held in memory
+            while len(pending) > 2 * self.processes or pending[0].done():
+                yield pending.popleft().result()
+                if not pending:
+                    break
+        while pending:
+            yield pending.popleft().result()
+
+    async def _gather(self, context, calls):
+        return await asyncio.gather(
+            *(
+                self.loop.run_in_executor(
+                    self.requests, functools.partial(context.copy().run, *call)
+                )
+                for call in calls
+            )
+        )
+
+    def gather(self, *calls):
+        """Run blocking request functions concurrently and wait for all of them.
+
+        Can be called from a check run by run_checks() as well as directly.
+
+        :param calls: (function, *args) tuples
+        :returns: list of the results, in the order of the calls
+        :raises: the first exception raised by a call
+        """
+        # the requests are timed as part of the calling check
+        context = contextvars.copy_context()
+        if self.loop.is_running():
+            # called from a check running on a worker thread
+            return asyncio.run_coroutine_threadsafe(
+                self._gather(context, calls), self.loop
+            ).result(self.timeout)
+        return self.loop.run_until_complete(self._gather(context, calls))
+
+    async def _run_check(self, name, check):
+        context = contextvars.copy_context()
+        flags = {}
+        context.run(FLAGS.set, flags)
+        if self.timeout:
+            context.run(DEADLINE.set, time.monotonic() + self.timeout)
+        if self.timings:
+            context.run(TIMINGS.set, Timings())
+        call = functools.partial(context.run, check)
+        if self.profile_dir:
+            call = functools.partial(profile_call, self.profile_dir, name, call)
+        try:
+            result = CheckResult.of(
+                await asyncio.wait_for(
+                    self.loop.run_in_executor(self.checks, call), self.timeout
+                )
+            )
+        except asyncio.TimeoutError:
+            return CheckResult(
+                NAGIOS_STATUS_UNKNOWN,
+                "Check {} timed out after {}s".format(name, self.timeout),
+                flags=flags,
+            )
+        except Exception as e:
+            return CheckResult(
+                NAGIOS_STATUS_UNKNOWN,
+                "{}: {}".format(type(e).__name__, e),
+                flags=flags,
+            )
+        message = result.message
+        timings = context.get(TIMINGS)
+        if timings:
+            message, perfdata = split_perfdata(message)
+            message = with_perfdata(message, dict(perfdata, **timings.perfdata()))
+        return CheckResult(result.status, message, result.findings, flags)
+
+    async def _run_checks(self, checks):
+        results = await asyncio.gather(
+            *(self._run_check(name, check) for name, check in checks.items())
+        )
+        return dict(zip(checks, results))
+
+    def run_checks(self, checks):
+        """Run checks concurrently, each one against the engine deadline.
+
+        :param checks: dict of check name to a function taking no argument
+                       and returning (status, message)
+        :returns: dict of check name to CheckResult, errors and expired
+                  deadlines being reported as UNKNOWN
+        """
+        return self.loop.run_until_complete(self._run_checks(checks))
+
+
+def profile_path(profile_dir, name, extension):
+    """Get a new profile dump path, removing the oldest dumps beyond PROFILE_KEEP.
+
+    :param profile_dir: Directory holding the profile dumps
+    :param name: Name of the profiled check
+    :param extension: 'prof' for cProfile, 'snapshot' for tracemalloc
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    dumps = sorted(os.listdir(profile_dir))
+    for dump in dumps[: max(len(dumps) - PROFILE_KEEP + 1, 0)]:
+        os.remove(os.path.join(profile_dir, dump))
+    return os.path.join(
+        profile_dir, "{:.6f}-{}.{}".format(time.time(), name, extension)
+    )
+
+
+def profile_call(profile_dir, name, func):
+    """Run a function under cProfile and dump its statistics.
+
+    The profiler only sees the calling thread, so each check is profiled on
+    the worker thread running it.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile_path(profile_dir, name, "prof"))
+
+
+@contextlib.contextmanager
+def traced(profile_dir, name):
+    """Dump a tracemalloc snapshot of the memory allocated within a block."""
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(profile_path(profile_dir, name, "snapshot"))
+
+
+def parse_timestamp(timestamp):
+    """Convert a Kubernetes RFC 3339 UTC timestamp to seconds since the epoch."""
+    return calendar.timegm(time.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def load_state(state_dir, name):
+    """Load the state a check saved on its previous run.
+
+    :param state_dir: Directory holding the check state files
+    :param name: Name of the check owning the state
+    :returns: dict, empty if there is no (readable) previous state
+    """
+    try:
+        with open(os.path.join(state_dir, "{}.json".format(name))) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_dir, name, state):
+    """Atomically save the state of a check for its next run.
+
+    :param state_dir: Directory holding the check state files
+    :param name: Name of the check owning the state
+    :param state: JSON serializable state
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix=".{}.".format(name))
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(state_dir, "{}.json".format(name)))
+
+
+def parse_health_components(body):
+    """Parse the per-component lines of a verbose /readyz or /livez response.
+
+    :param body: Response body, the "[+]ping ok" and "[-]etcd failed" lines
+    :returns: dict of component name to bool (True when the check passed)
+    """
+    components = {}
+    for line in body.decode(errors="replace").splitlines():
+        if line[:3] in ("[+]", "[-]"):
+            name = line[3:].split(" ", 1)[0]
+            components[name] = line[1] == "+"
+    return components
+
+
+def _component_status(component):
+    """Get the Nagios status of a failing health component."""
+    if component.startswith(HEALTH_WARNING_COMPONENTS):
+        return NAGIOS_STATUS_WARNING
+    return NAGIOS_STATUS_CRITICAL
+
+
+def check_kubernetes_health(
+    k8s_address, client_token, disable_ssl, endpoint="readyz", exclude=(), engine=None
+):
+    """Call <kubernetes-api>/readyz?verbose and check every health component.
+
+    A single request returns the status of all the apiserver components
+    (etcd, informer-sync, post start hooks, ...). Each failing component
+    gets its own status and the worst one is returned.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param endpoint: Health endpoint to call, 'readyz' or 'livez'
+    :param exclude: Names of the components to ignore
+    :param engine: CheckEngine the check is run by, if any
+    """
+    url = "{}/{}?verbose".format(k8s_address, endpoint)
+    http = engine.http if engine else http_pool(disable_ssl)
+
+    try:
+        resp = api_request(http, url, client_token)
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+
+    with timed("parse"):
+        components = parse_health_components(resp.data)
+    if not components and resp.status == 200 and resp.data == b"ok":
+        return NAGIOS_STATUS_OK, "Kubernetes {} 'ok'".format(endpoint)
+    elif not components and resp.status == 200:
+        return (
+            NAGIOS_STATUS_WARNING,
+            "Unexpected Kubernetes {} status '{}'".format(endpoint, resp.data),
+        )
+    elif resp.status not in (200, 500) or not components:
+        return (
+            NAGIOS_STATUS_CRITICAL,
+            "Unexpected HTTP Response code ({})".format(resp.status),
+        )
+
+    failed = {
+        name: _component_status(name)
+        for name, passed in components.items()
+        if not passed and name not in exclude
+    }
+    if not failed:
+        return NAGIOS_STATUS_OK, "Kubernetes {} 'ok' ({} checks passed)".format(
+            endpoint, len(components)
+        )
+    return (
+        max(failed.values()),
+        "Kubernetes {} failed: {}".format(
+            endpoint,
+            ", ".join(
+                "{} ({})".format(name, NAGIOS_STATUS[status])
+                for name, status in sorted(failed.items())
+            ),
+        ),
+    )
+
+
+def list_nodes(http, k8s_address, client_token, engine=None):
+    """List the nodes, once per engine for the checks sharing it.
+
+    :param http: urllib3 PoolManager shared between requests
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param engine: CheckEngine the check is run by, if any
+    :raises KubernetesAPIError: on any non 200 response
+    """
+    url = k8s_address + "/api/v1/nodes"
+    if engine:
+        return engine.memoise(
+            ("nodes", url),
+            lambda: list(list_resources(engine.http, url, client_token)),
+        )
+    return list(list_resources(http, url, client_token))
+
+
+def _kubelet_versions(nodes):
+    """Get the [name, kubelet version] of each node of a node list."""
+    return [
+        [
+            item["metadata"]["name"],
+            item["status"].get("nodeInfo", {}).get("kubeletVersion", ""),
+        ]
+        for item in nodes
+    ]
+
+
+def _save_node_versions(state_dir, kubelets):
+    """Save the kubelet versions of the nodes, for the skew check to reuse."""
+    try:
+        save_state(
+            state_dir, "node_versions", {"timestamp": time.time(), "kubelets": kubelets}
+        )
+    except OSError:
+        # only spares a node list, the skew check then lists the nodes
+        pass
+
+
+def _node_groups(labels, group_label=None):
+    """Get the role, zone and optional label value of a node from its labels."""
+    roles = [
+        key.partition("/")[2] for key in labels if key.startswith(NODE_ROLE_PREFIX)
+    ]
+    groups = {
+        "role": ",".join(sorted(roles)) or "<none>",
+        "zone": labels.get(NODE_ZONE_LABEL, "<none>"),
+    }
+    if group_label:
+        groups[group_label] = labels.get(group_label, "<none>")
+    return groups
+
+
+def _summarise_not_ready(not_ready, total, listed, detail):
+    """Summarise a long list of NotReady nodes in a message of bounded size.
+
+    :param not_ready: list of (name, dict of group to value)
+    :param total: Number of nodes
+    :param listed: Number of nodes listed by name
+    :param detail: Path to the file holding the full list, None if not saved
+    """
+    counters = collections.defaultdict(collections.Counter)
+    for _, groups in not_ready:
+        for group, value in groups.items():
+            counters[group][value] += 1
+    message = "{} of {} Nodes NotReady ({}): {}, +{} more".format(
+        len(not_ready),
+        total,
+        "; ".join(
+            "{} {}".format(group, _format_top(counter))
+            for group, counter in counters.items()
+        ),
+        ", ".join(name for name, _ in not_ready[:listed]),
+        len(not_ready) - listed,
+    )
+    if detail:
+        message += " (full list in {})".format(detail)
+    return message
+
+
+def _save_not_ready(state_dir, not_ready):
+    """Save the full list of NotReady nodes to a local detail file.
+
+    :returns: path to the detail file, None when it could not be written
+    """
+    try:
+        save_state(
+            state_dir,
+            "nodes_not_ready",
+            {
+                "timestamp": time.time(),
+                "nodes": [dict(groups, name=name) for name, groups in not_ready],
+            },
+        )
+    except OSError:
+        return None
+    return os.path.join(state_dir, "nodes_not_ready.json")
+
+
+def check_kubernetes_nodes(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    state_dir=STATE_DIR,
+    listed=NODES_LISTED,
+    group_label=None,
+    engine=None,
+):
+    """Call <kubernetes-api>/api/v1/nodes endpoint and check each node status.
+
+    Beyond `listed` NotReady nodes, as when a rack goes down, the message
+    only names the first ones and counts them all by role, zone and
+    `group_label`, the full list being saved to a detail file in
+    `state_dir`, so the output stays within the NRPE buffer.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param state_dir: Directory to save the full list of NotReady nodes, and
+                      the kubelet versions reused by the skew check, to
+    :param listed: Number of NotReady nodes listed by name
+    :param group_label: Node label the NotReady nodes are also counted by
+    :param engine: CheckEngine the check is run by, if any
+    """
+    http = engine.http if engine else http_pool(disable_ssl)
+
+    try:
+        nodes = list_nodes(http, k8s_address, client_token, engine)
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+    except KubernetesAPIError as e:
+        return NAGIOS_STATUS_CRITICAL, str(e)
+    _save_node_versions(state_dir, _kubelet_versions(nodes))
+
+    not_ready = []
+    with timed("evaluate"):
+        for item in nodes:
+            for condition in item["status"]["conditions"]:
+                if condition["type"] == "Ready" and condition["status"] != "True":
+                    metadata = item["metadata"]
+                    not_ready.append(
+                        (
+                            metadata["name"],
+                            _node_groups(metadata.get("labels") or {}, group_label),
+                        )
+                    )
+
+    perfdata = {
+        "nodes": len(nodes),
+        "not_ready": len(not_ready),
+    }
+    if not not_ready:
+        return NAGIOS_STATUS_OK, with_perfdata("All Nodes Ready", perfdata)
+
+    if len(not_ready) > listed:
+        message = _summarise_not_ready(
+            not_ready, len(nodes), listed, _save_not_ready(state_dir, not_ready)
+        )
+    else:
+        message = "Nodes NotReady: {}".format(", ".join(name for name, _ in not_ready))
+    return CheckResult(
+        NAGIOS_STATUS_CRITICAL,
+        with_perfdata(message, perfdata),
+        [dict(groups, node=name, problem="NotReady") for name, groups in not_ready],
+    )
+
+
+def _rollout_state(item):
+    """Get whether a rollout has stalled or is still being picked up.
+
+    Only the controller giving up (Progressing=False, past the progress
+    deadline) is a stalled rollout; a spec newer than the generation the
+    controller has observed, as right after every apply, is in progress.
+
+    :returns: "stalled", "progressing" or None
+    """
+    for condition in item["status"].get("conditions") or []:
+        if condition["type"] == "Progressing" and (
+            condition.get("status") == "False"
+            or condition.get("reason") == "ProgressDeadlineExceeded"
+        ):
+            return "stalled"
+    observed = item["status"].get("observedGeneration", 0)
+    if observed < item["metadata"].get("generation", 0):
+        return "progressing"
+    return None
+
+
+def _compact_replicated(item):
+    """Reduce a Deployment or StatefulSet to its replica counts."""
+    status = item["status"]
+    ready = status.get("readyReplicas", 0)
+    return (
+        item["spec"].get("replicas", 1),
+        ready,
+        status.get("updatedReplicas", 0),
+        status.get("availableReplicas", ready),
+    )
+
+
+def _compact_daemonset(item):
+    """Reduce a DaemonSet to its scheduling counts."""
+    status = item["status"]
+    return (
+        status.get("desiredNumberScheduled", 0),
+        status.get("numberReady", 0),
+        status.get("updatedNumberScheduled", 0),
+        status.get("numberAvailable", 0),
+    )
+
+
+WORKLOAD_KINDS = {
+    "Deployment": ("deployments", _compact_replicated),
+    "StatefulSet": ("statefulsets", _compact_replicated),
+    "DaemonSet": ("daemonsets", _compact_daemonset),
+}
+
+
+def _list_workloads(http, k8s_address, client_token, kind):
+    """List one apps/v1 workload kind, keeping only the fields being checked.
+
+    :returns: list of (kind, namespace, name, counts, rollout) tuples
+    """
+    resource, compact = WORKLOAD_KINDS[kind]
+    url = "{}/apis/apps/v1/{}".format(k8s_address, resource)
+    return [
+        (
+            kind,
+            item["metadata"]["namespace"],
+            item["metadata"]["name"],
+            compact(item),
+            _rollout_state(item),
+        )
+        for item in list_resources(http, url, client_token)
+    ]
+
+
+def _format_namespace_counts(counter):
+    return ", ".join("{}: {}".format(ns, n) for ns, n in sorted(counter.items()))
+
+
+def check_kubernetes_workloads(
+    k8s_address, client_token, disable_ssl, listed=NODES_LISTED, engine=None
+):
+    """Check rollout health of Deployments, StatefulSets and DaemonSets.
+
+    The three kinds are listed concurrently over a shared connection pool.
+    A workload is degraded when its ready, updated or available counts are
+    below the desired count or its new spec is not yet observed by its
+    controller, and critical when its rollout has stalled or none of its
+    replicas are ready.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param listed: Number of degraded workloads listed by name, critical first
+    :param engine: CheckEngine the check is run by, if any
+    """
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            kinds = engine.gather(
+                *(
+                    (_list_workloads, engine.http, k8s_address, client_token, kind)
+                    for kind in WORKLOAD_KINDS
+                )
+            )
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
+    workloads = [w for kind_workloads in kinds for w in kind_workloads]
+
+    status = NAGIOS_STATUS_OK
+    degraded = collections.Counter()
+    names = []
+    critical = []
+    findings = []
+    for kind, namespace, name, counts, rollout in workloads:
+        desired = counts[0]
+        if not rollout and min(counts[1:]) >= desired:
+            continue
+        degraded[namespace] += 1
+        findings.append(
+            {
+                "kind": kind,
+                "namespace": namespace,
+                "name": name,
+                "problem": rollout or "degraded",
+            }
+        )
+        if rollout == "stalled" or (desired and counts[1] == 0):
+            status = NAGIOS_STATUS_CRITICAL
+            critical.append("{} {}/{}".format(kind, namespace, name))
+        else:
+            status = max(status, NAGIOS_STATUS_WARNING)
+            names.append("{} {}/{}".format(kind, namespace, name))
+    names = critical + names
+
+    perfdata = {"workloads": len(workloads), "degraded": len(names)}
+    if not degraded:
+        return NAGIOS_STATUS_OK, with_perfdata(
+            "All {} workloads at spec".format(len(workloads)), perfdata
+        )
+    return CheckResult(
+        status,
+        with_perfdata(
+            "{} of {} workloads degraded ({}): {}{}".format(
+                len(names),
+                len(workloads),
+                _format_namespace_counts(degraded),
+                ", ".join(names[:listed]),
+                ", ..." if len(names) > listed else "",
+            ),
+            perfdata,
+        ),
+        findings,
+    )
+
+
+def _events_bookmark(http, url, client_token):
+    """Get the current resourceVersion of the Warning events list."""
+    resp = api_request(
+        http, url, client_token, fields={"fieldSelector": "type=Warning", "limit": 1}
+    )
+    if resp.status != 200:
+        raise KubernetesAPIError(
+            "Unexpected HTTP Response code ({})".format(resp.status)
+        )
+    return json.loads(resp.data)["metadata"]["resourceVersion"]
+
+
+def _watch_warning_events(http, url, client_token, resource_version):
+    """Stream the Warning events added since resource_version.
+
+    The watch is closed by the apiserver after WATCH_TIMEOUT seconds, so the
+    cost of a run only depends on the number of new events.
+
+    :returns: (events, resourceVersion to resume from next run)
+    :raises ResourceVersionExpired: when resource_version was compacted
+    :raises KubernetesAPIError: on any other error
+    """
+    resp = api_request(
+        http,
+        url,
+        client_token,
+        fields={
+            "watch": 1,
+            "fieldSelector": "type=Warning",
+            "resourceVersion": resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": WATCH_TIMEOUT,
+        },
+        preload_content=False,
+    )
+    events = []
+    with released(resp):
+        if resp.status == 410:
+            raise ResourceVersionExpired("resourceVersion {}".format(resource_version))
+        if resp.status != 200:
+            raise KubernetesAPIError(
+                "Unexpected HTTP Response code ({})".format(resp.status)
+            )
+        for line in iter_lines(resp):
+            if not line.strip():
+                continue
+            watch_event = json.loads(line)
+            obj = watch_event["object"]
+            if watch_event["type"] == "ERROR":
+                if obj.get("code") == 410:
+                    raise ResourceVersionExpired(obj.get("message"))
+                raise KubernetesAPIError(
+                    "Events watch failed ({})".format(obj.get("message"))
+                )
+            resource_version = obj["metadata"]["resourceVersion"]
+            if watch_event["type"] in ("ADDED", "MODIFIED"):
+                involved = obj.get("involvedObject", {})
+                events.append(
+                    (
+                        obj.get("reason", ""),
+                        "{} {}/{}".format(
+                            involved.get("kind"),
+                            involved.get("namespace", ""),
+                            involved.get("name"),
+                        ),
+                    )
+                )
+    return events, resource_version
+
+
+def _resync_events(http, url, client_token, state_dir, now):
+    """Replace an expired events bookmark with the current resourceVersion.
+
+    Bookmarks expire with the normal compaction of the apiserver, so this
+    is not an error, only the events since the previous run are missed.
+    """
+    try:
+        resource_version = _events_bookmark(http, url, client_token)
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+    except KubernetesAPIError as e:
+        save_state(state_dir, "events", {})
+        return NAGIOS_STATUS_UNKNOWN, str(e)
+    save_state(
+        state_dir, "events", {"resourceVersion": resource_version, "timestamp": now}
+    )
+    flag("resynced")
+    return (
+        NAGIOS_STATUS_OK,
+        "Warning events resynced after their bookmark expired, "
+        "events may have been missed",
+    )
+
+
+def _format_top(counter, count=5):
+    return ", ".join("{}: {}".format(k, n) for k, n in counter.most_common(count))
+
+
+def check_kubernetes_events(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    state_dir=STATE_DIR,
+    warn_rate=10.0,
+    crit_rate=50.0,
+    engine=None,
+):
+    """Check the rate of new Warning events since the previous run.
+
+    The resourceVersion reached is saved between runs and only the events
+    newer than it are watched, aggregated by reason and involved object. A
+    bookmark compacted away by the apiserver is replaced in the same run, the
+    events in the gap being missed.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param state_dir: Directory to keep the resourceVersion bookmark in
+    :param warn_rate: Warning events per minute before alerting Warning
+    :param crit_rate: Warning events per minute before alerting Critical
+    :param engine: CheckEngine the check is run by, if any
+    """
+    url = k8s_address + "/api/v1/events"
+    http = engine.http if engine else http_pool(disable_ssl)
+    state = load_state(state_dir, "events")
+    now = time.time()
+    try:
+        if not state.get("resourceVersion"):
+            state = {
+                "resourceVersion": _events_bookmark(http, url, client_token),
+                "timestamp": now,
+            }
+            save_state(state_dir, "events", state)
+            flag("resumed", False)
+            return NAGIOS_STATUS_OK, "Warning events bookmark initialised"
+        flag("resumed")
+        events, resource_version = _watch_warning_events(
+            http, url, client_token, state["resourceVersion"]
+        )
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+    except ResourceVersionExpired:
+        return _resync_events(http, url, client_token, state_dir, now)
+    except KubernetesAPIError as e:
+        # the bookmark is kept, retried on next run
+        return NAGIOS_STATUS_UNKNOWN, str(e)
+    save_state(
+        state_dir, "events", {"resourceVersion": resource_version, "timestamp": now}
+    )
+
+    minutes = max(now - state.get("timestamp", now), 60) / 60
+    rate = len(events) / minutes
+    if rate >= crit_rate:
+        status = NAGIOS_STATUS_CRITICAL
+    elif rate >= warn_rate:
+        status = NAGIOS_STATUS_WARNING
+    else:
+        status = NAGIOS_STATUS_OK
+    message = "{} new Warning events ({:.1f}/min)".format(len(events), rate)
+    if events:
+        reasons = collections.Counter(reason for reason, _ in events)
+        objects = collections.Counter(obj for _, obj in events)
+        message += "; reasons: {}; objects: {}".format(
+            _format_top(reasons), _format_top(objects)
+        )
+    return status, with_perfdata(
+        message,
+        {
+            "events": len(events),
+            "rate": "{:.2f};{};{}".format(rate, warn_rate, crit_rate),
+        },
+    )
+
+
+def parse_metric_line(line):
+    """Parse a Prometheus text format sample line.
+
+    :param line: e.g. 'apiserver_current_inflight_requests{request_kind="x"} 3'
+    :returns: (metric name, dict of labels, float value)
+    """
+    name, _, rest = line.partition("{")
+    if rest:
+        labels, _, value = rest.rpartition("}")
+        labels = dict(METRICS_LABEL_RE.findall(labels))
+    else:
+        name, _, value = line.partition(" ")
+        labels = {}
+    return name.strip(), labels, float(value.split()[0])
+
+
+def scrape_metrics(resp):
+    """Incrementally parse a streamed /metrics response.
+
+    Only the families used by the metrics check are kept, with histogram
+    buckets summed per verb/operation, so memory use does not grow with the
+    size of the response.
+
+    :param resp: urllib3 HTTPResponse requested with preload_content=False
+    :returns: dict with the 'histograms', 'inflight' and 'rejected' counters
+    """
+    wanted = tuple(
+        name.encode()
+        for name in list(METRICS_HISTOGRAMS) + [METRICS_INFLIGHT, METRICS_REJECTED]
+    )
+    histograms = {name: {} for name in METRICS_HISTOGRAMS}
+    inflight = 0.0
+    rejected = 0.0
+    for raw_line in iter_lines(resp):
+        if not raw_line.startswith(wanted):
+            continue
+        name, labels, value = parse_metric_line(raw_line.decode())
+        if name in histograms:
+            group = histograms[name].setdefault(
+                labels.get(METRICS_HISTOGRAMS[name]), {}
+            )
+            group[labels["le"]] = group.get(labels["le"], 0.0) + value
+        elif name == METRICS_INFLIGHT:
+            inflight += value
+        elif name == METRICS_REJECTED:
+            rejected += value
+    return {"histograms": histograms, "inflight": inflight, "rejected": rejected}
+
+
+def histogram_quantile(quantile, buckets):
+    """Estimate a quantile from cumulative histogram buckets, like Prometheus.
+
+    :param quantile: Quantile to estimate, e.g. 0.99
+    :param buckets: dict of upper bound ('le' label) to cumulative count
+    :returns: float, or None when the histogram holds no observation
+    """
+    bounds = sorted((float(le), count) for le, count in buckets.items())
+    if not bounds or bounds[-1][1] <= 0:
+        return None
+    rank = quantile * bounds[-1][1]
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in bounds:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (
+                count - lower_count
+            )
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def _bucket_deltas(current, previous):
+    """Subtract the previous run's bucket counters, unless they were reset."""
+    deltas = {le: count - previous.get(le, 0.0) for le, count in current.items()}
+    if any(delta < 0 for delta in deltas.values()):
+        # counters reset by an apiserver restart
+        return current
+    return deltas
+
+
+def _worst_p99(current, previous, ignored=()):
+    """Get the highest p99 latency, and its group, since the previous run."""
+    worst = (0.0, None)
+    for group, buckets in current.items():
+        if group in ignored:
+            continue
+        p99 = histogram_quantile(0.99, _bucket_deltas(buckets, previous.get(group, {})))
+        if p99 is not None and p99 > worst[0]:
+            worst = (p99, group)
+    return worst
+
+
+def _threshold_status(value, warn, crit):
+    if value >= crit:
+        return NAGIOS_STATUS_CRITICAL
+    elif value >= warn:
+        return NAGIOS_STATUS_WARNING
+    return NAGIOS_STATUS_OK
+
+
+def check_kubernetes_metrics(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    state_dir=STATE_DIR,
+    latency_warn=1.0,
+    latency_crit=5.0,
+    etcd_latency_warn=0.5,
+    etcd_latency_crit=2.0,
+    engine=None,
+):
+    """Check apiserver and etcd request latency and saturation from /metrics.
+
+    p99 latencies are computed from the histogram buckets observed since
+    the previous run, whose counters are saved in the state directory.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param state_dir: Directory to keep the previous run's counters in
+    :param latency_warn: apiserver p99 request latency (s) before alerting Warning
+    :param latency_crit: apiserver p99 request latency (s) before alerting Critical
+    :param etcd_latency_warn: etcd p99 request latency (s) before alerting Warning
+    :param etcd_latency_crit: etcd p99 request latency (s) before alerting Critical
+    :param engine: CheckEngine the check is run by, if any
+    """
+    http = engine.http if engine else http_pool(disable_ssl)
+    try:
+        resp = api_request(
+            http, k8s_address + "/metrics", client_token, preload_content=False
+        )
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+    with released(resp):
+        if resp.status != 200:
+            return (
+                NAGIOS_STATUS_CRITICAL,
+                "Unexpected HTTP Response code ({})".format(resp.status),
+            )
+        metrics = scrape_metrics(resp)
+    previous = load_state(state_dir, "metrics")
+    save_state(state_dir, "metrics", metrics)
+    if not previous:
+        return NAGIOS_STATUS_OK, "Metrics baseline recorded"
+
+    histograms = list(METRICS_HISTOGRAMS)
+    api_p99, verb = _worst_p99(
+        metrics["histograms"][histograms[0]],
+        previous["histograms"].get(histograms[0], {}),
+        METRICS_IGNORED_VERBS,
+    )
+    etcd_p99, operation = _worst_p99(
+        metrics["histograms"][histograms[1]],
+        previous["histograms"].get(histograms[1], {}),
+    )
+    rejected = max(metrics["rejected"] - previous.get("rejected", 0.0), 0.0)
+    status = max(
+        _threshold_status(api_p99, latency_warn, latency_crit),
+        _threshold_status(etcd_p99, etcd_latency_warn, etcd_latency_crit),
+        NAGIOS_STATUS_WARNING if rejected else NAGIOS_STATUS_OK,
+    )
+    message = (
+        "apiserver p99 {:.3f}s ({}), etcd p99 {:.3f}s ({}), "
+        "{:.0f} inflight requests, {:.0f} APF rejected requests".format(
+            api_p99,
+            verb or "n/a",
+            etcd_p99,
+            operation or "n/a",
+            metrics["inflight"],
+            rejected,
+        )
+    )
+    return status, with_perfdata(
+        message,
+        {
+            "apiserver_p99": "{:.3f}s;{};{}".format(
+                api_p99, latency_warn, latency_crit
+            ),
+            "etcd_p99": "{:.3f}s;{};{}".format(
+                etcd_p99, etcd_latency_warn, etcd_latency_crit
+            ),
+            "inflight": "{:.0f}".format(metrics["inflight"]),
+            "apf_rejected": "{:.0f}".format(rejected),
+        },
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_quantity(quantity):
+    """Convert a Kubernetes resource quantity (e.g. '250m', '2Gi') to a float.
+
+    Memoised, as the same few quantity strings are found over and over in
+    the specs and statuses of large clusters.
+
+    :param quantity: Quantity string as found in a resource spec or status
+    :raises ValueError: when the quantity cannot be parsed
+    """
+    match = QUANTITY_RE.match(str(quantity).strip())
+    if not match or match.group(2) not in QUANTITY_SUFFIXES:
+        raise ValueError("Invalid quantity '{}'".format(quantity))
+    number, suffix = match.groups()
+    return float(number) * QUANTITY_SUFFIXES[suffix]
+
+
+def _resource_columns(items, key):
+    """Get the cpu and memory of each node found in `key` of its items.
+
+    :returns: (names, cpu, memory) columns, cpu and memory as arrays
+    """
+    names, cpu, memory = [], array("d"), array("d")
+    for item in items:
+        resources = (item.get("status") or item)[key]
+        names.append(item["metadata"]["name"])
+        cpu.append(parse_quantity(resources["cpu"]))
+        memory.append(parse_quantity(resources["memory"]))
+    return names, cpu, memory
+
+
+def _list_node_resources(http, url, client_token, key):
+    """List the cpu and memory of each node found in `key` of its items.
+
+    :returns: (names, cpu, memory) columns, cpu and memory as arrays
+    """
+    return _resource_columns(list_resources(http, url, client_token), key)
+
+
+def _percentile(values, percent):
+    """Get the nearest-rank percentile of an already sorted sequence."""
+    if not values:
+        return math.nan
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def _utilisation(usage, allocatable):
+    """Compute the utilisation percentage column from usage and allocatable."""
+    ratios = map(operator.truediv, usage, allocatable)
+    return array("d", map((100.0).__mul__, ratios))
+
+
+def check_kubernetes_utilisation(
+    k8s_address, client_token, disable_ssl, warn=85, crit=95, top=3, engine=None
+):
+    """Check cpu and memory utilisation of the nodes against their allocatable.
+
+    Node usage (metrics.k8s.io) and allocatable (node list) are fetched
+    concurrently and aligned into columns, so the utilisation is computed
+    for all the nodes in one pass.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param warn: Node utilisation (percent) before alerting Warning
+    :param crit: Node utilisation (percent) before alerting Critical
+    :param top: Number of most utilised nodes to report
+    :param engine: CheckEngine the check is run by, if any
+    """
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            usage, nodes = engine.gather(
+                (
+                    _list_node_resources,
+                    engine.http,
+                    k8s_address + "/apis/metrics.k8s.io/v1beta1/nodes",
+                    client_token,
+                    "usage",
+                ),
+                (list_nodes, engine.http, k8s_address, client_token, engine),
+            )
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
+    names, usage_cpu, usage_memory = usage
+    allocatable_names, allocatable_cpu, allocatable_memory = _resource_columns(
+        nodes, "allocatable"
+    )
+
+    # align both column sets on the listed nodes reporting metrics, leaving
+    # out the nodes gone since the metrics were scraped and the nodes with
+    # nothing allocatable
+    position = {
+        name: i
+        for i, name in enumerate(allocatable_names)
+        if allocatable_cpu[i] > 0 and allocatable_memory[i] > 0
+    }
+    rows = [(i, position[name]) for i, name in enumerate(names) if name in position]
+    if not rows:
+        return NAGIOS_STATUS_UNKNOWN, "No node metrics available"
+    names = [names[row] for row, _ in rows]
+    cpu = _utilisation(
+        [usage_cpu[row] for row, _ in rows], [allocatable_cpu[i] for _, i in rows]
+    )
+    memory = _utilisation(
+        [usage_memory[row] for row, _ in rows],
+        [allocatable_memory[i] for _, i in rows],
+    )
+    worst = array("d", map(max, cpu, memory))
+
+    status = _threshold_status(max(worst), warn, crit)
+    ranked = sorted(range(len(names)), key=worst.__getitem__, reverse=True)[:top]
+    sorted_cpu, sorted_memory = sorted(cpu), sorted(memory)
+    perfdata = {
+        "cpu_max": "{:.1f}%;{};{}".format(sorted_cpu[-1], warn, crit),
+        "memory_max": "{:.1f}%;{};{}".format(sorted_memory[-1], warn, crit),
+    }
+    return status, with_perfdata(
+        "Node utilisation cpu p50 {:.0f}% p90 {:.0f}% max {:.0f}%, "
+        "memory p50 {:.0f}% p90 {:.0f}% max {:.0f}%; most utilised: {}".format(
+            _percentile(sorted_cpu, 50),
+            _percentile(sorted_cpu, 90),
+            sorted_cpu[-1],
+            _percentile(sorted_memory, 50),
+            _percentile(sorted_memory, 90),
+            sorted_memory[-1],
+            ", ".join(
+                "{} (cpu {:.0f}%, memory {:.0f}%)".format(names[i], cpu[i], memory[i])
+                for i in ranked
+            ),
+        ),
+        perfdata,
+    )
+
+
+def _ready_endpoints(http, k8s_address, client_token):
+    """Count the ready endpoints of every Service from its EndpointSlices.
+
+    :returns: Counter of (namespace, service name) to ready endpoints
+    """
+    ready = collections.Counter()
+    url = k8s_address + "/apis/discovery.k8s.io/v1/endpointslices"
+    for item in list_resources(
+        http, url, client_token, {"labelSelector": SERVICE_NAME_LABEL}
+    ):
+        metadata = item["metadata"]
+        key = (metadata["namespace"], metadata["labels"][SERVICE_NAME_LABEL])
+        # a nil ready condition is to be interpreted as ready
+        ready[key] += sum(
+            (endpoint.get("conditions") or {}).get("ready") is not False
+            for endpoint in item.get("endpoints") or []
+        )
+    return ready
+
+
+def _selector_services(http, k8s_address, client_token, namespaces, exclude):
+    """List the Services whose endpoints are managed from a pod selector.
+
+    :returns: list of (namespace, name), in the filtered namespaces
+    """
+    return [
+        (item["metadata"]["namespace"], item["metadata"]["name"])
+        for item in list_resources(http, k8s_address + "/api/v1/services", client_token)
+        if item["spec"].get("selector")
+        and item["spec"].get("type") != "ExternalName"
+        and (not namespaces or item["metadata"]["namespace"] in namespaces)
+        and item["metadata"]["namespace"] not in exclude
+    ]
+
+
+def check_kubernetes_services(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    namespaces=(),
+    exclude_namespaces=(),
+    critical=(),
+    engine=None,
+):
+    """Check every Service backed by a pod selector has a ready endpoint.
+
+    Services and EndpointSlices are listed concurrently, page by page, and
+    reduced to a ready endpoints count per Service, which the Services are
+    then joined to by the kubernetes.io/service-name label of the slices.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param namespaces: Only check the Services of these namespaces, if any
+    :param exclude_namespaces: Namespaces whose Services are not checked
+    :param critical: '<namespace>/<name>' of the Services alerting Critical,
+                     any other one alerts Warning
+    :param engine: CheckEngine the check is run by, if any
+    """
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            services, ready = engine.gather(
+                (
+                    _selector_services,
+                    engine.http,
+                    k8s_address,
+                    client_token,
+                    set(namespaces),
+                    set(exclude_namespaces),
+                ),
+                (_ready_endpoints, engine.http, k8s_address, client_token),
+            )
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
+
+    with timed("evaluate"):
+        down = ["{}/{}".format(*key) for key in services if not ready[key]]
+    perfdata = {"services": len(services), "no_endpoints": len(down)}
+    if not down:
+        return NAGIOS_STATUS_OK, with_perfdata(
+            "All {} services have ready endpoints".format(len(services)), perfdata
+        )
+    critical = set(critical)
+    down_critical = [name for name in down if name in critical]
+    listed = (down_critical + [name for name in down if name not in critical])[
+        :SERVICES_LISTED
+    ]
+    return CheckResult(
+        NAGIOS_STATUS_CRITICAL if down_critical else NAGIOS_STATUS_WARNING,
+        with_perfdata(
+            "{} of {} services without ready endpoints ({}): {}{}".format(
+                len(down),
+                len(services),
+                _format_namespace_counts(
+                    collections.Counter(name.split("/")[0] for name in down)
+                ),
+                ", ".join(listed),
+                ", ..." if len(down) > len(listed) else "",
+            ),
+            perfdata,
+        ),
+        [
+            {
+                "service": name,
+                "critical": name in critical,
+                "problem": "no ready endpoints",
+            }
+            for name in down
+        ],
+    )
+
+
+def _list_claims(http, k8s_address, client_token):
+    """List the PersistentVolumeClaims, keeping only the fields being checked.
+
+    :returns: list of (namespace, name, phase, volume name, storage class,
+              creation time) tuples
+    """
+    return [
+        (
+            item["metadata"]["namespace"],
+            item["metadata"]["name"],
+            item["status"].get("phase"),
+            item["spec"].get("volumeName"),
+            item["spec"].get("storageClassName"),
+            parse_timestamp(item["metadata"]["creationTimestamp"]),
+        )
+        for item in list_resources(
+            http, k8s_address + "/api/v1/persistentvolumeclaims", client_token
+        )
+    ]
+
+
+def _list_volumes(http, k8s_address, client_token):
+    """Index the PersistentVolumes by name, keeping only the fields being checked.
+
+    :returns: dict of volume name to (phase, storage class)
+    """
+    return {
+        item["metadata"]["name"]: (
+            item["status"].get("phase"),
+            item["spec"].get("storageClassName"),
+        )
+        for item in list_resources(
+            http, k8s_address + "/api/v1/persistentvolumes", client_token
+        )
+    }
+
+
+def _storage_problems(claims, volumes, pending_age):
+    """Count the claims and volumes problems per StorageClass.
+
+    :returns: (status, dict of storage class to Counter of problems)
+    """
+    status = NAGIOS_STATUS_OK
+    problems = collections.defaultdict(collections.Counter)
+    now = time.time()
+    for namespace, name, phase, volume, storage_class, created in claims:
+        volume_phase, volume_class = volumes.get(volume, (None, None))
+        storage_class = storage_class or volume_class or "<none>"
+        if phase == "Pending" and now - created > pending_age:
+            problems[storage_class]["pending claims"] += 1
+            status = max(status, NAGIOS_STATUS_WARNING)
+        elif phase == "Lost" or (phase == "Bound" and volume_phase is None):
+            problems[storage_class]["lost claims"] += 1
+            status = NAGIOS_STATUS_CRITICAL
+    for volume_phase, storage_class in volumes.values():
+        if volume_phase == "Failed":
+            problems[storage_class or "<none>"]["failed volumes"] += 1
+            status = NAGIOS_STATUS_CRITICAL
+        elif volume_phase == "Released":
+            problems[storage_class or "<none>"]["released volumes"] += 1
+            status = max(status, NAGIOS_STATUS_WARNING)
+    return status, problems
+
+
+def check_kubernetes_storage(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    pending_age=STORAGE_PENDING_AGE,
+    engine=None,
+):
+    """Check the binding of PersistentVolumeClaims and PersistentVolumes.
+
+    Claims and volumes are listed concurrently and claims are joined to
+    their volume through the volumes indexed by name. Claims Pending for
+    longer than `pending_age` and Released volumes alert Warning; Lost
+    claims, claims whose volume is missing and Failed volumes alert
+    Critical. Problems are grouped by StorageClass.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param pending_age: Seconds a claim may stay Pending before alerting
+    :param engine: CheckEngine the check is run by, if any
+    """
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            claims, volumes = engine.gather(
+                (_list_claims, engine.http, k8s_address, client_token),
+                (_list_volumes, engine.http, k8s_address, client_token),
+            )
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
+
+    with timed("evaluate"):
+        status, problems = _storage_problems(claims, volumes, pending_age)
+    perfdata = {
+        "claims": len(claims),
+        "volumes": len(volumes),
+        "problems": sum(sum(counts.values()) for counts in problems.values()),
+    }
+    if not problems:
+        return NAGIOS_STATUS_OK, with_perfdata(
+            "All {} claims and {} volumes bound".format(len(claims), len(volumes)),
+            perfdata,
+        )
+    return CheckResult(
+        status,
+        with_perfdata(
+            "Storage problems: {}".format(
+                "; ".join(
+                    "{}: {}".format(
+                        storage_class,
+                        ", ".join(
+                            "{} {}".format(n, problem)
+                            for problem, n in sorted(counts.items())
+                        ),
+                    )
+                    for storage_class, counts in sorted(problems.items())
+                )
+            ),
+            perfdata,
+        ),
+        [
+            {"storage_class": storage_class, "problem": problem, "count": n}
+            for storage_class, counts in sorted(problems.items())
+            for problem, n in sorted(counts.items())
+        ],
+    )
+
+
+def _resource_requests(resources):
+    """Get the cpu and memory requests of container resources."""
+    requests = (resources or {}).get("requests") or {}
+    return parse_quantity(requests.get("cpu", 0)), parse_quantity(
+        requests.get("memory", 0)
+    )
+
+
+def _pod_requests(spec):
+    """Get the cpu and memory requested by a pod, as the scheduler counts them.
+
+    Containers run together and add up, init containers run one at a time
+    before them, and the pod overhead comes on top.
+    """
+    cpu = memory = 0.0
+    for container in spec.get("containers") or []:
+        container_cpu, container_memory = _resource_requests(container.get("resources"))
+        cpu += container_cpu
+        memory += container_memory
+    for container in spec.get("initContainers") or []:
+        container_cpu, container_memory = _resource_requests(container.get("resources"))
+        cpu = max(cpu, container_cpu)
+        memory = max(memory, container_memory)
+    overhead_cpu, overhead_memory = _resource_requests(
+        {"requests": spec.get("overhead")}
+    )
+    return cpu + overhead_cpu, memory + overhead_memory
+
+
+def _page_requests(data):
+    """Add up the requests of the pods of a raw list page, per node.
+
+    Run on the worker processes, it only returns the per node sums rather
+    than the pods.
+
+    :param data: Raw bytes of a pods list page
+    :returns: dict of node name to [cpu, memory]
+    """
+    requested = {}
+    for pod in json.loads(data).get("items") or []:
+        node = pod["spec"].get("nodeName")
+        if not node:
+            # not scheduled yet
+            continue
+        pod_cpu, pod_memory = _pod_requests(pod["spec"])
+        total = requested.setdefault(node, [0.0, 0.0])
+        total[0] += pod_cpu
+        total[1] += pod_memory
+    return requested
+
+
+def _requested_per_node(http, k8s_address, client_token, engine):
+    """Add up the requests of the pods holding resources on each node.
+
+    Pods are fetched page by page, each page being reduced to its requests
+    per node, on the engine worker processes if any, and merged into one
+    accumulator slot per node.
+
+    :returns: (names, cpu, memory) columns, cpu and memory as arrays
+    """
+    names, cpu, memory = [], array("d"), array("d")
+    position = {}
+    pages = list_pages(
+        http,
+        k8s_address + "/api/v1/pods",
+        client_token,
+        {"fieldSelector": CAPACITY_POD_SELECTOR},
+    )
+    for requested in engine.map_pages(_page_requests, pages):
+        for node, (pod_cpu, pod_memory) in requested.items():
+            i = position.get(node)
+            if i is None:
+                i = position[node] = len(names)
+                names.append(node)
+                cpu.append(0.0)
+                memory.append(0.0)
+            cpu[i] += pod_cpu
+            memory[i] += pod_memory
+    return names, cpu, memory
+
+
+def check_kubernetes_capacity(
+    k8s_address, client_token, disable_ssl, warn=85, crit=95, top=3, engine=None
+):
+    """Check the cpu and memory requested by the pods against node allocatable.
+
+    The node list, shared with the other node checks of the engine, and the
+    pods holding node resources are fetched concurrently. The cluster
+    alerts when its total requests cross the thresholds; nodes whose
+    requests reach `crit` alert Warning, as the scheduler can still place
+    pods on the other nodes.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param warn: Requested cpu or memory (percent of allocatable) before alerting
+                 Warning
+    :param crit: Requested cpu or memory (percent of allocatable) before alerting
+                 Critical
+    :param top: Number of nodes above `warn` to report
+    :param engine: CheckEngine the check is run by, if any
+    """
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            nodes, requested = engine.gather(
+                (list_nodes, engine.http, k8s_address, client_token, engine),
+                (_requested_per_node, engine.http, k8s_address, client_token, engine),
+            )
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
+
+    with timed("evaluate"):
+        names, allocatable_cpu, allocatable_memory = _resource_columns(
+            nodes, "allocatable"
+        )
+        # align the requests on the schedulable nodes, which may have no pods
+        requested_names, requested_cpu, requested_memory = requested
+        position = {name: i for i, name in enumerate(requested_names)}
+        index = [
+            i
+            for i in range(len(names))
+            if allocatable_cpu[i] > 0 and allocatable_memory[i] > 0
+        ]
+        if not index:
+            return NAGIOS_STATUS_UNKNOWN, "No node with allocatable resources"
+        cpu_requests = array(
+            "d",
+            (
+                requested_cpu[position[names[i]]] if names[i] in position else 0.0
+                for i in index
+            ),
+        )
+        memory_requests = array(
+            "d",
+            (
+                requested_memory[position[names[i]]] if names[i] in position else 0.0
+                for i in index
+            ),
+        )
+        cpu_allocatable = [allocatable_cpu[i] for i in index]
+        memory_allocatable = [allocatable_memory[i] for i in index]
+        cpu = _utilisation(cpu_requests, cpu_allocatable)
+        memory = _utilisation(memory_requests, memory_allocatable)
+        worst = array("d", map(max, cpu, memory))
+        cluster_cpu = 100.0 * sum(cpu_requests) / sum(cpu_allocatable)
+        cluster_memory = 100.0 * sum(memory_requests) / sum(memory_allocatable)
+
+    status = _threshold_status(max(cluster_cpu, cluster_memory), warn, crit)
+    if max(worst) >= crit:
+        status = worst_status([status, NAGIOS_STATUS_WARNING])
+    full = [j for j in range(len(index)) if worst[j] >= warn]
+    ranked = sorted(full, key=worst.__getitem__, reverse=True)[:top]
+    perfdata = {
+        "cpu_requested": "{:.1f}%;{};{}".format(cluster_cpu, warn, crit),
+        "memory_requested": "{:.1f}%;{};{}".format(cluster_memory, warn, crit),
+        "nodes_full": len(full),
+    }
+    message = "Requested cpu {:.0f}% memory {:.0f}% of allocatable".format(
+        cluster_cpu, cluster_memory
+    )
+    if full:
+        message += ", {} nodes above {}%: {}".format(
+            len(full),
+            warn,
+            ", ".join(
+                "{} (cpu {:.0f}%, memory {:.0f}%)".format(
+                    names[index[j]], cpu[j], memory[j]
+                )
+                for j in ranked
+            ),
+        )
+    return status, with_perfdata(message, perfdata)
+
+
+def _quota_columns(http, k8s_address, client_token):
+    """List the used and hard amounts of every resource of every ResourceQuota.
+
+    Resources without a positive hard limit are left out.
+
+    :returns: (names, used, hard) columns, names being (namespace, quota,
+              resource) and used and hard arrays
+    """
+    names, used, hard = [], array("d"), array("d")
+    for item in list_resources(
+        http, k8s_address + "/api/v1/resourcequotas", client_token
+    ):
+        status = item.get("status") or {}
+        for resource, limit in (status.get("hard") or {}).items():
+            limit = parse_quantity(limit)
+            if limit <= 0:
+                continue
+            names.append(
+                (item["metadata"]["namespace"], item["metadata"]["name"], resource)
+            )
+            used.append(parse_quantity((status.get("used") or {}).get(resource, 0)))
+            hard.append(limit)
+    return names, used, hard
+
+
+def check_kubernetes_quotas(
+    k8s_address, client_token, disable_ssl, warn=80, crit=95, top=5, engine=None
+):
+    """Check how close the ResourceQuotas of the namespaces are to their limits.
+
+    The used and hard amounts of every quota resource are collected into
+    columns, so their ratios are computed for all of them in one pass.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param warn: Quota usage (percent of hard) before alerting Warning
+    :param crit: Quota usage (percent of hard) before alerting Critical
+    :param top: Number of most saturated quotas to report
+    :param engine: CheckEngine the check is run by, if any
+    """
+    http = engine.http if engine else http_pool(disable_ssl)
+    try:
+        names, used, hard = _quota_columns(http, k8s_address, client_token)
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+    except KubernetesAPIError as e:
+        return NAGIOS_STATUS_CRITICAL, str(e)
+    if not names:
+        return NAGIOS_STATUS_OK, with_perfdata(
+            "No ResourceQuota limits", {"quotas": 0, "saturated": 0}
+        )
+
+    with timed("evaluate"):
+        usage = _utilisation(used, hard)
+        saturated = [i for i, percent in enumerate(usage) if percent >= warn]
+        ranked = sorted(saturated, key=usage.__getitem__, reverse=True)[:top]
+    status = _threshold_status(max(usage), warn, crit)
+    perfdata = {
+        "quotas": len(names),
+        "saturated": len(saturated),
+        "max": "{:.1f}%;{};{}".format(max(usage), warn, crit),
+    }
+    if not saturated:
+        return status, with_perfdata(
+            "All {} quota resources below {}%".format(len(names), warn), perfdata
+        )
+    return status, with_perfdata(
+        "{} quota resources above {}% ({}); most saturated: {}".format(
+            len(saturated),
+            warn,
+            _format_namespace_counts(
+                collections.Counter(names[i][0] for i in saturated)
+            ),
+            ", ".join("{}/{} {} {:.0f}%".format(*names[i], usage[i]) for i in ranked),
+        ),
+        perfdata,
+    )
+
+
+def _lease_renewals(http, k8s_address, client_token):
+    """List the node Leases, keeping only their holder and last renewal.
+
+    :returns: list of (node name, renewTime as a timestamp, None if never renewed)
+    """
+    return [
+        (
+            item["metadata"]["name"],
+            parse_timestamp(item["spec"]["renewTime"])
+            if (item.get("spec") or {}).get("renewTime")
+            else None,
+        )
+        for item in list_resources(http, k8s_address + NODE_LEASES_PATH, client_token)
+    ]
+
+
+def check_kubernetes_leases(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    warn=20,
+    crit=40,
+    listed=NODES_LISTED,
+    engine=None,
+):
+    """Check the age of the node heartbeat Leases renewed by the kubelets.
+
+    A kubelet renews the Lease of its node, in the kube-node-lease
+    namespace, every 10s, so one that stopped heartbeating is caught before
+    the node-monitor grace period flips its Ready condition, from objects a
+    fraction of the size of the Nodes. Ages are measured against the local
+    clock, which must be synchronised with the control plane.
+
+    :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
+    :param client_token: Token for authenticating with the kube-api
+    :param disable_ssl: Disables SSL Host Key verification
+    :param warn: Seconds since the last renewal before alerting Warning
+    :param crit: Seconds since the last renewal before alerting Critical
+    :param listed: Number of stale Leases listed by name
+    :param engine: CheckEngine the check is run by, if any
+    """
+    http = engine.http if engine else http_pool(disable_ssl)
+    try:
+        leases = _lease_renewals(http, k8s_address, client_token)
+    except urllib3.exceptions.MaxRetryError as e:
+        return NAGIOS_STATUS_CRITICAL, e
+    except KubernetesAPIError as e:
+        return NAGIOS_STATUS_CRITICAL, str(e)
+    if not leases:
+        return NAGIOS_STATUS_UNKNOWN, "No node Lease found in kube-node-lease"
+
+    with timed("evaluate"):
+        now = time.time()
+        ages = [
+            (now - renewed if renewed is not None else math.inf, name)
+            for name, renewed in leases
+        ]
+        stale = sorted((age, name) for age, name in ages if age >= warn)
+        max_age = max(age for age, _ in ages)
+        # leases never renewed are left out of the perfdata
+        max_renewal_age = max((a for a, _ in ages if a != math.inf), default=0)
+
+    perfdata = {
+        "leases": len(leases),
+        "stale": len(stale),
+        "max_age": "{:.0f}s;{};{}".format(max_renewal_age, warn, crit),
+    }
+    if not stale:
+        return NAGIOS_STATUS_OK, with_perfdata(
+            "All {} node Leases renewed within {}s".format(len(leases), warn),
+            perfdata,
+        )
+    stale.reverse()
+    return CheckResult(
+        _threshold_status(max_age, warn, crit),
+        with_perfdata(
+            "{} of {} node Leases not renewed for {}s: {}{}".format(
+                len(stale),
+                len(leases),
+                warn,
+                ", ".join(
+                    "{} ({})".format(
+                        name, "never" if age == math.inf else "{:.0f}s".format(age)
+                    )
+                    for age, name in stale[:listed]
+                ),
+                ", ..." if len(stale) > listed else "",
+            ),
+            perfdata,
+        ),
+        [
+            {"node": name, "age": None if age == math.inf else round(age, 1)}
+            for age, name in stale
+        ],
+    )
+
+
+def _apiserver_version(http, k8s_address, client_token):
+    """Get the gitVersion of the apiserver from its /version endpoint.
+
+    :raises KubernetesAPIError: on any non 200 response
     """
-    assert status in NAGIOS_STATUS, "Invalid Nagios status code"
-    # prefix status name to message
-    output = "{}: {}".format(NAGIOS_STATUS[status], message)
-    print(output)  # nagios requires print to stdout, no stderr
-    sys.exit(status)
+    resp = api_request(http, k8s_address + "/version", client_token)
+    if resp.status != 200:
+        raise KubernetesAPIError(
+            "Unexpected HTTP Response code ({})".format(resp.status)
+        )
+    return json.loads(resp.data)["gitVersion"]
+
+
+def _version_skew(kubelet, apiserver, max_minor):
+    """Check whether a kubelet version is outside the supported skew.
+
+    :param kubelet: (major, minor) of the kubelet, None if unparsable
+    :param apiserver: (major, minor) of the apiserver
+    :param max_minor: Minor versions the kubelet may be older by
+    """
+    if kubelet is None or kubelet[0] != apiserver[0]:
+        return True
+    return not 0 <= apiserver[1] - kubelet[1] <= max_minor
+
 
+def check_kubernetes_skew(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    state_dir=STATE_DIR,
+    max_minor=SKEW_MAX_MINOR,
+    listed=NODES_LISTED,
+    max_age=NODE_VERSIONS_MAX_AGE,
+    engine=None,
+):
+    """Check the kubelet versions of the nodes against the apiserver version.
 
-def check_kubernetes_health(k8s_address, client_token, disable_ssl):
-    """Call <kubernetes-api>/healthz endpoint and check return value is 'ok'.
+    The kubelet versions saved by the nodes check in the last `max_age`
+    seconds are reused, else they come from the node list shared with the
+    other node checks run by the same engine, so the check usually only
+    adds a /version request. Nodes are grouped by kubelet version and those
+    newer than the apiserver, or older by more than `max_minor` minor
+    versions, alert Critical.
 
     :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
     :param client_token: Token for authenticating with the kube-api
     :param disable_ssl: Disables SSL Host Key verification
+    :param state_dir: Directory the nodes check saves the kubelet versions to
+    :param max_minor: Minor versions a kubelet may be older than the apiserver
+    :param listed: Number of nodes outside the skew listed by name
+    :param max_age: Seconds the saved kubelet versions are reused for
+    :param engine: CheckEngine the check is run by, if any
     """
-    url = k8s_address + "/healthz"
-    if disable_ssl:
-        # perform check without SSL verification
-        http = urllib3.PoolManager(cert_reqs="CERT_NONE", assert_hostname=False)
-    else:
-        http = urllib3.PoolManager()
+    saved = load_state(state_dir, "node_versions")
+    fresh = time.time() - saved.get("timestamp", 0) < max_age
+    flag("node_versions_cached", fresh)
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            if fresh:
+                kubelets = saved["kubelets"]
+                (version,) = engine.gather(
+                    (_apiserver_version, engine.http, k8s_address, client_token)
+                )
+            else:
+                nodes, version = engine.gather(
+                    (list_nodes, engine.http, k8s_address, client_token, engine),
+                    (_apiserver_version, engine.http, k8s_address, client_token),
+                )
+                kubelets = _kubelet_versions(nodes)
+                _save_node_versions(state_dir, kubelets)
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
+    match = VERSION_RE.match(version)
+    if not match:
+        return NAGIOS_STATUS_UNKNOWN, "Unknown apiserver version {}".format(version)
+    apiserver = tuple(map(int, match.groups()))
+
+    with timed("evaluate"):
+        versions = collections.Counter()
+        skewed = []
+        for name, kubelet in kubelets:
+            versions[kubelet] += 1
+            match = VERSION_RE.match(kubelet)
+            parsed = tuple(map(int, match.groups())) if match else None
+            if _version_skew(parsed, apiserver, max_minor):
+                skewed.append((name, kubelet))
+
+    perfdata = {
+        "nodes": len(kubelets),
+        "versions": len(versions),
+        "skewed": len(skewed),
+    }
+    message = "apiserver {}, kubelets {}".format(version, _format_top(versions))
+    if not skewed:
+        return NAGIOS_STATUS_OK, with_perfdata(message, perfdata)
+    return CheckResult(
+        NAGIOS_STATUS_CRITICAL,
+        with_perfdata(
+            "{}; {} nodes outside the supported skew: {}{}".format(
+                message,
+                len(skewed),
+                ", ".join(
+                    "{} ({})".format(name, kubelet or "unknown")
+                    for name, kubelet in skewed[:listed]
+                ),
+                ", ..." if len(skewed) > listed else "",
+            ),
+            perfdata,
+        ),
+        [
+            {"node": name, "kubelet_version": kubelet, "apiserver_version": version}
+            for name, kubelet in skewed
+        ],
+    )
+
 
+def _der_element(data, offset):
+    """Read the DER element at an offset.
+
+    :returns: (tag, offset of its content, offset of the next element)
+    :raises ValueError: on a truncated element
+    """
+    tag, length = data[offset], data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        start, offset = offset, offset + (length & 0x7F)
+        length = int.from_bytes(data[start:offset], "big")
+    if offset + length > len(data):
+        raise ValueError("Truncated DER element")
+    return tag, offset, offset + length
+
+
+def certificate_not_after(der):
+    """Get the expiry of a DER X.509 certificate, reading only its validity.
+
+    Certificate ::= SEQUENCE { tbsCertificate SEQUENCE { [0] version OPTIONAL,
+    serialNumber, signature, issuer, validity SEQUENCE { notBefore, notAfter },
+    ... } ... }
+
+    :returns: notAfter as a timestamp
+    :raises ValueError: on anything else than a certificate
+    """
     try:
-        resp = http.request(
-            "GET", url, headers={"Authorization": "Bearer {}".format(client_token)}
+        _, offset, _ = _der_element(der, 0)
+        _, offset, _ = _der_element(der, offset)
+        if der[offset] == 0xA0:
+            # explicit version
+            offset = _der_element(der, offset)[2]
+        for _ in range(3):
+            # serialNumber, signature and issuer
+            offset = _der_element(der, offset)[2]
+        _, offset, _ = _der_element(der, offset)
+        offset = _der_element(der, offset)[2]
+        tag, start, end = _der_element(der, offset)
+    except IndexError:
+        raise ValueError("Truncated certificate")
+    value = der[start:end].decode("ascii")
+    if tag == 0x17:
+        # UTCTime, YYMMDDHHMMSSZ, years 1950 to 2049
+        year = int(value[:2])
+        value = str(1900 + year if year >= 50 else 2000 + year) + value[2:]
+    elif tag != 0x18:
+        raise ValueError("Unexpected notAfter tag {:#x}".format(tag))
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+
+def pem_not_after(pem):
+    """Get the soonest expiry of the certificates of a PEM bundle.
+
+    :raises ValueError: when the bundle holds no certificate
+    """
+    expiries = [
+        certificate_not_after(base64.b64decode(block))
+        for block in PEM_CERTIFICATE_RE.findall(pem)
+    ]
+    if not expiries:
+        raise ValueError("No certificate found")
+    return min(expiries)
+
+
+def _pending_csrs(http, k8s_address, client_token):
+    """List the CertificateSigningRequests neither approved, denied nor failed.
+
+    :returns: list of (name, signer name, creation time)
+    """
+    return [
+        (
+            item["metadata"]["name"],
+            item["spec"].get("signerName", ""),
+            parse_timestamp(item["metadata"]["creationTimestamp"]),
         )
-    except urllib3.exceptions.MaxRetryError as e:
-        return NAGIOS_STATUS_CRITICAL, e
+        for item in list_resources(
+            http,
+            k8s_address + "/apis/certificates.k8s.io/v1/certificatesigningrequests",
+            client_token,
+        )
+        if not (item.get("status") or {}).get("conditions")
+    ]
 
-    if resp.status != 200:
-        return (
-            NAGIOS_STATUS_CRITICAL,
-            "Unexpected HTTP Response code ({})".format(resp.status),
+
+def _tls_secrets(http, k8s_address, client_token, namespace):
+    """List the TLS Secrets of a namespace.
+
+    :returns: list of ("namespace/name", resourceVersion, base64 tls.crt)
+    """
+    return [
+        (
+            "{}/{}".format(namespace, item["metadata"]["name"]),
+            item["metadata"]["resourceVersion"],
+            (item.get("data") or {}).get("tls.crt", ""),
         )
-    elif resp.data != b"ok":
-        return (
-            NAGIOS_STATUS_WARNING,
-            "Unexpected Kubernetes healthz status '{}'".format(resp.data),
+        for item in list_resources(
+            http,
+            "{}/api/v1/namespaces/{}/secrets".format(k8s_address, namespace),
+            client_token,
+            {"fieldSelector": "type=kubernetes.io/tls"},
         )
-    return NAGIOS_STATUS_OK, "Kubernetes health 'ok'"
+    ]
 
 
-def check_kubernetes_nodes(k8s_address, client_token, disable_ssl):
-    """Call <kubernetes-api>/api/v1/nodes endpoint and check each node status.
+def _secrets_not_after(secrets, cache):
+    """Get the expiry of the certificates of TLS Secrets, decoding only new ones.
+
+    :param secrets: list of ("namespace/name", resourceVersion, base64 tls.crt)
+    :param cache: dict of "namespace/name" to [resourceVersion, notAfter] of
+                  the previous run
+    :returns: dict of "namespace/name" to [resourceVersion, notAfter], notAfter
+              being None for an unreadable certificate
+    """
+    decoded = {}
+    for name, resource_version, crt in secrets:
+        cached = cache.get(name)
+        if cached and cached[0] == resource_version:
+            decoded[name] = cached
+            continue
+        try:
+            not_after = pem_not_after(base64.b64decode(crt))
+        except ValueError:
+            not_after = None
+        decoded[name] = [resource_version, not_after]
+    return decoded
+
+
+def check_kubernetes_certificates(
+    k8s_address,
+    client_token,
+    disable_ssl,
+    state_dir=STATE_DIR,
+    namespaces=CERTIFICATES_NAMESPACES,
+    csr_age=CSR_PENDING_AGE,
+    warn_days=60,
+    crit_days=30,
+    listed=NODES_LISTED,
+    engine=None,
+):
+    """Check pending CertificateSigningRequests and TLS Secrets expiry.
+
+    CSRs pending for longer than `csr_age`, e.g. kubelet certificates left
+    unapproved, alert Warning. The TLS Secrets of `namespaces`, listed
+    concurrently with a field selector, have the certificates of their
+    tls.crt decoded to their soonest expiry, which is cached by
+    resourceVersion in `state_dir`, so unchanged Secrets are not decoded
+    again.
 
     :param k8s_address: Address to kube-api-server formatted 'https://<IP>:<PORT>'
     :param client_token: Token for authenticating with the kube-api
     :param disable_ssl: Disables SSL Host Key verification
+    :param state_dir: Directory to keep the decoded expiries in
+    :param namespaces: Namespaces whose TLS Secrets are checked
+    :param csr_age: Seconds a CSR may stay pending before alerting Warning
+    :param warn_days: Days left before a certificate expiry alerts Warning
+    :param crit_days: Days left before a certificate expiry alerts Critical
+    :param listed: Number of pending CSRs and expiring certificates listed
+    :param engine: CheckEngine the check is run by, if any
     """
-    url = k8s_address + "/api/v1/nodes"
-    if disable_ssl:
-        # perform check without SSL verification
-        http = urllib3.PoolManager(cert_reqs="CERT_NONE", assert_hostname=False)
-    else:
-        http = urllib3.PoolManager()
+    with CheckEngine.shared(engine, disable_ssl) as engine:
+        try:
+            pending, *secrets = engine.gather(
+                (_pending_csrs, engine.http, k8s_address, client_token),
+                *(
+                    (_tls_secrets, engine.http, k8s_address, client_token, ns)
+                    for ns in namespaces
+                ),
+            )
+        except urllib3.exceptions.MaxRetryError as e:
+            return NAGIOS_STATUS_CRITICAL, e
+        except KubernetesAPIError as e:
+            return NAGIOS_STATUS_CRITICAL, str(e)
 
-    try:
-        resp = http.request(
-            "GET", url, headers={"Authorization": "Bearer {}".format(client_token)}
+    now = time.time()
+    with timed("evaluate"):
+        stale = sorted(
+            (created, name, signer)
+            for name, signer, created in pending
+            if now - created > csr_age
         )
-    except urllib3.exceptions.MaxRetryError as e:
-        return NAGIOS_STATUS_CRITICAL, e
+        expiries = _secrets_not_after(
+            [secret for ns_secrets in secrets for secret in ns_secrets],
+            load_state(state_dir, "certificates"),
+        )
+    save_state(state_dir, "certificates", expiries)
+    days = sorted(
+        ((not_after - now) / 86400, name)
+        for name, (_, not_after) in expiries.items()
+        if not_after is not None
+    )
+    unreadable = sorted(
+        name for name, (_, not_after) in expiries.items() if not_after is None
+    )
+    expiring = [(left, name) for left, name in days if left <= warn_days]
+    return _certificates_result(
+        stale, expiring, days, unreadable, csr_age, warn_days, crit_days, listed
+    )
 
-    if resp.status != 200:
-        return (
-            NAGIOS_STATUS_CRITICAL,
-            "Unexpected HTTP Response code ({})".format(resp.status),
+
+def _certificates_result(
+    stale, expiring, days, unreadable, csr_age, warn_days, crit_days, listed
+):
+    """Build the result of the certificates check from its findings."""
+    status = NAGIOS_STATUS_OK
+    findings = []
+    parts = []
+    if stale:
+        status = NAGIOS_STATUS_WARNING
+        parts.append(
+            "{} CSRs pending over {}s: {}".format(
+                len(stale),
+                csr_age,
+                ", ".join(
+                    "{} ({})".format(name, signer) for _, name, signer in stale[:listed]
+                ),
+            )
+        )
+        findings += [
+            {"csr": name, "signer": signer, "problem": "pending"}
+            for _, name, signer in stale
+        ]
+    if expiring:
+        status = worst_status(
+            [
+                status,
+                NAGIOS_STATUS_CRITICAL
+                if expiring[0][0] <= crit_days
+                else NAGIOS_STATUS_WARNING,
+            ]
+        )
+        parts.append(
+            "{} TLS certificates expire within {} days: {}".format(
+                len(expiring),
+                warn_days,
+                ", ".join(
+                    "{} ({})".format(
+                        name, "expired" if left < 0 else "{:.0f} days".format(left)
+                    )
+                    for left, name in expiring[:listed]
+                ),
+            )
+        )
+        findings += [
+            {"secret": name, "days_left": round(left, 1), "problem": "expiring"}
+            for left, name in expiring
+        ]
+    if unreadable:
+        status = worst_status([status, NAGIOS_STATUS_WARNING])
+        parts.append(
+            "{} TLS Secrets without a readable certificate: {}".format(
+                len(unreadable), ", ".join(unreadable[:listed])
+            )
         )
+        findings += [{"secret": name, "problem": "unreadable"} for name in unreadable]
+    if not parts:
+        parts.append("No CSR pending over {}s".format(csr_age))
+        if days:
+            parts.append(
+                "soonest TLS certificate expiry {} in {:.0f} days".format(
+                    days[0][1], days[0][0]
+                )
+            )
+    perfdata = {
+        "csrs_pending": len(stale),
+        "certificates": len(days),
+        "expiring": len(expiring),
+    }
+    if days:
+        perfdata["min_days"] = "{:.0f}".format(days[0][0])
+    return CheckResult(status, with_perfdata("; ".join(parts), perfdata), findings)
 
-    response_body = json.loads(resp.data)
-    nodes_not_ready = []
-    for item in response_body["items"]:
-        for condition in item["status"]["conditions"]:
-            if condition["type"] == "Ready":
-                node_name = item["metadata"]["name"]
-                if condition["status"] != "True":
-                    nodes_not_ready.append(node_name)
 
-    if nodes_not_ready:
-        nodes = ", ".join(nodes_not_ready)
-        return (
-            NAGIOS_STATUS_CRITICAL,
-            f"Nodes NotReady: {nodes}",
+def worst_status(statuses):
+    """Get the worst of Nagios statuses, CRITICAL > WARNING > UNKNOWN > OK."""
+    return max(statuses, key=STATUS_SEVERITY.index, default=NAGIOS_STATUS_OK)
+
+
+def aggregate_results(results):
+    """Combine the results of several checks into a single Nagios result.
+
+    The first line summarises the child statuses and carries the merged
+    performance data, labels prefixed with '<check>::'; each child result
+    follows on its own line.
+
+    :param results: list of (check name, status, message)
+    :returns: CheckResult of the worst status, without the child results
+    """
+    counts = collections.Counter(status for _, status, _ in results)
+    perfdata = {}
+    lines = []
+    for check, status, message in results:
+        message, child_perfdata = split_perfdata(message)
+        lines.append("[{}] {}: {}".format(NAGIOS_STATUS[status], check, message))
+        perfdata.update(
+            ("{}::{}".format(check, label), value)
+            for label, value in child_perfdata.items()
         )
+    summary = "{} checks, {}".format(
+        len(results),
+        ", ".join(
+            "{} {}".format(counts[status], NAGIOS_STATUS[status].lower())
+            for status in reversed(STATUS_SEVERITY)
+        ),
+    )
+    if perfdata:
+        summary = with_perfdata(summary, perfdata)
+    return CheckResult(worst_status(counts), "\n".join([summary] + lines))
 
-    return NAGIOS_STATUS_OK, "All Nodes Ready"
 
+def run_checks(args, engine):
+    """Run every check listed in --checks concurrently and aggregate them.
 
-if __name__ == "__main__":
+    :param args: argparse.Namespace built by build_parser()
+    :param engine: CheckEngine running the checks
+    :returns: CheckResult holding the result of each check
+    """
+    results = engine.run_checks(
+        {
+            check: check_function(
+                argparse.Namespace(**dict(vars(args), check=check)), engine
+            )
+            for check in args.checks
+        }
+    )
+    status, message = aggregate_results(
+        [(check, status, message) for check, (status, message) in results.items()]
+    )
+    return CheckResult(status, message, checks=results)
+
+
+def _comma_list(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def _check_list(value):
+    checks = [check.strip() for check in value.split(",") if check.strip()]
+    for check in checks:
+        if check not in CHECK_CHOICES:
+            raise argparse.ArgumentTypeError("invalid check '{}'".format(check))
+    return checks
+
+
+def build_parser():
+    """Build the command line parser of the plugin."""
     parser = argparse.ArgumentParser(
         description="Check Kubernetes API status",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -145,17 +2946,24 @@ if __name__ == "__main__":
         help="Client access token for authenticate with the Kubernetes API",
     )
 
-    check_choices = ["health", "nodes"]
     parser.add_argument(
         "--check",
         dest="check",
-        metavar="|".join(check_choices),
+        metavar="|".join(CHECK_CHOICES),
         type=str,
-        choices=check_choices,
-        default=check_choices[0],
+        choices=CHECK_CHOICES,
+        default=CHECK_CHOICES[0],
         help="which check to run",
     )
 
+    parser.add_argument(
+        "--checks",
+        dest="checks",
+        metavar="CHECK,...",
+        type=_check_list,
+        help="run several checks in one process and aggregate their results",
+    )
+
     parser.add_argument(
         "-d",
         "--disable-host-key-check",
@@ -164,18 +2972,496 @@ if __name__ == "__main__":
         action="store_true",
         help="Disables Host SSL Key Authentication",
     )
-    args = parser.parse_args()
 
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=CHECK_TIMEOUT,
+        help="Seconds each check has to complete before reporting UNKNOWN",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=ENGINE_CONCURRENCY,
+        help="Maximum number of API requests in flight at once",
+    )
+
+    profile_modes = [
+        mode.strip()
+        for mode in os.environ.get(PROFILE_ENV, "").split(",")
+        if mode.strip()
+    ]
+    parser.add_argument(
+        "--timings",
+        dest="timings",
+        default="timings" in profile_modes,
+        action="store_true",
+        help="Append the time spent in each phase of the checks to their "
+        "perfdata (also enabled by {}=timings)".format(PROFILE_ENV),
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        choices=PROFILE_MODES,
+        default=next((m for m in profile_modes if m in PROFILE_MODES), None),
+        help="Dump a cProfile or tracemalloc profile of the run to "
+        "--profile-dir (also enabled by {}=cprofile|tracemalloc)".format(PROFILE_ENV),
+    )
+
+    parser.add_argument(
+        "--profile-dir",
+        dest="profile_dir",
+        default=os.path.join(STATE_DIR, "profiles"),
+        help="Directory keeping the last {} profile dumps".format(PROFILE_KEEP),
+    )
+
+    parser.add_argument(
+        "--parse-processes",
+        dest="parse_processes",
+        type=int,
+        default=0,
+        help="Worker processes parsing the pages of the largest lists (the pods of "
+        "the capacity check), 0 to parse them in-process",
+    )
+
+    parser.add_argument(
+        "--output",
+        dest="output",
+        choices=["nagios", "json"],
+        default="nagios",
+        help="Print the result as a Nagios line, truncated to {} bytes, or as "
+        "JSON with the findings, counts, timings and flags".format(NAGIOS_OUTPUT_LIMIT),
+    )
+
+    parser.add_argument(
+        "--output-file",
+        dest="output_file",
+        metavar="PATH",
+        help="Also write the JSON result to a file, replaced atomically",
+    )
+
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument(
+        "--record",
+        dest="record",
+        metavar="ARCHIVE",
+        help="Record the apiserver responses of the run to a zip archive",
+    )
+    archive.add_argument(
+        "--replay",
+        dest="replay",
+        metavar="ARCHIVE",
+        help="Run the checks against the responses recorded in an archive, "
+        "without contacting the apiserver",
+    )
+
+    parser.add_argument(
+        "--health-endpoint",
+        dest="health_endpoint",
+        choices=["readyz", "livez"],
+        default="readyz",
+        help="apiserver health endpoint used by the health check",
+    )
+
+    parser.add_argument(
+        "--health-exclude",
+        dest="health_exclude",
+        type=_comma_list,
+        default=[],
+        help="Comma separated health components ignored by the health check",
+    )
+
+    parser.add_argument(
+        "--state-dir",
+        dest="state_dir",
+        default=STATE_DIR,
+        help="Directory used to keep check state between runs",
+    )
+
+    parser.add_argument(
+        "--events-warn-rate",
+        dest="events_warn_rate",
+        type=float,
+        default=10.0,
+        help="Warning events per minute before alerting Warning",
+    )
+
+    parser.add_argument(
+        "--events-crit-rate",
+        dest="events_crit_rate",
+        type=float,
+        default=50.0,
+        help="Warning events per minute before alerting Critical",
+    )
+
+    parser.add_argument(
+        "--metrics-latency-warn",
+        dest="metrics_latency_warn",
+        type=float,
+        default=1.0,
+        help="apiserver p99 request latency (seconds) before alerting Warning",
+    )
+
+    parser.add_argument(
+        "--metrics-latency-crit",
+        dest="metrics_latency_crit",
+        type=float,
+        default=5.0,
+        help="apiserver p99 request latency (seconds) before alerting Critical",
+    )
+
+    parser.add_argument(
+        "--metrics-etcd-latency-warn",
+        dest="metrics_etcd_latency_warn",
+        type=float,
+        default=0.5,
+        help="etcd p99 request latency (seconds) before alerting Warning",
+    )
+
+    parser.add_argument(
+        "--metrics-etcd-latency-crit",
+        dest="metrics_etcd_latency_crit",
+        type=float,
+        default=2.0,
+        help="etcd p99 request latency (seconds) before alerting Critical",
+    )
+
+    parser.add_argument(
+        "--utilisation-warn",
+        dest="utilisation_warn",
+        type=int,
+        default=85,
+        help="Node cpu or memory utilisation (percent) before alerting Warning",
+    )
+
+    parser.add_argument(
+        "--utilisation-crit",
+        dest="utilisation_crit",
+        type=int,
+        default=95,
+        help="Node cpu or memory utilisation (percent) before alerting Critical",
+    )
+
+    parser.add_argument(
+        "--services-namespaces",
+        dest="services_namespaces",
+        type=_comma_list,
+        default=[],
+        help="Comma separated namespaces whose Services are checked, "
+        "all of them when empty",
+    )
+
+    parser.add_argument(
+        "--services-exclude-namespaces",
+        dest="services_exclude_namespaces",
+        type=_comma_list,
+        default=[],
+        help="Comma separated namespaces whose Services are not checked",
+    )
+
+    parser.add_argument(
+        "--services-critical",
+        dest="services_critical",
+        type=_comma_list,
+        default=[],
+        help="Comma separated <namespace>/<name> of the Services alerting "
+        "Critical without ready endpoints, any other one alerts Warning",
+    )
+
+    parser.add_argument(
+        "--quotas-warn",
+        dest="quotas_warn",
+        type=int,
+        default=80,
+        help="ResourceQuota usage (percent of hard) before alerting Warning",
+    )
+
+    parser.add_argument(
+        "--quotas-crit",
+        dest="quotas_crit",
+        type=int,
+        default=95,
+        help="ResourceQuota usage (percent of hard) before alerting Critical",
+    )
+
+    parser.add_argument(
+        "--quotas-top",
+        dest="quotas_top",
+        type=int,
+        default=5,
+        help="Number of most saturated quotas reported",
+    )
+
+    parser.add_argument(
+        "--capacity-warn",
+        dest="capacity_warn",
+        type=int,
+        default=85,
+        help="Requested cpu or memory (percent of allocatable) before alerting "
+        "Warning",
+    )
+
+    parser.add_argument(
+        "--capacity-crit",
+        dest="capacity_crit",
+        type=int,
+        default=95,
+        help="Requested cpu or memory (percent of allocatable) before alerting "
+        "Critical",
+    )
+
+    parser.add_argument(
+        "--capacity-top",
+        dest="capacity_top",
+        type=int,
+        default=3,
+        help="Number of nodes above the Warning threshold reported",
+    )
+
+    parser.add_argument(
+        "--leases-warn",
+        dest="leases_warn",
+        type=int,
+        default=20,
+        help="Seconds since a node Lease was renewed before alerting Warning",
+    )
+
+    parser.add_argument(
+        "--leases-crit",
+        dest="leases_crit",
+        type=int,
+        default=40,
+        help="Seconds since a node Lease was renewed before alerting Critical",
+    )
+
+    parser.add_argument(
+        "--skew-max-minor",
+        dest="skew_max_minor",
+        type=int,
+        default=SKEW_MAX_MINOR,
+        help="Minor versions a kubelet may be older than the apiserver",
+    )
+
+    parser.add_argument(
+        "--certificates-namespaces",
+        dest="certificates_namespaces",
+        type=_comma_list,
+        default=CERTIFICATES_NAMESPACES,
+        help="Comma separated namespaces whose TLS Secrets are checked for expiry",
+    )
+
+    parser.add_argument(
+        "--certificates-csr-age",
+        dest="certificates_csr_age",
+        type=int,
+        default=CSR_PENDING_AGE,
+        help="Seconds a CertificateSigningRequest may stay pending before alerting "
+        "Warning",
+    )
+
+    parser.add_argument(
+        "--tls-warn-days",
+        dest="tls_warn_days",
+        type=int,
+        default=60,
+        help="Days left before a TLS Secret certificate expiry alerts Warning",
+    )
+
+    parser.add_argument(
+        "--tls-crit-days",
+        dest="tls_crit_days",
+        type=int,
+        default=30,
+        help="Days left before a TLS Secret certificate expiry alerts Critical",
+    )
+
+    parser.add_argument(
+        "--storage-pending-age",
+        dest="storage_pending_age",
+        type=int,
+        default=STORAGE_PENDING_AGE,
+        help="Seconds a PersistentVolumeClaim may stay Pending before alerting",
+    )
+
+    parser.add_argument(
+        "--nodes-listed",
+        dest="nodes_listed",
+        type=int,
+        default=NODES_LISTED,
+        help="Number of NotReady nodes listed by name, beyond which they are "
+        "counted by role, zone and --nodes-group-label",
+    )
+
+    parser.add_argument(
+        "--nodes-group-label",
+        dest="nodes_group_label",
+        help="Node label (e.g. a rack label) NotReady nodes are also counted by",
+    )
+
+    parser.add_argument(
+        "--utilisation-top",
+        dest="utilisation_top",
+        type=int,
+        default=3,
+        help="Number of most utilised nodes reported",
+    )
+    return parser
+
+
+def run_check(args):
+    """Run the check selected by the parsed command line arguments.
+
+    :param args: argparse.Namespace built by build_parser()
+    :returns: CheckResult
+    """
+    name = "checks" if args.checks else args.check
+    with contextlib.ExitStack() as stack:
+        if args.profile == "tracemalloc":
+            stack.enter_context(traced(args.profile_dir, name))
+        engine = stack.enter_context(
+            CheckEngine(
+                args.disable_host_key_check,
+                args.concurrency,
+                args.timeout,
+                timings=args.timings,
+                profile_dir=args.profile_dir if args.profile == "cprofile" else None,
+                record=args.record,
+                replay=args.replay,
+                processes=args.parse_processes,
+            )
+        )
+        if args.checks:
+            return run_checks(args, engine)
+        return engine.run_checks({name: check_function(args, engine)})[name]
+
+
+def check_function(args, engine):
+    """Get the check selected by --check, bound to its arguments and engine.
+
+    :param args: argparse.Namespace built by build_parser()
+    :param engine: CheckEngine the check is run by
+    :returns: function taking no argument and returning (status, message)
+    """
     checks = {
         "health": check_kubernetes_health,
         "nodes": check_kubernetes_nodes,
+        "workloads": check_kubernetes_workloads,
+        "events": check_kubernetes_events,
+        "metrics": check_kubernetes_metrics,
+        "utilisation": check_kubernetes_utilisation,
+        "services": check_kubernetes_services,
+        "storage": check_kubernetes_storage,
+        "quotas": check_kubernetes_quotas,
+        "capacity": check_kubernetes_capacity,
+        "leases": check_kubernetes_leases,
+        "skew": check_kubernetes_skew,
+        "certificates": check_kubernetes_certificates,
+    }
+    check_kwargs = {
+        "health": {
+            "endpoint": args.health_endpoint,
+            "exclude": args.health_exclude,
+        },
+        "events": {
+            "state_dir": args.state_dir,
+            "warn_rate": args.events_warn_rate,
+            "crit_rate": args.events_crit_rate,
+        },
+        "metrics": {
+            "state_dir": args.state_dir,
+            "latency_warn": args.metrics_latency_warn,
+            "latency_crit": args.metrics_latency_crit,
+            "etcd_latency_warn": args.metrics_etcd_latency_warn,
+            "etcd_latency_crit": args.metrics_etcd_latency_crit,
+        },
+        "utilisation": {
+            "warn": args.utilisation_warn,
+            "crit": args.utilisation_crit,
+            "top": args.utilisation_top,
+        },
+        "workloads": {"listed": args.nodes_listed},
+        "nodes": {
+            "state_dir": args.state_dir,
+            "listed": args.nodes_listed,
+            "group_label": args.nodes_group_label,
+        },
+        "services": {
+            "namespaces": args.services_namespaces,
+            "exclude_namespaces": args.services_exclude_namespaces,
+            "critical": args.services_critical,
+        },
+        "storage": {"pending_age": args.storage_pending_age},
+        "quotas": {
+            "warn": args.quotas_warn,
+            "crit": args.quotas_crit,
+            "top": args.quotas_top,
+        },
+        "capacity": {
+            "warn": args.capacity_warn,
+            "crit": args.capacity_crit,
+            "top": args.capacity_top,
+        },
+        "leases": {
+            "warn": args.leases_warn,
+            "crit": args.leases_crit,
+            "listed": args.nodes_listed,
+        },
+        "skew": {
+            "state_dir": args.state_dir,
+            "max_minor": args.skew_max_minor,
+            "listed": args.nodes_listed,
+        },
+        "certificates": {
+            "state_dir": args.state_dir,
+            "namespaces": args.certificates_namespaces,
+            "csr_age": args.certificates_csr_age,
+            "warn_days": args.tls_warn_days,
+            "crit_days": args.tls_crit_days,
+            "listed": args.nodes_listed,
+        },
     }
 
     k8s_url = "https://{}:{}".format(args.host, args.port)
-    nagios_exit(
-        *checks[args.check](k8s_url, args.client_token, args.disable_host_key_check)
+    return functools.partial(
+        checks[args.check],
+        k8s_url,
+        args.client_token,
+        args.disable_host_key_check,
+        engine=engine,
+        **check_kwargs.get(args.check, {}),
     )
 
+
+def output_result(args, result):
+    """Print the result of a run in the selected format and exit with its status.
+
+    :param args: argparse.Namespace built by build_parser()
+    :param result: CheckResult returned by run_check()
+    """
+    check = "checks" if args.checks else args.check
+    if args.output_file:
+        save_result(args.output_file, result, check)
+    if args.output == "json":
+        print(json.dumps(CheckResult.of(result).as_dict(check)))
+        sys.exit(result[0])
+    else:
+        nagios_exit(*result)
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    try:
+        output_result(args, run_check(args))
+    except SystemExit as e:
+        # an expired check may still be waiting on a request, on a worker
+        # thread that would hold the interpreter until the request times out
+        sys.stdout.flush()
+        os._exit(e.code or 0)
+
 """
 TODO: Future Checks
 
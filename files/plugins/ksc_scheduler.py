@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+"""Scheduler running the Kubernetes API checks of every related cluster.
+
+A single long running process runs the checks of all the clusters in one
+interpreter and saves their results, which the NRPE checks then read with
+`ksc_scheduler.py --config <file> --result <check name>`. In passive mode the
+results are also pushed to Nagios, in batches, by a submitter.
+
+With a ceiling above the interval, the polling is adaptive: the expensive list
+checks back off, doubling their interval up to the ceiling while their status
+is stable, and every check of a cluster is brought back to the floor interval
+as soon as a status changes or its health check fails.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import check_kubernetes_api
+from check_kubernetes_api import (
+    NAGIOS_STATUS_OK,
+    NAGIOS_STATUS_UNKNOWN,
+    load_state,
+    nagios_exit,
+    save_state,
+    worst_status,
+)
+
+import urllib3
+
+SCHEDULER_CONFIG = "/etc/kubernetes-service-checks/scheduler.json"
+
+# seconds results are held before a partial batch is submitted
+SUBMIT_INTERVAL = 10
+# results kept for a later attempt when submitting fails
+MAX_PENDING_RESULTS = 1000
+
+
+class SpoolSubmitter:
+    """Write passive results as Nagios external commands to a spool directory.
+
+    Each batch is written to its own file, which Nagios (or a local test)
+    can then process with PROCESS_SERVICE_CHECK_RESULT. Files left unread
+    for longer than max_age seconds are pruned, their results being stale.
+    """
+
+    def __init__(self, target, max_age=None, **kwargs):
+        """Initialize the submitter with the spool directory."""
+        self.spool_dir = target
+        self.max_age = max_age
+
+    def submit(self, hostname, results):
+        """Write a batch of results to a new spool file."""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(
+            self.spool_dir, "{:.6f}-{}.cmd".format(time.time(), os.getpid())
+        )
+        with open(path + ".tmp", "w") as f:
+            for result in results:
+                f.write(
+                    "[{:.0f}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}\n".format(
+                        result["timestamp"],
+                        hostname,
+                        result["service"],
+                        result["status"],
+                        _single_line(result["message"]),
+                    )
+                )
+        os.replace(path + ".tmp", path)
+        self.prune()
+
+    def prune(self):
+        """Remove the spool files older than max_age."""
+        if not self.max_age:
+            return
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except FileNotFoundError:
+                # processed by nagios meanwhile
+                pass
+
+
+class NRDPSubmitter:
+    """Submit passive results to a Nagios Remote Data Processor (NRDP)."""
+
+    def __init__(self, target, token="", **kwargs):
+        """Initialize the submitter with the NRDP URL and token."""
+        self.url = target
+        self.token = token
+        self.http = urllib3.PoolManager()
+
+    def submit(self, hostname, results):
+        """Post a batch of results in one NRDP submitcheck request."""
+        checkresults = [
+            {
+                "checkresult": {"type": "service", "checktype": "1"},
+                "hostname": hostname,
+                "servicename": result["service"],
+                "state": str(result["status"]),
+                "output": result["message"],
+            }
+            for result in results
+        ]
+        resp = self.http.request(
+            "POST",
+            self.url,
+            fields={
+                "token": self.token,
+                "cmd": "submitcheck",
+                "json": json.dumps({"checkresults": checkresults}),
+            },
+            encode_multipart=False,
+        )
+        if resp.status != 200:
+            raise IOError("NRDP submission failed ({})".format(resp.status))
+
+
+class NSCASubmitter:
+    """Submit passive results with send_nsca, one process per batch."""
+
+    def __init__(self, target, send_nsca="/usr/sbin/send_nsca", **kwargs):
+        """Initialize the submitter with the NSCA server address."""
+        self.command = [send_nsca, "-H", target, "-c", "/etc/send_nsca.cfg"]
+
+    def submit(self, hostname, results):
+        """Feed a batch of results to send_nsca."""
+        data = "".join(
+            "{}\t{}\t{}\t{}\n".format(
+                hostname,
+                result["service"],
+                result["status"],
+                _single_line(result["message"]),
+            )
+            for result in results
+        )
+        subprocess.run(self.command, input=data.encode(), check=True)
+
+
+SUBMITTERS = {
+    "spool": SpoolSubmitter,
+    "nrdp": NRDPSubmitter,
+    "nsca": NSCASubmitter,
+}
+
+
+def _single_line(message):
+    """Escape the line breaks of a multi-line plugin output."""
+    return message.replace("\n", "\\n")
+
+
+def make_submitter(config):
+    """Build the passive results submitter from its configuration.
+
+    :param config: {"type": "spool|nrdp|nsca", "target": ..., ...} or None
+    :returns: submitter, or None when results are not pushed
+    """
+    if not config:
+        return None
+    config = dict(config)
+    return SUBMITTERS[config.pop("type")](**config)
+
+
+def load_config(path):
+    """Load the scheduler configuration written by the charm.
+
+    :param path: Path to the JSON configuration file
+    :returns: dict with 'interval', 'concurrency', 'results_dir' and 'jobs',
+              each job being {"name": <nrpe check name>, "argv": [<plugin args>]},
+              and optionally the 'min_interval' and 'max_interval' bounds of
+              the adaptive polling
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def job_offset(name, interval):
+    """Get the deterministic offset of a job within the polling interval.
+
+    Spreading the jobs over the interval avoids every cluster being polled
+    in the same synchronised burst.
+    """
+    return zlib.crc32(name.encode()) % interval
+
+
+def run_job(job, results_dir):
+    """Run a check, or a group of checks, in-process and save their results.
+
+    The checks of a group run in one engine, sharing the resources they
+    list (e.g. the node list), and each of their results is saved apart.
+
+    :param job: {"name": <nrpe check name>, "argv": [<plugin args>],
+                 "service": <nagios service description, in passive mode>},
+                with "checks": {<check>: {"name": ..., "service": ...}}
+                listing the checks of a group run with --checks
+    :param results_dir: Directory holding the latest result of every check
+    :returns: list of dict, the saved results
+    """
+    members = job.get("checks") or {None: job}
+    try:
+        args = check_kubernetes_api.build_parser().parse_args(job["argv"])
+        result = check_kubernetes_api.run_check(args)
+        outcomes = result.checks if job.get("checks") else {None: result}
+    except (Exception, SystemExit) as e:
+        logging.exception("Check {} failed".format(job["name"]))
+        failure = (NAGIOS_STATUS_UNKNOWN, "Check failed: {}".format(e))
+        outcomes = dict.fromkeys(members, failure)
+    results = []
+    for check, member in members.items():
+        status, message = outcomes[check]
+        result = {"status": status, "message": str(message), "timestamp": time.time()}
+        save_state(results_dir, member["name"], result)
+        results.append(dict(result, service=member.get("service", member["name"])))
+    return results
+
+
+class Scheduler:
+    """Run the configured jobs every interval with bounded concurrency."""
+
+    def __init__(self, config, clock=time.time, submitter=None):
+        """Initialize the schedule of every job from the configuration."""
+        self.interval = config["interval"]
+        # bounds of the adaptive polling, none when they equal the interval
+        self.min_interval = min(
+            config.get("min_interval") or self.interval, self.interval
+        )
+        self.max_interval = max(config.get("max_interval") or 0, self.interval)
+        self.hostname = config.get("hostname")
+        self.submitter = submitter or make_submitter(config.get("submitter"))
+        self.batch_size = config.get("batch_size", 50)
+        self.pending = []
+        self.results_dir = config["results_dir"]
+        self.jobs = {job["name"]: job for job in config["jobs"]}
+        self.executor = ThreadPoolExecutor(max_workers=config["concurrency"])
+        self.clock = clock
+        self.running = {}
+        start = clock()
+        self.last_submit = start
+        self.next_run = {
+            name: start + job_offset(name, self.interval) for name in self.jobs
+        }
+        self.intervals = dict.fromkeys(self.jobs, self.interval)
+        self.last_status = {}
+
+    def tick(self):
+        """Submit the jobs that are due and not still running.
+
+        :returns: seconds until the next job is due
+        """
+        now = self.clock()
+        self.collect(now)
+        if self.pending and (
+            len(self.pending) >= self.batch_size
+            or now - self.last_submit >= SUBMIT_INTERVAL
+        ):
+            self.submit(now)
+        for name, due in self.next_run.items():
+            future = self.running.get(name)
+            if due > now or (future and not future.done()):
+                continue
+            self.running[name] = self.executor.submit(
+                run_job, self.jobs[name], self.results_dir
+            )
+            # keep the job on its slot of the interval, even if late
+            while self.next_run[name] <= now:
+                self.next_run[name] += self.intervals[name]
+        return max(min(self.next_run.values(), default=now + 1) - now, 0)
+
+    def collect(self, now):
+        """Adapt the intervals to the finished jobs and queue their results."""
+        for name, future in list(self.running.items()):
+            if future.done():
+                del self.running[name]
+                results = future.result()
+                self.adapt(
+                    name, worst_status(result["status"] for result in results), now
+                )
+                if self.submitter:
+                    self.pending.extend(results)
+
+    def adapt(self, name, status, now):
+        """Back a job off while its status is stable, or tighten on a change.
+
+        :param name: Name of the finished job
+        :param status: Nagios status of its result
+        :param now: Current time, to bring the tightened jobs forward
+        """
+        job = self.jobs[name]
+        previous = self.last_status.get(name, status)
+        self.last_status[name] = status
+        if job.get("check") == "health" and status != NAGIOS_STATUS_OK:
+            # the cluster is in trouble, watch all of its checks closely
+            for other, other_job in self.jobs.items():
+                if other_job.get("cluster") == job.get("cluster"):
+                    self.tighten(other, now)
+        elif status != previous or status != NAGIOS_STATUS_OK:
+            self.tighten(name, now)
+        elif job.get("backoff"):
+            self.intervals[name] = min(2 * self.intervals[name], self.max_interval)
+        else:
+            # stable again, back to the configured interval
+            self.intervals[name] = self.interval
+
+    def tighten(self, name, now):
+        """Bring a job back to the floor interval, with adaptive polling only."""
+        if self.max_interval <= self.interval:
+            return
+        self.intervals[name] = self.min_interval
+        self.next_run[name] = min(self.next_run[name], now + self.min_interval)
+
+    def submit(self, now):
+        """Submit the queued results as one batch, keeping them on failure."""
+        self.last_submit = now
+        try:
+            self.submitter.submit(self.hostname, self.pending)
+        except Exception:
+            logging.exception("Failed to submit {} results".format(len(self.pending)))
+            del self.pending[:-MAX_PENDING_RESULTS]
+            return
+        self.pending = []
+
+    def run_forever(self):
+        """Run the jobs until the process is stopped."""
+        while True:
+            time.sleep(min(self.tick(), 1))
+
+
+def read_result(config, name):
+    """Get the Nagios status and message of a check saved by the scheduler.
+
+    Results older than two intervals, or two ceiling intervals with adaptive
+    polling, are reported as UNKNOWN, as the scheduler is then no longer
+    running the check.
+    """
+    result = load_state(config["results_dir"], name)
+    if not result:
+        return NAGIOS_STATUS_UNKNOWN, "No result yet for {}".format(name)
+    age = time.time() - result["timestamp"]
+    if age > 2 * max(config["interval"], config.get("max_interval", 0)):
+        return NAGIOS_STATUS_UNKNOWN, "Stale result ({:.0f}s old): {}".format(
+            age, result["message"]
+        )
+    return result["status"], result["message"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Schedule the Kubernetes API checks of every cluster",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--config",
+        dest="config",
+        default=SCHEDULER_CONFIG,
+        help="Path to the scheduler configuration",
+    )
+    parser.add_argument(
+        "--result",
+        dest="result",
+        metavar="CHECK",
+        help="Print the latest result of a check, in Nagios format, and exit",
+    )
+    args = parser.parse_args()
+
+    if args.result:
+        nagios_exit(*read_result(load_config(args.config), args.result))
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    Scheduler(load_config(args.config)).run_forever()
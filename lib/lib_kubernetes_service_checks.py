@@ -1,8 +1,12 @@
 """Kubernetes Service Checks Helper Library."""
 import base64
+import collections
+import functools
+import glob
 import json
 import logging
 import os
+import shlex
 import subprocess
 
 from charmhelpers.contrib.charmsupport.nrpe import NRPE
@@ -11,6 +15,184 @@ from charmhelpers.fetch import snap
 
 CERT_FILE = "/usr/local/share/ca-certificates/kubernetes-service-checks.crt"
 NAGIOS_PLUGINS_DIR = "/usr/local/lib/nagios/plugins/"
+PLUGIN_STATE_DIR = "/var/lib/nagios/kubernetes-service-checks"
+SCHEDULER_CONFIG = "/etc/kubernetes-service-checks/scheduler.json"
+SCHEDULER_SERVICE = "ksc-scheduler"
+SCHEDULER_UNIT_FILE = "/etc/systemd/system/ksc-scheduler.service"
+SCHEDULER_UNIT = """[Unit]
+Description=Kubernetes Service Checks scheduler
+After=network-online.target
+
+[Service]
+User=nagios
+ExecStart=/usr/bin/python3 {plugin} --config {config}
+Restart=always
+RestartSec=10
+
+[Install]
+WantedBy=multi-user.target
+"""
+NAGIOS_EXPORT_DIR = "/var/lib/nagios/export"
+PASSIVE_SERVICE_FILE = "service__{hostname}_passive_{shortname}.cfg"
+PASSIVE_SERVICE = """
+#---------------------------------------------------
+# This file is Juju managed
+#---------------------------------------------------
+define service {{
+    use                             active-service
+    host_name                       {hostname}
+    service_description             {description}
+    check_command                   check_dummy!3!"No passive result received"
+    servicegroups                   {servicegroups}
+    active_checks_enabled           0
+    passive_checks_enabled          1
+    check_freshness                 1
+    freshness_threshold             {freshness_threshold}
+}}
+"""
+
+# checks of check_kubernetes_api.py registered as k8s_api_<check>
+PLUGIN_CHECKS = [
+    "health",
+    "nodes",
+    "workloads",
+    "events",
+    "metrics",
+    "utilisation",
+    "services",
+    "storage",
+    "quotas",
+    "capacity",
+    "leases",
+    "skew",
+    "certificates",
+]
+
+# list checks the scheduler backs off while their status is stable
+BACKOFF_CHECKS = [
+    "nodes",
+    "workloads",
+    "utilisation",
+    "services",
+    "storage",
+    "quotas",
+    "capacity",
+    "skew",
+    "certificates",
+]
+
+# checks the scheduler runs in one job per cluster, sharing the node list
+NODE_CHECKS = ["nodes", "utilisation", "capacity", "skew"]
+
+# checks registered as k8s_api_<check>, shared between the units
+ALL_CHECKS = PLUGIN_CHECKS + ["cert_expiration"]
+
+# charm config options passed to check_kubernetes_api.py as --<option-name>
+CHECK_CONFIG_OPTIONS = {
+    "health": ["health_exclude"],
+    "nodes": ["nodes_group_label"],
+    "events": ["events_warn_rate", "events_crit_rate"],
+    "metrics": [
+        "metrics_latency_warn",
+        "metrics_latency_crit",
+        "metrics_etcd_latency_warn",
+        "metrics_etcd_latency_crit",
+    ],
+    "utilisation": ["utilisation_warn", "utilisation_crit", "utilisation_top"],
+    "services": [
+        "services_namespaces",
+        "services_exclude_namespaces",
+        "services_critical",
+    ],
+    "storage": ["storage_pending_age"],
+    "quotas": ["quotas_warn", "quotas_crit", "quotas_top"],
+    "capacity": ["capacity_warn", "capacity_crit", "parse_processes"],
+    "leases": ["leases_warn", "leases_crit"],
+    "skew": ["skew_max_minor"],
+    "certificates": [
+        "certificates_namespaces",
+        "certificates_csr_age",
+        "tls_warn_days",
+        "tls_crit_days",
+    ],
+}
+
+
+Cluster = collections.namedtuple("Cluster", ["name", "address", "port", "token"])
+
+
+@functools.lru_cache(maxsize=32)
+def parse_client_token(creds):
+    """Get the first client token found in the kube-control credentials.
+
+    Memoised on the raw credentials, which only change with the relation
+    data, as they hold the tokens of every user of the cluster.
+
+    :param creds: JSON encoded credentials, keyed by user
+    """
+    try:
+        data = json.loads(creds or "{}")
+    except json.decoder.JSONDecodeError:
+        data = {}
+    for user_creds in data.values():
+        token = user_creds.get("client_token", None)
+        if token:
+            return token
+    return None
+
+
+def parse_cluster_endpoints(pairs):
+    """Get the kube-control application paired with each kube-api-endpoint one.
+
+    :param pairs: space separated <kube-api-endpoint app>:<kube-control app>
+    :returns: dict of kube-api-endpoint application to kube-control application
+    """
+    return dict(pair.split(":", 1) for pair in (pairs or "").split() if ":" in pair)
+
+
+def parse_enabled_checks(checks):
+    """Get the enabled checks and the unknown check names of the config.
+
+    :param checks: space or comma separated check names
+    :returns: (list of the enabled checks, in ALL_CHECKS order,
+               sorted list of the unknown check names)
+    """
+    names = set((checks or "").replace(",", " ").split())
+    return (
+        [check for check in ALL_CHECKS if check in names],
+        sorted(names.difference(ALL_CHECKS)),
+    )
+
+
+def check_shortname(cluster, check):
+    """Get the nrpe check name of a check of a cluster."""
+    if not cluster.name:
+        return "k8s_api_{}".format(check)
+    return "k8s_api_{}_{}".format(cluster.name, check)
+
+
+def check_description(cluster, check):
+    """Get the nagios description of a check of a cluster."""
+    return "Check Kubernetes API {}({})".format(
+        "{} ".format(cluster.name) if cluster.name else "", check
+    )
+
+
+def assign_checks(checks, units):
+    """Deterministically spread the checks over the units of the application.
+
+    Checks are dealt round-robin to the units sorted by unit number, so the
+    assignment only depends on which units are present.
+
+    :param checks: list of check names
+    :param units: list of unit names, e.g. ["kubernetes-service-checks/0"]
+    :returns: dict of unit name to the list of its checks
+    """
+    units = sorted(units, key=lambda unit: int(unit.rsplit("/", 1)[-1]))
+    assignments = {unit: [] for unit in units}
+    for i, check in enumerate(checks):
+        assignments[units[i % len(units)]].append(check)
+    return assignments
 
 
 class KSCHelper:
@@ -20,29 +202,103 @@ class KSCHelper:
         """Initialize the Helper with the charm config and state."""
         self.config = config
         self.state = state
+        self._related_clusters = None
+        self._checks_config = None
+
+    def invalidate(self):
+        """Forget the relation model, after the relation state has changed."""
+        self._related_clusters = None
+
+    def invalidate_config(self):
+        """Forget the parsed config, after the config has changed."""
+        self._checks_config = None
+
+    @property
+    def related_clusters(self):
+        """Get the relation model: the endpoint and token of every cluster.
+
+        Built from the stored relation data once, then reused until
+        invalidate() is called. The first related cluster, named "", is
+        always included, even when its relations are incomplete.
+
+        :returns: list of Cluster
+        """
+        if self._related_clusters is None:
+            clusters = [
+                Cluster(
+                    "",
+                    self.state.kube_api_endpoint.get("hostname", None),
+                    self.state.kube_api_endpoint.get("port", None),
+                    parse_client_token(self.state.kube_control.get("creds", "{}")),
+                )
+            ]
+            for name, relations in sorted(self.state.clusters.items()):
+                endpoint = relations.get("kube_api_endpoint", {})
+                clusters.append(
+                    Cluster(
+                        name,
+                        endpoint.get("hostname"),
+                        endpoint.get("port"),
+                        parse_client_token(
+                            relations.get("kube_control", {}).get("creds")
+                        ),
+                    )
+                )
+            self._related_clusters = clusters
+        return self._related_clusters
 
     @property
     def kubernetes_api_address(self):
         """Get kubernetes api hostname."""
-        return self.state.kube_api_endpoint.get("hostname", None)
+        return self.related_clusters[0].address
 
     @property
     def kubernetes_api_port(self):
         """Get kubernetes api port."""
-        return self.state.kube_api_endpoint.get("port", None)
+        return self.related_clusters[0].port
 
     @property
     def kubernetes_client_token(self):
         """Get kubernetes client token."""
-        try:
-            data = json.loads(self.state.kube_control.get("creds", "{}"))
-        except json.decoder.JSONDecodeError:
-            data = {}
-        for creds in data.values():
-            token = creds.get("client_token", None)
-            if token:
-                return token
-        return None
+        return self.related_clusters[0].token
+
+    @property
+    def clusters(self):
+        """Get the related clusters with a complete endpoint and credentials.
+
+        The first related cluster keeps the k8s_api_<check> check names, the
+        other ones are named after their remote application.
+        """
+        return [cluster for cluster in self.related_clusters if all(cluster[1:])]
+
+    @property
+    def _parsed_checks(self):
+        # parsed once, then reused until invalidate_config() is called
+        if self._checks_config is None:
+            self._checks_config = parse_enabled_checks(
+                self.config.get("enabled_checks")
+            )
+        return self._checks_config
+
+    @property
+    def enabled_checks(self):
+        """Get the checks enabled in the charm config, in ALL_CHECKS order."""
+        return self._parsed_checks[0]
+
+    @property
+    def unknown_checks(self):
+        """Get the unknown check names of the enabled_checks config."""
+        return self._parsed_checks[1]
+
+    @property
+    def scheduled(self):
+        """Check if the checks are run by the scheduler rather than by NRPE."""
+        return self.config.get("check_mode") in ("scheduled", "passive")
+
+    @property
+    def passive(self):
+        """Check if the scheduler pushes the results as passive checks."""
+        return self.config.get("check_mode") == "passive"
 
     @property
     def use_tls_cert(self):
@@ -95,6 +351,7 @@ class KSCHelper:
     def configure(self):
         """Refresh configuration data."""
         self.update_plugins()
+        self.render_scheduler()
         self.render_checks()
 
     def update_plugins(self):
@@ -102,47 +359,296 @@ class KSCHelper:
         charm_plugin_dir = os.path.join(hookenv.charm_dir(), "files", "plugins/")
         host.rsync(charm_plugin_dir, self.plugins_dir, options=["--executability"])
 
-    def render_checks(self):
-        """Render nrpe checks."""
-        nrpe = NRPE()
-        if not os.path.exists(self.plugins_dir):
-            os.makedirs(self.plugins_dir)
+    def check_options(self, check):
+        """Get the plugin arguments built from the charm config for a check.
+
+        Options left empty in the config are not passed to the plugin, the
+        others are quoted for the shell running the nrpe command.
+        """
+        return "".join(
+            " --{} {}".format(
+                option.replace("_", "-"), shlex.quote(str(self.config.get(option)))
+            )
+            for option in CHECK_CONFIG_OPTIONS.get(check, [])
+            if self.config.get(option) not in (None, "")
+        )
+
+    @property
+    def assigned_checks(self):
+        """Get the checks assigned to this unit, None when checks aren't sharded."""
+        return self.state.assigned_checks
+
+    def is_assigned(self, check):
+        """Check if a check is enabled and run by this unit."""
+        if check == "all":
+            # the aggregated check only runs the checks assigned to this unit
+            return True
+        if check not in self.enabled_checks:
+            return False
+        return self.assigned_checks is None or check in self.assigned_checks
+
+    def plugin_arguments(self, cluster, checks):
+        """Get the check_kubernetes_api.py arguments running checks of a cluster.
+
+        A single check is selected with --check, several checks are run in
+        one process and aggregated with --checks.
+        """
+        arguments = "-H {} -P {} -T {} {} {}".format(
+            shlex.quote(cluster.address),
+            shlex.quote(cluster.port),
+            shlex.quote(cluster.token),
+            "--check" if len(checks) == 1 else "--checks",
+            ",".join(checks),
+        )
+        arguments += "".join(self.check_options(check) for check in checks)
+        if cluster.name:
+            # keep the state of each cluster apart
+            arguments += " --state-dir {}".format(
+                shlex.quote(os.path.join(PLUGIN_STATE_DIR, cluster.name))
+            )
+        if not self.use_tls_cert:
+            arguments += " -d"
+        return arguments
 
-        # register basic api health check and nodes readiness status
+    def check_commands(self, cluster):
+        """Get the nrpe check commands of a cluster, keyed by check name."""
+        commands = {}
+        # basic api health check, nodes readiness, workload rollouts, warning
+        # events rate, apiserver latency metrics and nodes utilisation
         check_k8s_plugin = os.path.join(self.plugins_dir, "check_kubernetes_api.py")
-        for check in ["health", "nodes"]:
-            check_command = "{} -H {} -P {} -T {} --check {}".format(
-                check_k8s_plugin,
-                self.kubernetes_api_address,
-                self.kubernetes_api_port,
-                self.kubernetes_client_token,
-                check,
-            ).strip()
-            if not self.use_tls_cert:
-                check_command += " -d"
-
-            nrpe.add_check(
-                shortname="k8s_api_{}".format(check),
-                description="Check Kubernetes API ({})".format(check),
-                check_cmd=check_command,
+        scheduler_plugin = os.path.join(self.plugins_dir, "ksc_scheduler.py")
+        for check in PLUGIN_CHECKS:
+            if self.scheduled:
+                # report the latest result saved by the scheduler
+                commands[check] = "{} --config {} --result {}".format(
+                    scheduler_plugin, SCHEDULER_CONFIG, check_shortname(cluster, check)
+                )
+            else:
+                commands[check] = "{} {}".format(
+                    check_k8s_plugin, self.plugin_arguments(cluster, [check])
+                )
+
+        # all the checks of this unit in a single nrpe command
+        aggregated = [check for check in PLUGIN_CHECKS if self.is_assigned(check)]
+        if self.config.get("aggregate_check") and aggregated and not self.scheduled:
+            commands["all"] = "{} {}".format(
+                check_k8s_plugin, self.plugin_arguments(cluster, aggregated)
             )
 
-        # register k8s host certificate expiration check
+        # k8s host certificate expiration check
         check_http_plugin = "/usr/lib/nagios/plugins/check_http"
-        check_command = "{} -I {} -p {} -C {},{}".format(
+        commands["cert_expiration"] = "{} -I {} -p {} -C {}".format(
             check_http_plugin,
-            self.kubernetes_api_address,
-            self.kubernetes_api_port,
-            self.config.get("tls_warn_days"),
-            self.config.get("tls_crit_days"),
+            shlex.quote(cluster.address),
+            shlex.quote(cluster.port),
+            shlex.quote(
+                "{},{}".format(
+                    self.config.get("tls_warn_days"), self.config.get("tls_crit_days")
+                )
+            ),
         ).strip()
-        nrpe.add_check(
-            shortname="k8s_api_cert_expiration",
-            description="Check Kubernetes API ({})".format(check),
-            check_cmd=check_command,
+        return commands
+
+    def scheduler_jobs(self, hostname=None):
+        """Get the checks of every cluster run by the scheduler on this unit.
+
+        The node checks of a cluster are run as one job, listing the nodes
+        once for all of them.
+
+        :param hostname: nagios host name of the unit, to name the passive
+                         service each result is pushed to
+        """
+
+        def member(cluster, check):
+            return {
+                "name": check_shortname(cluster, check),
+                "service": "{}[{}] {}".format(
+                    hostname,
+                    check_shortname(cluster, check),
+                    check_description(cluster, check),
+                ),
+            }
+
+        jobs = []
+        for cluster in self.clusters:
+            checks = [check for check in PLUGIN_CHECKS if self.is_assigned(check)]
+            grouped = [check for check in checks if check in NODE_CHECKS]
+            for check in checks:
+                group = grouped if check in grouped and len(grouped) > 1 else [check]
+                if check != group[0]:
+                    continue
+                job = dict(
+                    member(cluster, check),
+                    argv=shlex.split(self.plugin_arguments(cluster, group)),
+                    cluster=cluster.name,
+                    check=check,
+                    backoff=any(check in BACKOFF_CHECKS for check in group),
+                )
+                if len(group) > 1:
+                    job["checks"] = {check: member(cluster, check) for check in group}
+                jobs.append(job)
+        return jobs
+
+    @property
+    def scheduler_max_interval(self):
+        """Get the longest interval between two runs of a scheduled check."""
+        return max(
+            self.config.get("scheduler_interval"),
+            self.config.get("scheduler_max_interval"),
         )
+
+    @property
+    def passive_submitter(self):
+        """Get the scheduler configuration of the passive results submitter."""
+        return {
+            "type": self.config.get("passive_submitter"),
+            "target": self.config.get("passive_target"),
+            "token": self.config.get("passive_token"),
+            # a spooled result is stale once nagios reports the service stale
+            "max_age": 2 * self.scheduler_max_interval,
+        }
+
+    def render_scheduler(self):
+        """Configure and (re)start the scheduler, or remove it if not used."""
+        if not self.scheduled:
+            if os.path.exists(SCHEDULER_UNIT_FILE):
+                host.service_stop(SCHEDULER_SERVICE)
+                host.service("disable", SCHEDULER_SERVICE)
+                os.remove(SCHEDULER_UNIT_FILE)
+                subprocess.call(["systemctl", "daemon-reload"])
+            if os.path.exists(SCHEDULER_CONFIG):
+                # holds the client tokens
+                os.remove(SCHEDULER_CONFIG)
+            return
+
+        config = {
+            "interval": self.config.get("scheduler_interval"),
+            "min_interval": self.config.get("scheduler_min_interval"),
+            "max_interval": self.scheduler_max_interval,
+            "concurrency": self.config.get("scheduler_concurrency"),
+            "results_dir": os.path.join(PLUGIN_STATE_DIR, "results"),
+            "jobs": self.scheduler_jobs(),
+        }
+        if self.passive:
+            hostname = NRPE().hostname
+            config.update(
+                hostname=hostname,
+                submitter=self.passive_submitter,
+                jobs=self.scheduler_jobs(hostname),
+            )
+        # the configuration holds the client tokens
+        host.write_file(
+            SCHEDULER_CONFIG,
+            json.dumps(config, indent=2).encode(),
+            owner="nagios",
+            group="nagios",
+            perms=0o600,
+        )
+        host.write_file(
+            SCHEDULER_UNIT_FILE,
+            SCHEDULER_UNIT.format(
+                plugin=os.path.join(self.plugins_dir, "ksc_scheduler.py"),
+                config=SCHEDULER_CONFIG,
+            ).encode(),
+            perms=0o644,
+        )
+        subprocess.call(["systemctl", "daemon-reload"])
+        host.service("enable", SCHEDULER_SERVICE)
+        host.service_restart(SCHEDULER_SERVICE)
+
+    def render_checks(self):
+        """Render the nrpe checks assigned to this unit, removing the others."""
+        nrpe = NRPE()
+        if not os.path.exists(self.plugins_dir):
+            os.makedirs(self.plugins_dir)
+
+        passive_services = []
+        for cluster in self.related_clusters:
+            if cluster not in self.clusters:
+                # missing its endpoint or credentials, e.g. half removed
+                self.remove_checks(nrpe, cluster)
+        for cluster in self.clusters:
+            commands = self.check_commands(cluster)
+            if "all" not in commands:
+                # aggregate disabled, run by the scheduler or with no check
+                nrpe.remove_check(shortname=check_shortname(cluster, "all"))
+            for check, check_command in commands.items():
+                shortname = check_shortname(cluster, check)
+                if not self.is_assigned(check):
+                    nrpe.remove_check(shortname=shortname)
+                elif self.passive and check in PLUGIN_CHECKS:
+                    # pushed by the scheduler, nagios only checks their freshness
+                    nrpe.remove_check(shortname=shortname)
+                    passive_services.append(
+                        (shortname, check_description(cluster, check))
+                    )
+                else:
+                    nrpe.add_check(
+                        shortname=shortname,
+                        description=check_description(cluster, check),
+                        check_cmd=check_command,
+                    )
+        self.render_passive_services(nrpe, passive_services)
         nrpe.write()
 
+    def remove_checks(self, nrpe, cluster):
+        """Remove every nrpe check of a cluster."""
+        for check in ALL_CHECKS + ["all"]:
+            nrpe.remove_check(shortname=check_shortname(cluster, check))
+
+    def remove_cluster(self, name):
+        """Remove the nrpe checks of a cluster no longer related.
+
+        :param name: Name of the cluster, "" for the first related cluster
+        """
+        nrpe = NRPE()
+        self.remove_checks(nrpe, Cluster(name, None, None, None))
+        nrpe.write()
+
+    def render_passive_services(self, nrpe, services):
+        """Write the nagios passive services, removing the stale ones.
+
+        :param nrpe: NRPE instance, giving the nagios host name and groups
+        :param services: list of (shortname, description)
+        """
+        if not os.path.exists(NAGIOS_EXPORT_DIR):
+            # created by nrpe-external-master, as charmhelpers NRPE expects
+            logging.warning(
+                "Not writing the passive services as {} is not accessible".format(
+                    NAGIOS_EXPORT_DIR
+                )
+            )
+            return
+        stale = set(
+            glob.glob(
+                os.path.join(
+                    NAGIOS_EXPORT_DIR,
+                    PASSIVE_SERVICE_FILE.format(hostname=nrpe.hostname, shortname="*"),
+                )
+            )
+        )
+        for shortname, description in services:
+            path = os.path.join(
+                NAGIOS_EXPORT_DIR,
+                PASSIVE_SERVICE_FILE.format(
+                    hostname=nrpe.hostname, shortname=shortname
+                ),
+            )
+            stale.discard(path)
+            with open(path, "w") as f:
+                f.write(
+                    PASSIVE_SERVICE.format(
+                        hostname=nrpe.hostname,
+                        description="{}[{}] {}".format(
+                            nrpe.hostname, shortname, description
+                        ),
+                        servicegroups=nrpe.nagios_servicegroups,
+                        freshness_threshold=2 * self.scheduler_max_interval,
+                    )
+                )
+        for path in stale:
+            os.remove(path)
+
     def install_kubectl(self):
         """Attempt to install kubectl.
 
@@ -5,11 +5,16 @@
 
 """Operator Charm main library."""
 # Load modules from lib directory
+import json
 import logging
 
 import setuppath  # noqa:F401
 
-from lib_kubernetes_service_checks import KSCHelper  # noqa:I100
+from lib_kubernetes_service_checks import (  # noqa:I100
+    KSCHelper,
+    assign_checks,
+    parse_cluster_endpoints,
+)
 
 from ops.charm import CharmBase
 from ops.framework import StoredState
@@ -38,6 +43,10 @@ class KubernetesServiceChecksCharm(CharmBase):
             self.on.kube_api_endpoint_relation_departed,
             self.on_kube_api_endpoint_relation_departed,
         )
+        self.framework.observe(
+            self.on.kube_api_endpoint_relation_broken,
+            self.on_kube_api_endpoint_relation_broken,
+        )
         self.framework.observe(
             self.on.kube_control_relation_changed, self.on_kube_control_relation_changed
         )
@@ -45,6 +54,10 @@ class KubernetesServiceChecksCharm(CharmBase):
             self.on.kube_control_relation_departed,
             self.on_kube_control_relation_departed,
         )
+        self.framework.observe(
+            self.on.kube_control_relation_broken,
+            self.on_kube_control_relation_broken,
+        )
         self.framework.observe(
             self.on.nrpe_external_master_relation_joined,
             self.on_nrpe_external_master_relation_joined,
@@ -53,6 +66,17 @@ class KubernetesServiceChecksCharm(CharmBase):
             self.on.nrpe_external_master_relation_departed,
             self.on_nrpe_external_master_relation_departed,
         )
+        # -- check sharding between units --
+        self.framework.observe(self.on.leader_elected, self.on_replicas_changed)
+        self.framework.observe(
+            self.on.replicas_relation_joined, self.on_replicas_changed
+        )
+        self.framework.observe(
+            self.on.replicas_relation_changed, self.on_replicas_changed
+        )
+        self.framework.observe(
+            self.on.replicas_relation_departed, self.on_replicas_changed
+        )
         # -- initialize states --
         self.state.set_default(
             installed=False,
@@ -61,6 +85,10 @@ class KubernetesServiceChecksCharm(CharmBase):
             kube_control={},
             kube_api_endpoint={},
             nrpe_configured=False,
+            assigned_checks=None,
+            primary_cluster="",
+            clusters={},
+            cluster_relations={},
         )
         self.helper = KSCHelper(self.model.config, self.state)
 
@@ -102,6 +130,21 @@ class KubernetesServiceChecksCharm(CharmBase):
             logging.warning("nrpe-external-master relation missing or misconfigured")
             self.unit.status = BlockedStatus("missing nrpe-external-master relation")
             return
+        if self.helper.unknown_checks:
+            self.unit.status = BlockedStatus(
+                "unknown enabled_checks: {}".format(
+                    ", ".join(self.helper.unknown_checks)
+                )
+            )
+            return
+        if self.helper.passive and not (
+            self.config["passive_submitter"] and self.config["passive_target"]
+        ):
+            logging.warning("passive check_mode without a submitter and its target")
+            self.unit.status = BlockedStatus(
+                "passive check_mode needs passive_submitter and passive_target"
+            )
+            return
 
         if not self.state.configured:
             # Check specific required config values
@@ -132,6 +175,7 @@ class KubernetesServiceChecksCharm(CharmBase):
     def on_config_changed(self, event):
         """Handle config changed."""
         self.state.configured = False
+        self.helper.invalidate_config()
         if not self.state.installed:
             logging.warning(
                 "Config changed called before install complete, "
@@ -139,6 +183,9 @@ class KubernetesServiceChecksCharm(CharmBase):
             )
             self._defer_once(event)
             return
+        # the enabled checks may have changed
+        self.rebalance_checks()
+        self.update_assigned_checks()
         self.check_charm_status()
 
     def on_start(self, event):
@@ -174,34 +221,116 @@ class KubernetesServiceChecksCharm(CharmBase):
             )
             event.defer()
 
+    def _cluster_name(self, event, relation):
+        """Get the name of the cluster behind a relation event.
+
+        A cluster is named after its kube-control application, which a
+        kube-api-endpoint application of another name (e.g. a load balancer)
+        is paired with in the cluster_endpoints config.
+        """
+        app = event.app.name if event.app else ""
+        if relation == "kube_api_endpoint":
+            return parse_cluster_endpoints(self.config["cluster_endpoints"]).get(
+                app, app
+            )
+        return app
+
+    def _single_cluster(self):
+        """Check if at most one relation of each kind is established."""
+        return all(
+            len(self.model.relations[name]) <= 1
+            for name in ("kube-api-endpoint", "kube-control")
+        )
+
+    def _cluster_relation_state(self, event, relation):
+        """Get the stored data of a relation with the cluster behind the event.
+
+        The first related cluster is kept in the kube_api_endpoint and
+        kube_control states, any other cluster is kept in the clusters state
+        under its name. With a single relation of each kind, both belong to
+        the first cluster, whatever their applications. A relation stays with
+        the cluster it was first stored with, recorded by relation id.
+        """
+        key = str(event.relation.id)
+        cluster = self.state.cluster_relations.get(key)
+        if cluster is None:
+            cluster = self._cluster_name(event, relation)
+            if self._single_cluster() or self.state.primary_cluster in ("", cluster):
+                if not self.state.primary_cluster or relation == "kube_control":
+                    self.state.primary_cluster = cluster
+                cluster = ""
+            self.state.cluster_relations[key] = cluster
+        # the returned state is about to change
+        self.helper.invalidate()
+        if not cluster:
+            return getattr(self.state, relation)
+        if cluster not in self.state.clusters:
+            self.state.clusters[cluster] = {"kube_api_endpoint": {}, "kube_control": {}}
+        return self.state.clusters[cluster][relation]
+
+    def _cluster_relation_broken(self, event, relation):
+        """Forget a removed relation and the nrpe checks of its cluster."""
+        self.state.configured = False
+        key = str(event.relation.id)
+        if key in self.state.cluster_relations:
+            cluster = self.state.cluster_relations.pop(key)
+        elif event.app and event.app.name != self.state.primary_cluster:
+            cluster = event.app.name
+        else:
+            cluster = ""
+        self.helper.invalidate()
+        if not cluster:
+            setattr(self.state, relation, {})
+        elif cluster in self.state.clusters:
+            self.state.clusters[cluster][relation] = {}
+            if not any(self.state.clusters[cluster].values()):
+                del self.state.clusters[cluster]
+        logging.info("Removing the checks of cluster '{}'".format(cluster))
+        self.helper.remove_cluster(cluster)
+        self.check_charm_status()
+
     def on_kube_api_endpoint_relation_changed(self, event):
         """Handle kube_api_endpoint relation changed."""
         self.state.configured = False
         self.unit.status = MaintenanceStatus("Updating K8S Endpoint")
-        self.state.kube_api_endpoint.update(event.relation.data.get(event.unit, {}))
+        self._cluster_relation_state(event, "kube_api_endpoint").update(
+            event.relation.data.get(event.unit, {})
+        )
         self.check_charm_status()
 
     def on_kube_api_endpoint_relation_departed(self, event):
         """Handle kube-api-endpoint relation departed."""
         self.state.configured = False
-        for k in self.state.kube_api_endpoint.keys():
-            self.state.kube_api_endpoint[k] = ""
+        kube_api_endpoint = self._cluster_relation_state(event, "kube_api_endpoint")
+        for k in kube_api_endpoint.keys():
+            kube_api_endpoint[k] = ""
         self.check_charm_status()
 
+    def on_kube_api_endpoint_relation_broken(self, event):
+        """Handle kube-api-endpoint relation broken."""
+        self._cluster_relation_broken(event, "kube_api_endpoint")
+
     def on_kube_control_relation_changed(self, event):
         """Handle kube-control relation changed."""
         self.state.configured = False
         self.unit.status = MaintenanceStatus("Updating K8S Credentials")
-        self.state.kube_control.update(event.relation.data.get(event.unit, {}))
+        self._cluster_relation_state(event, "kube_control").update(
+            event.relation.data.get(event.unit, {})
+        )
         self.check_charm_status()
 
     def on_kube_control_relation_departed(self, event):
         """Handle kube-control relation departed."""
         self.state.configured = False
-        for k in self.state.kube_control.keys():
-            self.state.kube_control[k] = ""
+        kube_control = self._cluster_relation_state(event, "kube_control")
+        for k in kube_control.keys():
+            kube_control[k] = ""
         self.check_charm_status()
 
+    def on_kube_control_relation_broken(self, event):
+        """Handle kube-control relation broken."""
+        self._cluster_relation_broken(event, "kube_control")
+
     def on_nrpe_external_master_relation_joined(self, event):
         """Handle nrpe-external-master relation joined."""
         self.state.nrpe_configured = True
@@ -213,6 +342,39 @@ class KubernetesServiceChecksCharm(CharmBase):
         self.state.nrpe_configured = False
         self.check_charm_status()
 
+    def rebalance_checks(self):
+        """Assign the checks to the units of the application, if leader."""
+        relation = self.model.get_relation("replicas")
+        if relation is None or not self.unit.is_leader():
+            return
+        units = [self.unit.name] + [unit.name for unit in relation.units]
+        assignments = json.dumps(
+            assign_checks(self.helper.enabled_checks, units), sort_keys=True
+        )
+        if relation.data[self.app].get("assignments") != assignments:
+            logging.info("Rebalancing checks across {} units".format(len(units)))
+            relation.data[self.app]["assignments"] = assignments
+
+    def update_assigned_checks(self):
+        """Read the checks assigned to this unit by the leader."""
+        relation = self.model.get_relation("replicas")
+        assignments = relation.data[self.app].get("assignments") if relation else None
+        if assignments:
+            assigned = json.loads(assignments).get(self.unit.name, [])
+        else:
+            assigned = None
+        current = self.state.assigned_checks
+        if (list(current) if current is not None else None) != assigned:
+            logging.info("Checks assigned to this unit: {}".format(assigned))
+            self.state.assigned_checks = assigned
+            self.state.configured = False
+
+    def on_replicas_changed(self, event):
+        """Handle units joining or leaving and leadership changes."""
+        self.rebalance_checks()
+        self.update_assigned_checks()
+        self.check_charm_status()
+
 
 if __name__ == "__main__":
     main(KubernetesServiceChecksCharm)
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""Benchmark the latency of the charm hooks.
+
+Drives KubernetesServiceChecksCharm through storms of events on the ops
+Harness, with local stand-ins for the host operations (rsync, NRPE,
+update-ca-certificates, service restarts, ...), and reports the latency of
+each hook and of each step run within it.
+
+The latency of each hook is also given as a ratio of a reference hook run
+alongside the storms, decoding a kube-control credentials payload, so that
+it does not depend on the speed of the machine. The results are compared
+with baseline.json, which keeps only those ratios and the calls of each
+step per hook: a hook whose ratio grows beyond the tolerance, or a step
+called more often per hook than in the baseline, is flagged as a regression.
+
+    python3 tests/benchmark/bench_hooks.py [--update-baseline]
+"""
+import argparse
+import collections
+import contextlib
+import functools
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, "lib"), os.path.join(ROOT_DIR, "src")]
+
+from charm import KubernetesServiceChecksCharm  # noqa:E402,I100
+
+# the module imported by the charm, to patch its host operations
+import lib_kubernetes_service_checks  # noqa:E402,I100
+
+from ops.testing import Harness  # noqa:E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# hook measured in the same run, the latency of the others is relative to
+REFERENCE = "reference"
+
+# latency growth (ratio of the baseline) and absolute growth (in reference
+# hook runs) flagged
+TOLERANCE = 1.0
+MIN_DELTA = 2.0
+
+STORM_SIZE = 20
+CREDS_USERS = 50
+
+
+class Recorder:
+    """Record the latency of the hooks and of the steps run within them."""
+
+    def __init__(self):
+        """Initialize empty hook and step records."""
+        self.hooks = collections.defaultdict(list)
+        self.steps = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.current = None
+
+    @contextlib.contextmanager
+    def hook(self, name):
+        """Record the latency of the hook run within the block."""
+        self.current = collections.defaultdict(lambda: [0.0, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.hooks[name].append(time.perf_counter() - start)
+            for step, (seconds, calls) in self.current.items():
+                self.steps[name][step].append((seconds, calls))
+            self.current = None
+
+    def wrap(self, step, func):
+        """Get a function recording the latency of each call to `func`."""
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.current is not None:
+                    record = self.current[step]
+                    record[0] += time.perf_counter() - start
+                    record[1] += 1
+
+        return timed
+
+    def results(self):
+        """Summarise the records, in milliseconds, by hook and step.
+
+        The median latency of each hook is also given as a ratio of the
+        median latency of the reference hook.
+        """
+        reference = statistics.median(self.hooks[REFERENCE])
+        results = {}
+        for hook, durations in self.hooks.items():
+            runs = len(durations)
+            results[hook] = {
+                "runs": runs,
+                "median_ms": round(1000 * statistics.median(durations), 3),
+                "max_ms": round(1000 * max(durations), 3),
+                "ratio": round(statistics.median(durations) / reference, 3),
+                "steps": {
+                    step: {
+                        # steps not run by every hook run count as 0 for the others
+                        "median_ms": round(
+                            1000
+                            * statistics.median(
+                                [seconds for seconds, _ in records]
+                                + [0.0] * (runs - len(records))
+                            ),
+                            3,
+                        ),
+                        "calls": round(sum(calls for _, calls in records) / runs, 3),
+                    }
+                    for step, records in sorted(self.steps[hook].items())
+                },
+            }
+        return results
+
+
+class StandInNRPE:
+    """Stand-in for charmhelpers NRPE, keeping the check definitions in memory."""
+
+    hostname = "juju-kubernetes-service-checks-0"
+    nagios_servicegroups = "juju"
+    definitions = {}
+
+    def __init__(self, *args, **kwargs):
+        """Start a new set of checks, as NRPE() does."""
+        self.checks = {}
+        self.removed = set()
+
+    def add_check(self, shortname, description, check_cmd):
+        """Add a check definition."""
+        self.checks[shortname] = (description, check_cmd)
+
+    def remove_check(self, shortname, **kwargs):
+        """Remove a check definition."""
+        self.removed.add(shortname)
+
+    def write(self):
+        """Render the check definitions, as the nrpe and nagios config files."""
+        for shortname in self.removed:
+            self.definitions.pop(shortname, None)
+        for shortname, (description, check_cmd) in self.checks.items():
+            self.definitions[shortname] = (
+                "command[check_{}]={}\n".format(shortname, check_cmd),
+                "define service {{\n    service_description {}[{}] {}\n}}\n".format(
+                    self.hostname, shortname, description
+                ),
+            )
+
+
+def _noop(*args, **kwargs):
+    return 0
+
+
+def stand_ins(recorder, tmp_dir):
+    """Patch the host operations with local stand-ins recording their latency.
+
+    The charm's own steps are wrapped as well, so their latency includes the
+    stand-ins they call.
+    """
+    lib = lib_kubernetes_service_checks
+    StandInNRPE.definitions = {}
+    patches = [
+        mock.patch.object(lib, "NRPE", StandInNRPE),
+        mock.patch.object(
+            StandInNRPE, "write", recorder.wrap("nrpe.write", StandInNRPE.write)
+        ),
+        mock.patch.object(lib.host, "rsync", recorder.wrap("rsync", _noop)),
+        mock.patch.object(lib.host, "write_file", recorder.wrap("write_file", _noop)),
+        mock.patch.object(lib.host, "service", recorder.wrap("service", _noop)),
+        mock.patch.object(lib.host, "service_stop", recorder.wrap("service", _noop)),
+        mock.patch.object(
+            lib.host, "service_restart", recorder.wrap("service_restart", _noop)
+        ),
+        mock.patch.object(lib.subprocess, "call", recorder.wrap("subprocess", _noop)),
+        mock.patch.object(lib, "CERT_FILE", os.path.join(tmp_dir, "ca.crt")),
+        mock.patch.object(lib, "NAGIOS_EXPORT_DIR", tmp_dir),
+        mock.patch.object(
+            lib,
+            "parse_client_token",
+            recorder.wrap("parse_client_token", lib.parse_client_token),
+        ),
+    ]
+    for method in (
+        "update_tls_certificates",
+        "update_plugins",
+        "render_scheduler",
+        "render_checks",
+    ):
+        patches.append(
+            mock.patch.object(
+                lib.KSCHelper,
+                method,
+                recorder.wrap(method, getattr(lib.KSCHelper, method)),
+            )
+        )
+    stack = contextlib.ExitStack()
+    for patch in patches:
+        stack.enter_context(patch)
+    return stack
+
+
+def _creds(generation):
+    """Get kube-control credentials with many users, as on large clusters."""
+    return json.dumps(
+        {
+            "system:node:worker-{}".format(i): {
+                "client_token": "token-{}-{}".format(generation, i),
+                "kubelet_token": "kubelet-{}-{}".format(generation, i),
+                "proxy_token": "proxy-{}-{}".format(generation, i),
+                "scope": "kubernetes-worker/{}".format(i),
+            }
+            for i in range(CREDS_USERS)
+        }
+    )
+
+
+def _harness():
+    # metadata.yaml and config.yaml defaults are read from the charm directory
+    harness = Harness(KubernetesServiceChecksCharm)
+    harness.set_leader(True)
+    harness.begin()
+    harness.charm.on.install.emit()
+    return harness
+
+
+def _relate(harness, recorder, endpoint, app, data):
+    """Relate a remote unit, recording the relation-changed hook."""
+    relation_id = harness.add_relation(endpoint, app)
+    harness.add_relation_unit(relation_id, app + "/0")
+    with recorder.hook("{}_relation_changed".format(endpoint.replace("-", "_"))):
+        harness.update_relation_data(relation_id, app + "/0", data)
+    return relation_id
+
+
+def storm(recorder):
+    """Drive the charm through the hooks of a deployment, then event storms."""
+    harness = _harness()
+    nrpe_id = harness.add_relation("nrpe-external-master", "nrpe")
+    with recorder.hook("nrpe_external_master_relation_joined"):
+        harness.add_relation_unit(nrpe_id, "nrpe/0")
+    api_id = _relate(
+        harness,
+        recorder,
+        "kube-api-endpoint",
+        "kubernetes-master",
+        {"hostname": "10.0.0.1", "port": "6443"},
+    )
+    control_id = _relate(
+        harness, recorder, "kube-control", "kubernetes-master", {"creds": _creds(0)}
+    )
+
+    for i in range(STORM_SIZE):
+        with recorder.hook(REFERENCE):
+            json.loads(_creds(i))
+        with recorder.hook("config_changed"):
+            harness.update_config(
+                {
+                    "trusted_ssl_ca": "Y2VydGlmaWNhdGU=" if i % 2 else "",
+                    "scheduler_interval": 300 + i,
+                }
+            )
+        with recorder.hook("kube_control_relation_changed"):
+            harness.update_relation_data(
+                control_id, "kubernetes-master/0", {"creds": _creds(i + 1)}
+            )
+        with recorder.hook("kube_api_endpoint_relation_changed"):
+            harness.update_relation_data(
+                api_id, "kubernetes-master/0", {"port": str(6444 + i)}
+            )
+
+    # more clusters, then more units to share the checks with
+    for i in range(3):
+        app = "k8s-{}".format(i)
+        _relate(
+            harness,
+            recorder,
+            "kube-api-endpoint",
+            app,
+            {"hostname": "10.0.{}.1".format(i + 1), "port": "6443"},
+        )
+        _relate(harness, recorder, "kube-control", app, {"creds": _creds(i)})
+    replicas_id = harness.add_relation("replicas", "kubernetes-service-checks")
+    for i in range(1, 4):
+        with recorder.hook("replicas_relation_joined"):
+            harness.add_relation_unit(
+                replicas_id, "kubernetes-service-checks/{}".format(i)
+            )
+    with recorder.hook("config_changed scheduled"):
+        harness.update_config({"check_mode": "scheduled"})
+    with recorder.hook("config_changed passive"):
+        harness.update_config(
+            {
+                "check_mode": "passive",
+                "passive_submitter": "nrdp",
+                "passive_target": "https://nagios.example.com/nrdp/",
+            }
+        )
+
+
+def baseline_of(results):
+    """Keep the results that do not depend on the speed of the machine.
+
+    :returns: dict, the latency ratio and the calls of each step, by hook
+    """
+    return {
+        hook: {
+            "ratio": result["ratio"],
+            "runs": result["runs"],
+            "steps": {
+                step: {"calls": step_result["calls"]}
+                for step, step_result in result["steps"].items()
+            },
+        }
+        for hook, result in results.items()
+        if hook != REFERENCE
+    }
+
+
+def compare(results, baseline, tolerance):
+    """List the hooks and steps regressing from the baseline.
+
+    :returns: list of messages, one per regression
+    """
+    regressions = []
+    for hook, result in sorted(results.items()):
+        previous = baseline.get(hook)
+        if previous is None:
+            continue
+        if (
+            result["ratio"] > previous["ratio"] * (1 + tolerance)
+            and result["ratio"] - previous["ratio"] > MIN_DELTA
+        ):
+            regressions.append(
+                "{}: {:.2f}x the reference hook, baseline {:.2f}x".format(
+                    hook, result["ratio"], previous["ratio"]
+                )
+            )
+        for step, step_result in result["steps"].items():
+            previous_step = previous["steps"].get(step)
+            if previous_step is None:
+                regressions.append("{} {}: new step".format(hook, step))
+            elif step_result["calls"] > previous_step["calls"]:
+                regressions.append(
+                    "{} {}: {:.2f} calls per run, baseline {:.2f}".format(
+                        hook, step, step_result["calls"], previous_step["calls"]
+                    )
+                )
+    return regressions
+
+
+def report(results):
+    """Print the latency of each hook and of its steps."""
+    print(
+        "{:<45} {:>5} {:>10} {:>10} {:>7}".format(
+            "hook / step", "runs", "median", "max", "ratio"
+        )
+    )
+    for hook, result in sorted(results.items()):
+        print(
+            "{:<45} {:>5} {:>10.2f} {:>10.2f} {:>7.2f}".format(
+                hook,
+                result["runs"],
+                result["median_ms"],
+                result["max_ms"],
+                result["ratio"],
+            )
+        )
+        for step, step_result in result["steps"].items():
+            print(
+                "  {:<43} {:>5.2f} {:>10.2f}".format(
+                    step, step_result["calls"], step_result["median_ms"]
+                )
+            )
+
+
+def main():
+    """Run the benchmark, report it and compare it with the baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline JSON file")
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Save the results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="Growth of the latency relative to the reference hook, as a ratio "
+        "of the baseline, flagged",
+    )
+    parser.add_argument("--output", help="Also save the results to a JSON file")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    os.environ.setdefault("JUJU_UNIT_NAME", "kubernetes-service-checks/0")
+    os.environ.setdefault("JUJU_CHARM_DIR", ROOT_DIR)
+    recorder = Recorder()
+    with tempfile.TemporaryDirectory() as tmp_dir, stand_ins(recorder, tmp_dir):
+        storm(recorder)
+    results = recorder.results()
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(baseline_of(results), f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""Benchmark the parsing of large list payloads, in-process and on worker processes.
+
+Runs the pods pass of the capacity check over synthetic pods list pages,
+shaped like the pods of a real cluster, with pages of LIST_PAGE_LIMIT pods
+served from memory. Each run creates its own engine, so the start of the
+worker processes is counted, as it is on every plugin run.
+
+The pages being served without network latency, the figures are the
+parsing cost alone; against a real apiserver the workers also overlap the
+parsing with the download of the next pages.
+
+The measured crossover needs as many idle cores as worker processes. The
+benchmark also measures the costs it depends on, the parsing of a page,
+the start of the workers and the transfer of a page to a worker, and
+projects from them the crossover on that many idle cores, so a host with
+fewer cores than the unit still gives an estimate.
+
+    python3 tests/benchmark/bench_parse.py [--sizes 500,5000] [--processes 2,4]
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT_DIR, "files", "plugins")]
+
+import check_kubernetes_api  # noqa:E402,I100
+
+NODES = 100
+
+
+def pod(i):
+    """Build a pod shaped like one of a real cluster, managedFields included."""
+    name = "app-{}-7c9f8d6b5-{:05d}".format(i % 50, i)
+    return {
+        "metadata": {
+            "name": name,
+            "namespace": "team-{}".format(i % 20),
+            "uid": "0f1e2d3c-4b5a-6978-8796-{:012d}".format(i),
+            "resourceVersion": str(100000 + i),
+            "creationTimestamp": "2024-01-01T00:00:00Z",
+            "labels": {
+                "app": "app-{}".format(i % 50),
+                "pod-template-hash": "7c9f8d6b5",
+            },
+            "annotations": {
+                "kubectl.kubernetes.io/restartedAt": "2024-01-01T00:00:00Z"
+            },
+            "ownerReferences": [
+                {"apiVersion": "apps/v1", "kind": "ReplicaSet", "name": name[:-6]}
+            ],
+            "managedFields": [
+                {
+                    "manager": "kube-controller-manager",
+                    "operation": "Update",
+                    "apiVersion": "v1",
+                    "fieldsType": "FieldsV1",
+                    "fieldsV1": {"f:spec": {"f:containers": {}}, "f:metadata": {}},
+                }
+            ],
+        },
+        "spec": {
+            "nodeName": "node-{}".format(i % NODES),
+            "containers": [
+                {
+                    "name": "app",
+                    "image": "registry.example.com/app:1.2.3",
+                    "resources": {
+                        "requests": {"cpu": "250m", "memory": "256Mi"},
+                        "limits": {"cpu": "1", "memory": "512Mi"},
+                    },
+                    "env": [
+                        {"name": "VAR_{}".format(n), "value": "x"} for n in range(5)
+                    ],
+                },
+                {
+                    "name": "sidecar",
+                    "image": "registry.example.com/proxy:1.0",
+                    "resources": {"requests": {"cpu": "50m", "memory": "64Mi"}},
+                },
+            ],
+            "initContainers": [
+                {"name": "init", "resources": {"requests": {"cpu": "100m"}}}
+            ],
+        },
+        "status": {
+            "phase": "Running",
+            "conditions": [
+                {"type": condition, "status": "True"}
+                for condition in ("Initialized", "Ready", "PodScheduled")
+            ],
+            "containerStatuses": [
+                {"name": "app", "ready": True, "restartCount": 0},
+                {"name": "sidecar", "ready": True, "restartCount": 0},
+            ],
+        },
+    }
+
+
+def pages(size):
+    """Serialize the pages of a pods list, continue tokens linking them."""
+    limit = check_kubernetes_api.LIST_PAGE_LIMIT
+    count = (size + limit - 1) // limit
+    return [
+        json.dumps(
+            {
+                "kind": "PodList",
+                "apiVersion": "v1",
+                "metadata": {
+                    "resourceVersion": "1",
+                    "continue": str(page + 1) if page + 1 < count else "",
+                },
+                "items": [
+                    pod(i) for i in range(page * limit, min(size, (page + 1) * limit))
+                ],
+            },
+            separators=(",", ":"),
+        ).encode()
+        for page in range(count)
+    ]
+
+
+class Response:
+    """Response serving a page from memory."""
+
+    status = 200
+
+    def __init__(self, data):
+        """Initialize the response with the page."""
+        self.data = data
+
+
+class PagesPool:
+    """Stand-in for the connection pool, serving the pages from memory."""
+
+    def __init__(self, data):
+        """Initialize the pool with the serialized pages."""
+        self.pages = data
+
+    def request(self, method, url, fields=None, headers=None):
+        """Get the page following the continue token of the request."""
+        return Response(self.pages[int(fields.get("continue") or 0)])
+
+
+def run(data, processes):
+    """Time the pods pass of the capacity check, engine start included."""
+    start = time.perf_counter()
+    with check_kubernetes_api.CheckEngine(False, processes=processes) as engine:
+        check_kubernetes_api._requested_per_node(
+            PagesPool(data), "https://bench", "token", engine
+        )
+    return time.perf_counter() - start
+
+
+def costs(data, processes):
+    """Measure the per page parse and transfer costs and the workers start.
+
+    :returns: (parse, start, transfer) seconds, parse and transfer per page
+    """
+    start = time.perf_counter()
+    for page in data:
+        check_kubernetes_api._page_requests(page)
+    parse = (time.perf_counter() - start) / len(data)
+
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["check_kubernetes_api"])
+    start = time.perf_counter()
+    with check_kubernetes_api.ProcessPoolExecutor(
+        processes, mp_context=context
+    ) as pool:
+        list(pool.map(len, [b""] * processes))
+        started = time.perf_counter()
+        # round trip of a page to a worker doing nothing with it
+        for page in data:
+            pool.submit(len, page).result()
+        transfer = (time.perf_counter() - started) / len(data)
+    return parse, started - start, transfer
+
+
+def projected_crossover(parse, start, transfer, processes):
+    """Project the list size from which the workers are faster on idle cores.
+
+    In-process, each page costs its parsing. With one idle core per worker,
+    the check only hands the pages over while the workers parse them, so
+    each page costs the larger of its transfer and its share of the
+    parsing, and the start of the workers has to be paid back.
+
+    :returns: number of pods, None when the workers are never faster
+    """
+    saved = parse - max(transfer, parse / processes)
+    if saved <= 0:
+        return None
+    return math.ceil(start / saved) * check_kubernetes_api.LIST_PAGE_LIMIT
+
+
+def main():
+    """Run the benchmark and report the crossover point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", default="500,2000,5000,10000,20000,50000", help="Pods per list"
+    )
+    parser.add_argument("--processes", default="2,4", help="Worker processes")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per size")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    workers = [int(n) for n in args.processes.split(",")]
+
+    print("{} CPUs".format(os.cpu_count()))
+    print(
+        "{:>8} {:>8} {:>12}".format("pods", "MiB", "in-process")
+        + "".join(" {:>12}".format("{} procs".format(n)) for n in workers)
+    )
+    crossover = {}
+    for size in sizes:
+        data = pages(size)
+        medians = [
+            statistics.median(run(data, n) for _ in range(args.repeat))
+            for n in [0] + workers
+        ]
+        print(
+            "{:>8} {:>8.1f}".format(size, sum(map(len, data)) / 2**20)
+            + "".join(" {:>10.1f}ms".format(1000 * median) for median in medians)
+        )
+        for n, median in zip(workers, medians[1:]):
+            if median < medians[0]:
+                crossover.setdefault(n, size)
+    data = pages(sizes[-1])
+    for n in workers:
+        parse, start, transfer = costs(data, n)
+        projected = projected_crossover(parse, start, transfer, n)
+        print(
+            "{} procs: {}; parse {:.1f}ms/page, start {:.0f}ms, "
+            "transfer {:.2f}ms/page, projected on {} idle cores: {}".format(
+                n,
+                "faster from {} pods".format(crossover[n])
+                if n in crossover
+                else "never faster in this range",
+                1000 * parse,
+                1000 * start,
+                1000 * transfer,
+                n,
+                "faster from {} pods".format(projected) if projected else "never",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 """Charm unit tests."""
+import json
 import os
 import unittest
 
@@ -156,6 +157,80 @@ class TestKubernetesServiceChecksCharm(unittest.TestCase):
         self.harness.charm.check_charm_status.assert_called_once()
         assert self.harness.charm.helper.kubernetes_client_token == "DECAFBADBEEF"
 
+    def test_second_cluster_relation_changed(self):
+        """Check a second cluster is stored apart from the first one."""
+        self.harness.begin()
+        self.harness.charm.check_charm_status = mock.MagicMock()
+        for app in ["kubernetes-master", "kubernetes-master-b"]:
+            relation_id = self.harness.add_relation("kube-api-endpoint", app)
+            self.harness.add_relation_unit(relation_id, app + "/0")
+            self.harness.update_relation_data(
+                relation_id,
+                app + "/0",
+                {"hostname": app, "port": "6443"},
+            )
+            relation_id = self.harness.add_relation("kube-control", app)
+            self.harness.add_relation_unit(relation_id, app + "/0")
+            self.harness.update_relation_data(
+                relation_id, app + "/0", TEST_KUBE_CONTOL_RELATION_DATA
+            )
+
+        self.assertEqual(
+            self.harness.charm.helper.kubernetes_api_address, "kubernetes-master"
+        )
+        clusters = self.harness.charm.helper.clusters
+        self.assertEqual(
+            [cluster.name for cluster in clusters], ["", "kubernetes-master-b"]
+        )
+        self.assertEqual(clusters[1].address, "kubernetes-master-b")
+        self.assertEqual(clusters[1].token, "DECAFBADBEEF")
+
+    def test_load_balancer_cluster_relations(self):
+        """Check an endpoint from a load balancer is paired with its cluster."""
+        self.harness.begin()
+        self.harness.charm.check_charm_status = mock.MagicMock()
+
+        def relate(relation, app, data):
+            relation_id = self.harness.add_relation(relation, app)
+            self.harness.add_relation_unit(relation_id, app + "/0")
+            self.harness.update_relation_data(relation_id, app + "/0", data)
+            return relation_id
+
+        # a single relation of each kind is the first cluster
+        relate(
+            "kube-api-endpoint",
+            "kubeapi-load-balancer",
+            TEST_KUBE_API_ENDPOINT_RELATION_DATA,
+        )
+        relate(
+            "kube-control", "kubernetes-control-plane", TEST_KUBE_CONTOL_RELATION_DATA
+        )
+        self.assertEqual(
+            self.harness.charm.helper.clusters,
+            [("", "1.1.1.1", "1111", "DECAFBADBEEF")],
+        )
+
+        # further clusters are paired in the config
+        self.harness._backend._config["cluster_endpoints"] = "lb-b:cp-b"
+        endpoint_id = relate(
+            "kube-api-endpoint", "lb-b", {"hostname": "2.2.2.2", "port": "2222"}
+        )
+        relate("kube-control", "cp-b", TEST_KUBE_CONTOL_RELATION_DATA)
+        clusters = self.harness.charm.helper.clusters
+        self.assertEqual([cluster.name for cluster in clusters], ["", "cp-b"])
+        self.assertEqual(clusters[1].address, "2.2.2.2")
+
+        # the checks of a cluster are removed with its relations
+        self.harness.charm.helper.remove_cluster = mock.MagicMock()
+        self.harness.remove_relation(endpoint_id)
+        self.harness.charm.helper.remove_cluster.assert_called_once_with("cp-b")
+        self.assertEqual(
+            [cluster.name for cluster in self.harness.charm.helper.clusters], [""]
+        )
+        self.assertEqual(
+            dict(self.harness.charm.state.clusters["cp-b"]["kube_api_endpoint"]), {}
+        )
+
     def test_nrpe_external_master_relation_joined(self):
         """Check that nrpe.configure is True after nrpe relation joined."""
         relation_id = self.harness.add_relation("nrpe-external-master", "nrpe")
@@ -238,6 +313,115 @@ class TestKubernetesServiceChecksCharm(unittest.TestCase):
         self.harness.charm.helper.configure.assert_called_once()
         self.assertTrue(self.harness.charm.state.configured)
 
+    def test_check_charm_status_unknown_checks(self):
+        """Check the charm blocks on unknown checks in enabled_checks."""
+        self.harness._backend._config["enabled_checks"] = "health nodez"
+        self.harness.begin()
+        self.harness.charm.helper.configure = mock.MagicMock()
+        self.harness.charm.state.kube_control.update(TEST_KUBE_CONTOL_RELATION_DATA)
+        self.harness.charm.state.kube_api_endpoint.update(
+            TEST_KUBE_API_ENDPOINT_RELATION_DATA
+        )
+        self.harness.charm.state.nrpe_configured = True
+        self.harness.charm.check_charm_status()
+
+        self.harness.charm.helper.configure.assert_not_called()
+        self.assertEqual(
+            self.harness.charm.unit.status.message, "unknown enabled_checks: nodez"
+        )
+
+    def test_check_charm_status_passive_target_missing(self):
+        """Check the charm blocks in passive mode without a submitter target."""
+        self.harness._backend._config["check_mode"] = "passive"
+        self.harness.begin()
+        self.harness.charm.helper.configure = mock.MagicMock()
+        self.harness.charm.state.kube_control.update(TEST_KUBE_CONTOL_RELATION_DATA)
+        self.harness.charm.state.kube_api_endpoint.update(
+            TEST_KUBE_API_ENDPOINT_RELATION_DATA
+        )
+        self.harness.charm.state.nrpe_configured = True
+        self.harness.charm.check_charm_status()
+
+        self.harness.charm.helper.configure.assert_not_called()
+        self.assertEqual(
+            self.harness.charm.unit.status.message,
+            "passive check_mode needs passive_submitter and passive_target",
+        )
+
+        self.harness._backend._config.update(
+            passive_submitter="nrdp", passive_target="https://nagios/nrdp/"
+        )
+        self.harness.charm.check_charm_status()
+        self.harness.charm.helper.configure.assert_called_once()
+
+    def test_replicas_rebalance(self):
+        """Check the leader spreads the checks over the units."""
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("replicas", "kubernetes-service-checks")
+        self.harness.begin()
+        self.assertIsNone(self.harness.charm.state.assigned_checks)
+        self.harness.charm.check_charm_status = mock.MagicMock()
+        self.harness.add_relation_unit(relation_id, "kubernetes-service-checks/1")
+
+        assignments = json.loads(
+            self.harness.get_relation_data(relation_id, "kubernetes-service-checks")[
+                "assignments"
+            ]
+        )
+        self.assertEqual(
+            sorted(assignments),
+            ["kubernetes-service-checks/0", "kubernetes-service-checks/1"],
+        )
+        assigned = list(self.harness.charm.state.assigned_checks)
+        self.assertEqual(assigned, assignments["kubernetes-service-checks/0"])
+        self.assertIn("health", assigned)
+        self.assertNotIn("nodes", assigned)
+        self.harness.charm.check_charm_status.assert_called_once()
+
+        # the remaining unit takes over every check
+        self.harness.remove_relation_unit(relation_id, "kubernetes-service-checks/1")
+        self.assertEqual(
+            len(self.harness.charm.state.assigned_checks),
+            sum(len(checks) for checks in assignments.values()),
+        )
+
+    def test_config_changed_rebalance(self):
+        """Check the leader takes its own new shard after a config change."""
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("replicas", "kubernetes-service-checks")
+        self.harness.begin()
+        self.harness.charm.check_charm_status = mock.MagicMock()
+        self.harness.add_relation_unit(relation_id, "kubernetes-service-checks/1")
+        self.assertEqual(
+            list(self.harness.charm.state.assigned_checks),
+            [
+                "health",
+                "workloads",
+                "metrics",
+                "services",
+                "quotas",
+                "leases",
+                "certificates",
+            ],
+        )
+
+        self.harness.charm.state.installed = True
+        self.harness._backend._config[
+            "enabled_checks"
+        ] = "health nodes workloads cert_expiration"
+        self.harness.charm.on.config_changed.emit()
+        assignments = json.loads(
+            self.harness.get_relation_data(relation_id, "kubernetes-service-checks")[
+                "assignments"
+            ]
+        )
+        self.assertEqual(
+            assignments["kubernetes-service-checks/0"], ["health", "workloads"]
+        )
+        self.assertEqual(
+            list(self.harness.charm.state.assigned_checks), ["health", "workloads"]
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,8 @@
 """Tests for Kubernetes Service Checks Helper."""
 import base64
+import json
 import os
+import shutil
 import subprocess
 import tempfile
 import unittest
@@ -60,8 +62,10 @@ class TestLibKSCHelper(unittest.TestCase):
             configured = False
             started = False
             nrpe_configured = False
+            assigned_checks = None
+            clusters = {}
 
-        cls.state = FakeStateObject()
+        cls.state_class = FakeStateObject
 
         # Stop unit test from calling fchown
         fchown_patcher = mock.patch("os.fchown")
@@ -95,7 +99,9 @@ class TestLibKSCHelper(unittest.TestCase):
 
     def setUp(self):
         """Prepare test fixture."""
-        self.helper = lib_kubernetes_service_checks.KSCHelper(self.config, self.state)
+        self.helper = lib_kubernetes_service_checks.KSCHelper(
+            self.config, self.state_class()
+        )
 
     def tearDown(self):
         """Clean up test fixture."""
@@ -111,6 +117,7 @@ class TestLibKSCHelper(unittest.TestCase):
         self.assertEqual(self.helper.kubernetes_api_port, "1111")
 
         self.helper.state.kube_api_endpoint = {}
+        self.helper.invalidate()
         self.assertEqual(self.helper.kubernetes_api_address, None)
         self.assertEqual(self.helper.kubernetes_api_port, None)
 
@@ -120,8 +127,29 @@ class TestLibKSCHelper(unittest.TestCase):
         self.assertEqual(self.helper.kubernetes_client_token, "abcdef0123456789")
 
         self.helper.state.kube_control = {}
+        self.helper.invalidate()
         self.assertEqual(self.helper.kubernetes_client_token, None)
 
+    @mock.patch(
+        "lib.lib_kubernetes_service_checks.parse_client_token",
+        wraps=lib_kubernetes_service_checks.parse_client_token,
+    )
+    def test_relation_model(self, mock_parse_client_token):
+        """Test the relation data is parsed once, until it changes."""
+        self.helper.invalidate()
+        for _ in range(3):
+            self.assertEqual(self.helper.kubernetes_client_token, "abcdef0123456789")
+            self.assertEqual(len(self.helper.clusters), 1)
+        mock_parse_client_token.assert_called_once()
+
+        self.helper.state.kube_control = {
+            "creds": '{"u": {"client_token": "new-token"}}'
+        }
+        self.assertEqual(self.helper.kubernetes_client_token, "abcdef0123456789")
+        self.helper.invalidate()
+        self.assertEqual(self.helper.kubernetes_client_token, "new-token")
+        self.assertEqual(mock_parse_client_token.call_count, 2)
+
     @mock.patch("lib.lib_kubernetes_service_checks.subprocess.call")
     def test_update_tls_certificates(self, mock_subprocess):
         """Test that SSL certificates get updated."""
@@ -144,10 +172,341 @@ class TestLibKSCHelper(unittest.TestCase):
         )
         self.assertFalse(self.helper.update_tls_certificates())
 
-    def test_render_checks(self):
+    def test_check_options(self):
+        """Test that check thresholds are passed from the charm config."""
+        self.assertEqual(self.helper.check_options("nodes"), "")
+        self.assertEqual(self.helper.check_options("health"), "")
+        self.helper.config["health_exclude"] = "etcd,informer-sync"
+        self.assertEqual(
+            self.helper.check_options("health"), " --health-exclude etcd,informer-sync"
+        )
+        self.helper.config["health_exclude"] = "etcd; reboot"
+        self.assertEqual(
+            self.helper.check_options("health"), " --health-exclude 'etcd; reboot'"
+        )
+        self.helper.config["health_exclude"] = ""
+        self.assertEqual(
+            self.helper.check_options("events"),
+            " --events-warn-rate 10.0 --events-crit-rate 50.0",
+        )
+
+    @mock.patch("lib.lib_kubernetes_service_checks.NRPE")
+    def test_render_checks(self, mock_nrpe):
         """Test that NPRE is called to add KSC checks."""
-        # TODO
-        pass
+        self.helper.render_checks()
+        shortnames = [
+            call[1]["shortname"]
+            for call in mock_nrpe.return_value.add_check.call_args_list
+        ]
+        self.assertEqual(
+            shortnames,
+            ["k8s_api_{}".format(c) for c in lib_kubernetes_service_checks.ALL_CHECKS],
+        )
+        mock_nrpe.return_value.remove_check.assert_called_once_with(
+            shortname="k8s_api_all"
+        )
+        mock_nrpe.return_value.write.assert_called_once()
+
+        # only the checks assigned to this unit are registered
+        mock_nrpe.reset_mock()
+        self.helper.state.assigned_checks = ["nodes"]
+        self.helper.render_checks()
+        mock_nrpe.return_value.add_check.assert_called_once()
+        self.assertEqual(
+            mock_nrpe.return_value.add_check.call_args[1]["shortname"],
+            "k8s_api_nodes",
+        )
+        mock_nrpe.return_value.remove_check.assert_any_call(shortname="k8s_api_health")
+
+        # the checks of an incomplete cluster are removed
+        mock_nrpe.reset_mock()
+        self.helper.state.assigned_checks = None
+        self.helper.state.clusters = {
+            "k8s-b": {"kube_api_endpoint": {}, "kube_control": {"creds": "{}"}}
+        }
+        self.helper.invalidate()
+        self.helper.render_checks()
+        self.assertEqual(
+            mock_nrpe.return_value.add_check.call_count,
+            len(lib_kubernetes_service_checks.ALL_CHECKS),
+        )
+        mock_nrpe.return_value.remove_check.assert_any_call(
+            shortname="k8s_api_k8s-b_nodes"
+        )
+        mock_nrpe.return_value.remove_check.assert_any_call(
+            shortname="k8s_api_k8s-b_all"
+        )
+
+    @mock.patch("lib.lib_kubernetes_service_checks.NRPE")
+    def test_enabled_checks(self, mock_nrpe):
+        """Test only the enabled checks are registered, the others removed."""
+        default = self.config["options"]["enabled_checks"]["default"]
+        self.assertEqual(
+            self.helper.enabled_checks, lib_kubernetes_service_checks.ALL_CHECKS
+        )
+        self.helper.config["enabled_checks"] = "health nodes cert_expiration"
+        self.addCleanup(self.helper.config.__setitem__, "enabled_checks", default)
+        # parsed once, until the config changes
+        self.assertEqual(
+            self.helper.enabled_checks, lib_kubernetes_service_checks.ALL_CHECKS
+        )
+        self.helper.invalidate_config()
+        self.assertEqual(
+            self.helper.enabled_checks, ["health", "nodes", "cert_expiration"]
+        )
+        self.helper.render_checks()
+        added = [
+            c[1]["shortname"] for c in mock_nrpe.return_value.add_check.call_args_list
+        ]
+        self.assertEqual(
+            added, ["k8s_api_health", "k8s_api_nodes", "k8s_api_cert_expiration"]
+        )
+        mock_nrpe.return_value.remove_check.assert_any_call(
+            shortname="k8s_api_workloads"
+        )
+
+        self.helper.config["enabled_checks"] = "events, skew bogus"
+        self.helper.invalidate_config()
+        self.assertEqual(self.helper.enabled_checks, ["events", "skew"])
+        self.assertEqual(self.helper.unknown_checks, ["bogus"])
+        self.helper.config["check_mode"] = "scheduled"
+        self.addCleanup(self.helper.config.__setitem__, "check_mode", "active")
+        self.assertEqual(
+            [job["name"] for job in self.helper.scheduler_jobs()],
+            ["k8s_api_events", "k8s_api_skew"],
+        )
+
+    @mock.patch("lib.lib_kubernetes_service_checks.NRPE")
+    def test_remove_cluster(self, mock_nrpe):
+        """Test every check of a removed cluster is removed from NRPE."""
+        self.helper.remove_cluster("k8s-b")
+        removed = [
+            call[1]["shortname"]
+            for call in mock_nrpe.return_value.remove_check.call_args_list
+        ]
+        self.assertEqual(
+            removed,
+            [
+                "k8s_api_k8s-b_{}".format(check)
+                for check in lib_kubernetes_service_checks.ALL_CHECKS + ["all"]
+            ],
+        )
+        mock_nrpe.return_value.write.assert_called_once()
+
+    def test_clusters(self):
+        """Test every related cluster gets its own check names."""
+        self.helper.state.clusters = {
+            "k8s-b": {
+                "kube_api_endpoint": {"hostname": "2.2.2.2", "port": "2222"},
+                "kube_control": {"creds": '{"u": {"client_token": "b-token"}}'},
+            },
+            "k8s-incomplete": {"kube_api_endpoint": {}, "kube_control": {}},
+        }
+        clusters = self.helper.clusters
+        self.assertEqual(
+            clusters,
+            [
+                ("", "1.1.1.1", "1111", "abcdef0123456789"),
+                ("k8s-b", "2.2.2.2", "2222", "b-token"),
+            ],
+        )
+        self.assertEqual(
+            lib_kubernetes_service_checks.check_shortname(clusters[0], "health"),
+            "k8s_api_health",
+        )
+        self.assertEqual(
+            lib_kubernetes_service_checks.check_shortname(clusters[1], "health"),
+            "k8s_api_k8s-b_health",
+        )
+        commands = self.helper.check_commands(clusters[1])
+        self.assertIn(
+            "-H 2.2.2.2 -P 2222 -T b-token --check events", commands["events"]
+        )
+        self.assertIn(
+            "--state-dir /var/lib/nagios/kubernetes-service-checks/k8s-b",
+            commands["events"],
+        )
+        self.assertNotIn(
+            "--state-dir", self.helper.check_commands(clusters[0])["events"]
+        )
+
+        # in scheduled mode the nrpe checks read the scheduler results
+        self.helper.config["check_mode"] = "scheduled"
+        self.addCleanup(self.helper.config.__setitem__, "check_mode", "active")
+        commands = self.helper.check_commands(clusters[1])
+        self.assertTrue(
+            commands["nodes"].endswith(
+                "ksc_scheduler.py --config {} --result k8s_api_k8s-b_nodes".format(
+                    lib_kubernetes_service_checks.SCHEDULER_CONFIG
+                )
+            )
+        )
+        jobs = self.helper.scheduler_jobs()
+        # the node checks of each cluster share one job
+        node_checks = lib_kubernetes_service_checks.NODE_CHECKS
+        per_cluster = len(lib_kubernetes_service_checks.PLUGIN_CHECKS)
+        self.assertEqual(len(jobs), 2 * (per_cluster - len(node_checks) + 1))
+        (nodes_job,) = [job for job in jobs if job["name"] == "k8s_api_k8s-b_nodes"]
+        self.assertEqual(sorted(nodes_job["checks"]), sorted(node_checks))
+        self.assertEqual(nodes_job["checks"]["skew"]["name"], "k8s_api_k8s-b_skew")
+        self.assertIn("--checks", nodes_job["argv"])
+        self.assertTrue(nodes_job["backoff"])
+        self.assertEqual(
+            jobs[-1]["name"],
+            "k8s_api_k8s-b_{}".format(lib_kubernetes_service_checks.PLUGIN_CHECKS[-1]),
+        )
+        self.assertEqual(jobs[-1]["argv"][:4], ["-H", "2.2.2.2", "-P", "2222"])
+
+    def test_aggregate_check(self):
+        """Test the aggregated check runs the checks assigned to the unit."""
+        cluster = self.helper.clusters[0]
+        self.assertNotIn("all", self.helper.check_commands(cluster))
+
+        self.helper.config["aggregate_check"] = True
+        self.addCleanup(self.helper.config.__setitem__, "aggregate_check", False)
+        self.helper.state.assigned_checks = ["health", "events", "cert_expiration"]
+        command = self.helper.check_commands(cluster)["all"]
+        self.assertIn("--checks health,events --events-warn-rate 10.0", command)
+        self.assertTrue(self.helper.is_assigned("all"))
+
+    @mock.patch("lib.lib_kubernetes_service_checks.NRPE")
+    def test_aggregate_check_disabled(self, mock_nrpe):
+        """Test the aggregated check is removed once disabled."""
+        nrpe = mock_nrpe.return_value
+        self.helper.config["aggregate_check"] = True
+        self.addCleanup(self.helper.config.__setitem__, "aggregate_check", False)
+        self.helper.render_checks()
+        nrpe.add_check.assert_any_call(
+            shortname="k8s_api_all", description=mock.ANY, check_cmd=mock.ANY
+        )
+        nrpe.remove_check.assert_not_called()
+
+        mock_nrpe.reset_mock()
+        self.helper.config["aggregate_check"] = False
+        self.helper.render_checks()
+        nrpe.remove_check.assert_called_once_with(shortname="k8s_api_all")
+        self.assertNotIn(
+            "k8s_api_all", [c[1]["shortname"] for c in nrpe.add_check.call_args_list]
+        )
+
+        # nor kept when the scheduler runs the checks
+        mock_nrpe.reset_mock()
+        self.helper.config["aggregate_check"] = True
+        self.helper.config["check_mode"] = "scheduled"
+        self.addCleanup(self.helper.config.__setitem__, "check_mode", "active")
+        self.helper.render_checks()
+        nrpe.remove_check.assert_called_once_with(shortname="k8s_api_all")
+
+    @mock.patch("lib.lib_kubernetes_service_checks.subprocess.call")
+    @mock.patch("lib.lib_kubernetes_service_checks.host.service_restart")
+    @mock.patch("lib.lib_kubernetes_service_checks.host.service")
+    @mock.patch("lib.lib_kubernetes_service_checks.host.write_file")
+    def test_render_scheduler(
+        self, mock_write_file, mock_service, mock_restart, mock_call
+    ):
+        """Test the scheduler is only configured in scheduled mode."""
+        self.helper.render_scheduler()
+        mock_write_file.assert_not_called()
+
+        self.helper.config["check_mode"] = "scheduled"
+        self.addCleanup(self.helper.config.__setitem__, "check_mode", "active")
+        self.helper.render_scheduler()
+        path, content = mock_write_file.call_args_list[0][0]
+        self.assertEqual(path, lib_kubernetes_service_checks.SCHEDULER_CONFIG)
+        config = json.loads(content)
+        self.assertEqual(config["interval"], 300)
+        self.assertEqual(config["concurrency"], 4)
+        self.assertEqual((config["min_interval"], config["max_interval"]), (60, 300))
+        nodes = config["jobs"][1]
+        self.assertEqual(
+            (nodes["cluster"], nodes["check"], nodes["backoff"]), ("", "nodes", True)
+        )
+        self.assertEqual(
+            [job["name"] for job in config["jobs"]],
+            [
+                "k8s_api_{}".format(check)
+                for check in lib_kubernetes_service_checks.PLUGIN_CHECKS
+                if check not in lib_kubernetes_service_checks.NODE_CHECKS[1:]
+            ],
+        )
+        mock_service.assert_called_once_with("enable", "ksc-scheduler")
+        mock_restart.assert_called_once_with("ksc-scheduler")
+
+    @mock.patch("lib.lib_kubernetes_service_checks.subprocess.call")
+    @mock.patch("lib.lib_kubernetes_service_checks.host.service")
+    @mock.patch("lib.lib_kubernetes_service_checks.host.service_stop")
+    def test_remove_scheduler(self, mock_stop, mock_service, mock_call):
+        """Test leaving the scheduled mode removes the scheduler files."""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        unit_file = os.path.join(tmp_dir, "ksc-scheduler.service")
+        config = os.path.join(tmp_dir, "scheduler.json")
+        for path in (unit_file, config):
+            open(path, "w").close()
+
+        with mock.patch.multiple(
+            "lib.lib_kubernetes_service_checks",
+            SCHEDULER_UNIT_FILE=unit_file,
+            SCHEDULER_CONFIG=config,
+        ):
+            self.helper.render_scheduler()
+        mock_stop.assert_called_once_with("ksc-scheduler")
+        mock_service.assert_called_once_with("disable", "ksc-scheduler")
+        mock_call.assert_called_once_with(["systemctl", "daemon-reload"])
+        self.assertEqual(os.listdir(tmp_dir), [])
+
+    @mock.patch("lib.lib_kubernetes_service_checks.NRPE")
+    def test_render_passive_checks(self, mock_nrpe):
+        """Test passive mode replaces the nrpe checks by passive services."""
+        self.helper.config["check_mode"] = "passive"
+        self.addCleanup(self.helper.config.__setitem__, "check_mode", "active")
+        nrpe = mock_nrpe.return_value
+        nrpe.hostname = "juju-ksc-0"
+        nrpe.nagios_servicegroups = "juju"
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir)
+        stale = os.path.join(export_dir, "service__juju-ksc-0_passive_old.cfg")
+        open(stale, "w").close()
+
+        with mock.patch(
+            "lib.lib_kubernetes_service_checks.NAGIOS_EXPORT_DIR", export_dir
+        ):
+            self.helper.render_checks()
+
+        added = [c[1]["shortname"] for c in nrpe.add_check.call_args_list]
+        self.assertEqual(added, ["k8s_api_cert_expiration"])
+        self.assertFalse(os.path.exists(stale))
+        with open(
+            os.path.join(export_dir, "service__juju-ksc-0_passive_k8s_api_nodes.cfg")
+        ) as f:
+            service = f.read()
+        self.assertIn("juju-ksc-0[k8s_api_nodes] Check Kubernetes API (nodes)", service)
+        self.assertIn("passive_checks_enabled          1", service)
+        self.assertIn("freshness_threshold             600", service)
+
+        # not written before nrpe-external-master creates the export directory
+        with mock.patch(
+            "lib.lib_kubernetes_service_checks.NAGIOS_EXPORT_DIR",
+            os.path.join(export_dir, "missing"),
+        ):
+            self.helper.render_checks()
+        self.assertFalse(os.path.exists(os.path.join(export_dir, "missing")))
+
+    def test_assign_checks(self):
+        """Test that checks are spread deterministically over the units."""
+        checks = ["health", "nodes", "events"]
+        units = ["ksc/10", "ksc/2"]
+        expected = {"ksc/2": ["health", "events"], "ksc/10": ["nodes"]}
+        self.assertEqual(
+            lib_kubernetes_service_checks.assign_checks(checks, units), expected
+        )
+        self.assertEqual(
+            lib_kubernetes_service_checks.assign_checks(checks, units[::-1]), expected
+        )
+        self.assertEqual(
+            lib_kubernetes_service_checks.assign_checks(checks, ["ksc/0"]),
+            {"ksc/0": checks},
+        )
 
     @mock.patch("charmhelpers.fetch.snap.subprocess.check_call")
     def test_install_kubectl(self, mock_snap_subprocess):
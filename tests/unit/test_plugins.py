@@ -1,14 +1,59 @@
 """Unit tests for Kubernetes Service Checks NRPE Plugins."""
+import base64
+import concurrent.futures
+import functools
+import json
+import os
+import tempfile
+import time
 import unittest
 
 import check_kubernetes_api
 
+import ksc_scheduler
+
 import mock
 
 
+# self-signed certificates, the first expiring 2026-11-18 13:03:00 (UTCTime),
+# the second 2136-04-25 13:03:06 (GeneralizedTime)
+CERT_2026 = (
+    "-----BEGIN CERTIFICATE-----\n"
+    "MIIBezCCASGgAwIBAgIUNuSi8YB4aj3tOLRYclGadSDUe3QwCgYIKoZIzj0EAwIw\n"
+    "EzERMA8GA1UEAwwIa3NjLXRlc3QwHhcNMjYxMDE5MTMwMzAwWhcNMjYxMTE4MTMw\n"
+    "MzAwWjATMREwDwYDVQQDDAhrc2MtdGVzdDBZMBMGByqGSM49AgEGCCqGSM49AwEH\n"
+    "A0IABC171eOL/6yTEWVOK0gtOnmvnsKM7+BE8IYWwNqC+st+sQFrZtH2uc2Erdjy\n"
+    "KismpkYaBf44Aq6Ds+uoNUOjqNWjUzBRMB0GA1UdDgQWBBQSX0r833IljGOj1//A\n"
+    "HJfJUUM95jAfBgNVHSMEGDAWgBQSX0r833IljGOj1//AHJfJUUM95jAPBgNVHRMB\n"
+    "Af8EBTADAQH/MAoGCCqGSM49BAMCA0gAMEUCIHR7vn74PQ7M/GvqtVtTNWOEQk0L\n"
+    "V4a1NeRCFjTDwIjmAiEA20Q14ycD+nR0CzWBzotAx5TWBdJQa9yTLyG3nJKwObY=\n"
+    "-----END CERTIFICATE-----\n"
+)
+CERT_2136 = (
+    "-----BEGIN CERTIFICATE-----\n"
+    "MIIBeDCCAR+gAwIBAgIUC7ek9CshcaOboptxbig89uLOFe4wCgYIKoZIzj0EAwIw\n"
+    "ETEPMA0GA1UEAwwGa3NjLWNhMCAXDTI2MTAxOTEzMDMwNloYDzIxMzYwNDI1MTMw\n"
+    "MzA2WjARMQ8wDQYDVQQDDAZrc2MtY2EwWTATBgcqhkjOPQIBBggqhkjOPQMBBwNC\n"
+    "AAT+mV1aawK7gb79i9FcNSGm6BHI19jT5ShQYhLjJ1gEOuhJ4Klvo0SqYni6slKw\n"
+    "9PcPCF6SgXeKo9+91XYAM7QKo1MwUTAdBgNVHQ4EFgQU7Hi427EEE/OCos556PYk\n"
+    "yPD4v5IwHwYDVR0jBBgwFoAU7Hi427EEE/OCos556PYkyPD4v5IwDwYDVR0TAQH/\n"
+    "BAUwAwEB/zAKBggqhkjOPQQDAgNHADBEAiAukJRtNIUxuFu4+ajMZoT5UNGyKesC\n"
+    "VEa68A9prInSngIgEt7FYWbLE/bBYMEFVkF4wVBEvbl2pSDeu0C7aTVWzO4=\n"
+    "-----END CERTIFICATE-----\n"
+)
+
+
 class TestKSCPlugins(unittest.TestCase):
     """Test cases for Kubernetes Service Checks NRPE plugins."""
 
+    def setUp(self):
+        """Keep the state of the checks run from the command line apart."""
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        patcher = mock.patch("check_kubernetes_api.STATE_DIR", state_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch("check_kubernetes_api.sys.exit")
     @mock.patch("check_kubernetes_api.print")
     def test_nagios_exit(self, mock_print, mock_sys_exit):
@@ -57,7 +102,7 @@ class TestKSCPlugins(unittest.TestCase):
         self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
         mock_http_pool_manager.return_value.request.assert_called_once_with(
             "GET",
-            "{}/healthz".format(host_address),
+            "{}/readyz?verbose".format(host_address),
             headers={"Authorization": "Bearer {}".format(token)},
         )
 
@@ -74,3 +119,1483 @@ class TestKSCPlugins(unittest.TestCase):
             host_address, token, ssl_ca
         )
         self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_health_components(self, mock_http_pool_manager):
+        """Test kubernetes health reports each failing readyz component."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        response = mock_http_pool_manager.return_value.request.return_value
+
+        response.status = 200
+        response.data = b"[+]ping ok\n[+]etcd ok\nreadyz check passed\n"
+        status, message = check_kubernetes_api.check_kubernetes_health(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(message, "Kubernetes readyz 'ok' (2 checks passed)")
+
+        response.status = 500
+        response.data = (
+            b"[+]ping ok\n"
+            b"[-]etcd failed: reason withheld\n"
+            b"[-]poststarthook/rbac/bootstrap-roles failed: reason withheld\n"
+            b"readyz check failed\n"
+        )
+        status, message = check_kubernetes_api.check_kubernetes_health(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "Kubernetes readyz failed: etcd (CRITICAL), "
+            "poststarthook/rbac/bootstrap-roles (WARNING)",
+        )
+
+        status, message = check_kubernetes_api.check_kubernetes_health(
+            host_address, token, True, exclude=["etcd"]
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertNotIn("etcd", message)
+
+        status, _ = check_kubernetes_api.check_kubernetes_health(
+            host_address, token, True, endpoint="livez", exclude=["etcd"]
+        )
+        mock_http_pool_manager.return_value.request.assert_called_with(
+            "GET",
+            "{}/livez?verbose".format(host_address),
+            headers={"Authorization": "Bearer {}".format(token)},
+        )
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_workloads(self, mock_http_pool_manager):
+        """Test the workloads rollout check."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        pages = {
+            "deployments": [
+                {
+                    "metadata": {"namespace": "default", "name": "web"},
+                    "spec": {"replicas": 3},
+                    "status": {
+                        "readyReplicas": 3,
+                        "updatedReplicas": 3,
+                        "availableReplicas": 3,
+                    },
+                }
+            ],
+            "statefulsets": [],
+            "daemonsets": [
+                {
+                    "metadata": {"namespace": "kube-system", "name": "proxy"},
+                    "spec": {},
+                    "status": {
+                        "desiredNumberScheduled": 3,
+                        "numberReady": 3,
+                        "updatedNumberScheduled": 3,
+                        "numberAvailable": 3,
+                    },
+                }
+            ],
+        }
+
+        def list_response(method, url, fields, headers):
+            resource = url.rsplit("/", 1)[-1]
+            self.assertEqual(fields["limit"], check_kubernetes_api.LIST_PAGE_LIMIT)
+            return mock.MagicMock(
+                status=200,
+                data=json.dumps({"metadata": {}, "items": pages[resource]}).encode(),
+            )
+
+        mock_http_pool_manager.return_value.request.side_effect = list_response
+        status, message = check_kubernetes_api.check_kubernetes_workloads(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(message, "All 2 workloads at spec | workloads=2 degraded=0")
+
+        # a rollout that is behind spec is a warning
+        pages["daemonsets"][0]["status"]["updatedNumberScheduled"] = 1
+        status, message = check_kubernetes_api.check_kubernetes_workloads(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertIn("(kube-system: 1): DaemonSet kube-system/proxy", message)
+
+        # a spec not yet observed by the controller is in progress, a warning
+        pages["deployments"][0]["metadata"]["generation"] = 2
+        pages["deployments"][0]["status"]["observedGeneration"] = 1
+        status, message = check_kubernetes_api.check_kubernetes_workloads(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertIn("Deployment default/web", message)
+
+        # a rollout past its progress deadline is critical
+        pages["deployments"][0]["status"]["conditions"] = [
+            {"type": "Progressing", "reason": "ProgressDeadlineExceeded"}
+        ]
+        status, message = check_kubernetes_api.check_kubernetes_workloads(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertIn("2 of 2 workloads degraded (default: 1, kube-system: 1)", message)
+
+        # beyond `listed`, the degraded workloads are only counted
+        status, message = check_kubernetes_api.check_kubernetes_workloads(
+            host_address, token, True, listed=1
+        )
+        self.assertIn("kube-system: 1): Deployment default/web, ... |", message)
+
+        mock_http_pool_manager.return_value.request.side_effect = None
+        mock_http_pool_manager.return_value.request.return_value.status = 403
+        status, _ = check_kubernetes_api.check_kubernetes_workloads(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_events(self, mock_http_pool_manager):
+        """Test the incremental Warning events check."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        request = mock_http_pool_manager.return_value.request
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+
+        # first run only records the current resourceVersion
+        request.return_value.status = 200
+        request.return_value.data = b'{"metadata": {"resourceVersion": "100"}}'
+        status, _ = check_kubernetes_api.check_kubernetes_events(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+
+        # next run watches only the events newer than the bookmark
+        watch_events = [
+            {
+                "type": "ADDED",
+                "object": {
+                    "metadata": {"resourceVersion": str(101 + i)},
+                    "reason": "BackOff",
+                    "involvedObject": {
+                        "kind": "Pod",
+                        "namespace": "default",
+                        "name": "web",
+                    },
+                },
+            }
+            for i in range(12)
+        ]
+        watch_events.append(
+            {"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": "150"}}}
+        )
+        body = "\n".join(json.dumps(event) for event in watch_events).encode()
+        request.return_value.stream.return_value = [body[:100], body[100:]]
+        status, message = check_kubernetes_api.check_kubernetes_events(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertEqual(request.call_args[1]["fields"]["resourceVersion"], "100")
+        self.assertIn("12 new Warning events", message)
+        self.assertIn("reasons: BackOff: 12; objects: Pod default/web: 12", message)
+        state = check_kubernetes_api.load_state(state_dir.name, "events")
+        self.assertEqual(state["resourceVersion"], "150")
+
+        # an expired resourceVersion is replaced in the same run
+        request.return_value.stream.return_value = [
+            b'{"type": "ERROR", "object": {"code": 410, "message": "too old"}}\n'
+        ]
+        request.return_value.data = b'{"metadata": {"resourceVersion": "900"}}'
+        status, message = check_kubernetes_api.check_kubernetes_events(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertIn("resynced", message)
+        self.assertEqual(request.call_args[1]["fields"]["limit"], 1)
+        state = check_kubernetes_api.load_state(state_dir.name, "events")
+        self.assertEqual(state["resourceVersion"], "900")
+
+        # other errors keep the bookmark for the next run
+        request.return_value.stream.return_value = [
+            b'{"type": "ERROR", "object": {"code": 500, "message": "boom"}}\n'
+        ]
+        status, _ = check_kubernetes_api.check_kubernetes_events(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_UNKNOWN)
+        state = check_kubernetes_api.load_state(state_dir.name, "events")
+        self.assertEqual(state["resourceVersion"], "900")
+
+    def test_histogram_quantile(self):
+        """Test p99 estimation from cumulative histogram buckets."""
+        buckets = {"0.1": 50.0, "0.5": 90.0, "1": 100.0, "+Inf": 100.0}
+        self.assertAlmostEqual(
+            check_kubernetes_api.histogram_quantile(0.99, buckets), 0.95
+        )
+        self.assertIsNone(check_kubernetes_api.histogram_quantile(0.99, {}))
+        self.assertEqual(
+            check_kubernetes_api.histogram_quantile(0.99, {"1": 0.0, "+Inf": 5.0}),
+            1.0,
+        )
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_metrics(self, mock_http_pool_manager):
+        """Test the apiserver metrics check compares bucket deltas."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        response = mock_http_pool_manager.return_value.request.return_value
+        response.status = 200
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+
+        def metrics_body(slow, rejected):
+            bucket = (
+                'apiserver_request_duration_seconds_bucket{{resource="{}",'
+                'verb="LIST",le="{}"}} {}'
+            )
+            lines = ["# HELP apiserver_request_duration_seconds Response latency"]
+            for resource in ("pods", "nodes"):
+                lines += [
+                    bucket.format(resource, "0.1", 100),
+                    bucket.format(resource, "2", 100 + slow),
+                    bucket.format(resource, "+Inf", 100 + slow),
+                ]
+            lines += [
+                'etcd_request_duration_seconds_bucket{operation="get",le="0.1"} 10',
+                'etcd_request_duration_seconds_bucket{operation="get",le="+Inf"} 10',
+                'apiserver_current_inflight_requests{request_kind="readOnly"} 3',
+                'apiserver_current_inflight_requests{request_kind="mutating"} 1',
+                'apiserver_flowcontrol_rejected_requests_total{{reason="x"}} {}'.format(
+                    rejected
+                ),
+                'apiserver_storage_objects{resource="pods"} 1234',
+            ]
+            body = "\n".join(lines).encode()
+            return [body[:64], body[64:]]
+
+        response.stream.return_value = metrics_body(0, 0)
+        status, message = check_kubernetes_api.check_kubernetes_metrics(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(message, "Metrics baseline recorded")
+
+        # only the requests since the previous run count towards p99
+        response.stream.return_value = metrics_body(50, 0)
+        status, message = check_kubernetes_api.check_kubernetes_metrics(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertIn("apiserver p99 1.981s (LIST)", message)
+        self.assertIn("4 inflight requests, 0 APF rejected requests", message)
+
+        response.stream.return_value = metrics_body(50, 2)
+        status, message = check_kubernetes_api.check_kubernetes_metrics(
+            host_address, token, True, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertIn("apiserver p99 0.000s (n/a)", message)
+        self.assertIn("2 APF rejected requests", message)
+
+        # the streamed scrape is timed as its request and parse phases
+        with check_kubernetes_api.CheckEngine(True, timings=True) as engine:
+            result = engine.run_checks(
+                {
+                    "metrics": functools.partial(
+                        check_kubernetes_api.check_kubernetes_metrics,
+                        host_address,
+                        token,
+                        True,
+                        state_dir=state_dir.name,
+                        engine=engine,
+                    )
+                }
+            )["metrics"]
+        _, perfdata = check_kubernetes_api.split_perfdata(result.message)
+        self.assertIn("time_request", perfdata)
+        self.assertIn("time_parse", perfdata)
+
+    def test_parse_quantity(self):
+        """Test Kubernetes resource quantities parsing."""
+        self.assertEqual(check_kubernetes_api.parse_quantity("250m"), 0.25)
+        self.assertEqual(check_kubernetes_api.parse_quantity("2"), 2.0)
+        self.assertEqual(check_kubernetes_api.parse_quantity("2Gi"), 2 * 2**30)
+        self.assertEqual(check_kubernetes_api.parse_quantity("1e3"), 1000.0)
+        self.assertEqual(check_kubernetes_api.parse_quantity("1E"), 1e18)
+        self.assertAlmostEqual(check_kubernetes_api.parse_quantity("5000n"), 5e-6)
+        self.assertRaises(ValueError, check_kubernetes_api.parse_quantity, "2Xi")
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_utilisation(self, mock_http_pool_manager):
+        """Test the nodes utilisation check."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        nodes = {
+            "nodes": [
+                {
+                    "metadata": {"name": "node-{}".format(i)},
+                    "status": {"allocatable": {"cpu": "4", "memory": "8Gi"}},
+                }
+                for i in range(3)
+            ],
+            "metrics.k8s.io/v1beta1/nodes": [
+                {
+                    "metadata": {"name": "node-{}".format(i)},
+                    "usage": {"cpu": "{}m".format(1000 * i), "memory": memory},
+                }
+                for i, memory in enumerate(["1Gi", "2Gi", "7800Mi"])
+            ],
+        }
+
+        def list_response(method, url, fields, headers):
+            resource = "metrics.k8s.io/v1beta1/nodes" if "metrics" in url else "nodes"
+            return mock.MagicMock(
+                status=200,
+                data=json.dumps({"metadata": {}, "items": nodes[resource]}).encode(),
+            )
+
+        mock_http_pool_manager.return_value.request.side_effect = list_response
+        status, message = check_kubernetes_api.check_kubernetes_utilisation(
+            host_address, token, True, top=1
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "Node utilisation cpu p50 25% p90 50% max 50%, "
+            "memory p50 25% p90 95% max 95%; "
+            "most utilised: node-2 (cpu 50%, memory 95%) "
+            "| cpu_max=50.0%;85;95 memory_max=95.2%;85;95",
+        )
+
+        status, _ = check_kubernetes_api.check_kubernetes_utilisation(
+            host_address, token, True, warn=90, crit=99
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+
+        # a node gone from the node list, or with nothing allocatable, is left
+        # out without shifting the usage of the nodes after it
+        nodes["metrics.k8s.io/v1beta1/nodes"].insert(
+            0,
+            {
+                "metadata": {"name": "gone"},
+                "usage": {"cpu": "4", "memory": "8Gi"},
+            },
+        )
+        nodes["nodes"][2]["status"]["allocatable"] = {"cpu": "0", "memory": "0"}
+        status, message = check_kubernetes_api.check_kubernetes_utilisation(
+            host_address, token, True, top=1
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertIn("most utilised: node-1 (cpu 25%, memory 25%)", message)
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_services(self, mock_http_pool_manager):
+        """Test Services are joined to their EndpointSlices."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+
+        def service(namespace, name, **spec):
+            return {
+                "metadata": {"namespace": namespace, "name": name},
+                "spec": dict({"selector": {"app": name}}, **spec),
+            }
+
+        def endpoint_slice(namespace, service, *ready):
+            return {
+                "metadata": {
+                    "namespace": namespace,
+                    "labels": {"kubernetes.io/service-name": service},
+                },
+                "endpoints": [{"conditions": {"ready": r}} for r in ready],
+            }
+
+        resources = {
+            "services": [
+                service("default", "web"),
+                service("default", "api"),
+                service("kube-system", "kube-dns"),
+                service("default", "external", type="ExternalName"),
+                service("default", "manual", selector=None),
+                service("test", "skipped"),
+            ],
+            "endpointslices": [
+                endpoint_slice("default", "web", False, None),
+                endpoint_slice("default", "api", False),
+                endpoint_slice("kube-system", "kube-dns", False),
+                endpoint_slice("kube-system", "kube-dns", False),
+            ],
+        }
+
+        def list_response(method, url, fields, headers):
+            resource = url.rsplit("/", 1)[-1]
+            if resource == "endpointslices":
+                self.assertEqual(fields["labelSelector"], "kubernetes.io/service-name")
+            return mock.MagicMock(
+                status=200,
+                data=json.dumps(
+                    {"metadata": {}, "items": resources[resource]}
+                ).encode(),
+            )
+
+        mock_http_pool_manager.return_value.request.side_effect = list_response
+        status, message = check_kubernetes_api.check_kubernetes_services(
+            host_address, token, True, exclude_namespaces=["test"]
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertEqual(
+            message,
+            "2 of 3 services without ready endpoints (default: 1, kube-system: 1): "
+            "default/api, kube-system/kube-dns | services=3 no_endpoints=2",
+        )
+
+        status, message = check_kubernetes_api.check_kubernetes_services(
+            host_address, token, True, critical=["kube-system/kube-dns"]
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertIn("): kube-system/kube-dns, default/api, test/skipped |", message)
+
+        resources["endpointslices"][1]["endpoints"][0]["conditions"] = {}
+        status, message = check_kubernetes_api.check_kubernetes_services(
+            host_address, token, True, namespaces=["default"]
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(
+            message,
+            "All 2 services have ready endpoints | services=2 no_endpoints=0",
+        )
+
+    @mock.patch("check_kubernetes_api.time.time")
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_storage(self, mock_http_pool_manager, mock_time):
+        """Test claims are joined to their volumes and grouped by StorageClass."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        mock_time.return_value = check_kubernetes_api.parse_timestamp(
+            "2024-01-01T01:00:00Z"
+        )
+
+        def claim(name, phase, volume=None, created="2024-01-01T00:00:00Z"):
+            return {
+                "metadata": {
+                    "namespace": "default",
+                    "name": name,
+                    "creationTimestamp": created,
+                },
+                "spec": {"volumeName": volume, "storageClassName": "fast"},
+                "status": {"phase": phase},
+            }
+
+        def volume(name, phase, storage_class="fast"):
+            return {
+                "metadata": {"name": name},
+                "spec": {"storageClassName": storage_class},
+                "status": {"phase": phase},
+            }
+
+        resources = {
+            "persistentvolumeclaims": [
+                claim("data", "Bound", "pv-1"),
+                claim("new", "Pending", created="2024-01-01T00:59:00Z"),
+            ],
+            "persistentvolumes": [volume("pv-1", "Bound")],
+        }
+
+        def list_response(method, url, fields, headers):
+            return mock.MagicMock(
+                status=200,
+                data=json.dumps(
+                    {"metadata": {}, "items": resources[url.rsplit("/", 1)[-1]]}
+                ).encode(),
+            )
+
+        mock_http_pool_manager.return_value.request.side_effect = list_response
+        status, message = check_kubernetes_api.check_kubernetes_storage(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(
+            message, "All 2 claims and 1 volumes bound | claims=2 volumes=1 problems=0"
+        )
+
+        resources["persistentvolumeclaims"].append(claim("stuck", "Pending"))
+        resources["persistentvolumes"].append(volume("pv-2", "Released", "slow"))
+        status, message = check_kubernetes_api.check_kubernetes_storage(
+            host_address, token, True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertEqual(
+            message,
+            "Storage problems: fast: 1 pending claims; slow: 1 released volumes "
+            "| claims=3 volumes=2 problems=2",
+        )
+
+        # a bound claim whose volume disappeared is lost
+        resources["persistentvolumes"][0]["status"]["phase"] = "Failed"
+        resources["persistentvolumeclaims"].append(claim("gone", "Bound", "pv-3"))
+        status, message = check_kubernetes_api.check_kubernetes_storage(
+            host_address, token, True, pending_age=7200
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertIn("fast: 1 failed volumes, 1 lost claims;", message)
+
+    @mock.patch("check_kubernetes_api.time.time")
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_leases(self, mock_http_pool_manager, mock_time):
+        """Test node Leases alert on the age of their last renewal."""
+        host_address = "https://1.1.1.1:1111"
+        mock_time.return_value = check_kubernetes_api.parse_timestamp(
+            "2024-01-01T00:01:00Z"
+        )
+        leases = [
+            {
+                "metadata": {"name": "node-a"},
+                "spec": {"renewTime": "2024-01-01T00:00:55.123456Z"},
+            },
+        ]
+        mock_http_pool_manager.return_value.request.side_effect = (
+            lambda method, url, fields, headers: mock.MagicMock(
+                status=200,
+                data=json.dumps({"metadata": {}, "items": leases}).encode(),
+            )
+        )
+        status, message = check_kubernetes_api.check_kubernetes_leases(
+            host_address, "token", True
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(
+            message,
+            "All 1 node Leases renewed within 20s | leases=1 stale=0 max_age=5s;20;40",
+        )
+        url = mock_http_pool_manager.return_value.request.call_args[0][1]
+        self.assertTrue(url.endswith("/namespaces/kube-node-lease/leases"))
+
+        leases += [
+            {
+                "metadata": {"name": "node-b"},
+                "spec": {"renewTime": "2024-01-01T00:00:30.000000Z"},
+            },
+            {"metadata": {"name": "node-c"}, "spec": {}},
+        ]
+        status, message = check_kubernetes_api.check_kubernetes_leases(
+            host_address, "token", True, listed=1
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "2 of 3 node Leases not renewed for 20s: node-c (never), ... "
+            "| leases=3 stale=2 max_age=30s;20;40",
+        )
+
+        leases.pop()
+        status, message = check_kubernetes_api.check_kubernetes_leases(
+            host_address, "token", True, warn=20, crit=3600
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertIn("not renewed for 20s: node-b (30s) |", message)
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_skew(self, mock_http_pool_manager):
+        """Test kubelet versions are checked from the shared node list."""
+        nodes = [
+            {
+                "metadata": {"name": name},
+                "status": {
+                    "conditions": [{"type": "Ready", "status": "True"}],
+                    "nodeInfo": {"kubeletVersion": kubelet},
+                },
+            }
+            for name, kubelet in (
+                ("node-a", "v1.29.1"),
+                ("node-b", "v1.28.5"),
+                ("node-c", "v1.28.5"),
+            )
+        ]
+        urls = []
+
+        def response(method, url, fields=None, headers=None, **kwargs):
+            urls.append(url)
+            if url.endswith("/version"):
+                body = {"gitVersion": "v1.29.1"}
+            else:
+                body = {"metadata": {}, "items": nodes}
+            return mock.MagicMock(status=200, data=json.dumps(body).encode())
+
+        mock_http_pool_manager.return_value.request.side_effect = response
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        args = check_kubernetes_api.build_parser().parse_args(
+            [
+                "-H",
+                "1.1.1.1",
+                "-P",
+                "1111",
+                "--checks",
+                "nodes,skew",
+                "--state-dir",
+                state_dir.name,
+            ]
+        )
+        status, message = check_kubernetes_api.run_check(args)
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertIn(
+            "[OK] skew: apiserver v1.29.1, kubelets v1.28.5: 2, v1.29.1: 1", message
+        )
+        # the node list is shared with the nodes check
+        self.assertEqual(
+            sorted(urls),
+            ["https://1.1.1.1:1111/api/v1/nodes", "https://1.1.1.1:1111/version"],
+        )
+
+        # run apart, it reuses the kubelet versions saved by the nodes check
+        del urls[:]
+        status, _ = check_kubernetes_api.check_kubernetes_skew(
+            "https://1.1.1.1:1111", "token", False, state_dir=state_dir.name
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(urls, ["https://1.1.1.1:1111/version"])
+
+        # and lists the nodes once they are too old
+        nodes[0]["status"]["nodeInfo"]["kubeletVersion"] = "v1.30.0"
+        nodes[1]["status"]["nodeInfo"]["kubeletVersion"] = "v1.25.9"
+        status, message = check_kubernetes_api.check_kubernetes_skew(
+            "https://1.1.1.1:1111", "token", False, state_dir=state_dir.name, max_age=0
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "apiserver v1.29.1, kubelets v1.30.0: 1, v1.25.9: 1, v1.28.5: 1; "
+            "2 nodes outside the supported skew: node-a (v1.30.0), node-b (v1.25.9) "
+            "| nodes=3 versions=3 skewed=2",
+        )
+
+    def test_pem_not_after(self):
+        """Test the expiry of a PEM bundle is read from its DER certificates."""
+        self.assertEqual(
+            check_kubernetes_api.pem_not_after(CERT_2136.encode()), 5248414986
+        )
+        self.assertEqual(
+            check_kubernetes_api.pem_not_after((CERT_2136 + CERT_2026).encode()),
+            check_kubernetes_api.parse_timestamp("2026-11-18T13:03:00Z"),
+        )
+        self.assertRaises(ValueError, check_kubernetes_api.pem_not_after, b"junk")
+        self.assertRaises(
+            ValueError,
+            check_kubernetes_api.pem_not_after,
+            CERT_2026[:100].encode() + b"\n-----END CERTIFICATE-----",
+        )
+
+    @mock.patch("check_kubernetes_api.time.time")
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_certificates(self, mock_http_pool_manager, mock_time):
+        """Test pending CSRs and TLS Secrets expiry, decoded once per version."""
+        mock_time.return_value = check_kubernetes_api.parse_timestamp(
+            "2026-11-08T13:03:00Z"
+        )
+        csrs = [
+            {
+                "metadata": {"name": name, "creationTimestamp": created},
+                "spec": {"signerName": "kubernetes.io/kubelet-serving"},
+                "status": status,
+            }
+            for name, created, status in (
+                ("csr-old", "2026-11-08T10:00:00Z", {}),
+                ("csr-new", "2026-11-08T13:00:00Z", {}),
+                (
+                    "csr-done",
+                    "2026-11-01T00:00:00Z",
+                    {"conditions": [{"type": "Approved"}]},
+                ),
+            )
+        ]
+
+        def secret(name, crt, version="1"):
+            return {
+                "metadata": {"name": name, "resourceVersion": version},
+                "data": {"tls.crt": base64.b64encode(crt.encode()).decode()},
+            }
+
+        secrets = [
+            secret("ca", CERT_2136),
+            secret("serving", CERT_2026),
+            secret("broken", "junk"),
+        ]
+
+        def list_response(method, url, fields, headers):
+            if url.endswith("/secrets"):
+                self.assertEqual(fields["fieldSelector"], "type=kubernetes.io/tls")
+                self.assertIn("/namespaces/kube-system/", url)
+            items = secrets if url.endswith("/secrets") else csrs
+            return mock.MagicMock(
+                status=200, data=json.dumps({"metadata": {}, "items": items}).encode()
+            )
+
+        mock_http_pool_manager.return_value.request.side_effect = list_response
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        check = functools.partial(
+            check_kubernetes_api.check_kubernetes_certificates,
+            "https://1.1.1.1:1111",
+            "token",
+            False,
+            state_dir=state_dir.name,
+        )
+        status, message = check()
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "1 CSRs pending over 3600s: csr-old (kubernetes.io/kubelet-serving); "
+            "1 TLS certificates expire within 60 days: kube-system/serving (10 days); "
+            "1 TLS Secrets without a readable certificate: kube-system/broken "
+            "| csrs_pending=1 certificates=2 expiring=1 min_days=10",
+        )
+
+        # unchanged Secrets are not decoded again
+        with mock.patch(
+            "check_kubernetes_api.pem_not_after",
+            wraps=check_kubernetes_api.pem_not_after,
+        ) as mock_pem_not_after:
+            secrets[:] = [secret("ca", CERT_2136), secret("serving", CERT_2136, "2")]
+            status, message = check(csr_age=86400)
+            self.assertEqual(mock_pem_not_after.call_count, 1)
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertEqual(
+            message,
+            "No CSR pending over 86400s; soonest TLS certificate expiry "
+            "kube-system/ca in 39980 days "
+            "| csrs_pending=0 certificates=2 expiring=0 min_days=39980",
+        )
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_quotas(self, mock_http_pool_manager):
+        """Test ResourceQuota usage ratios and memoised quantity parsing."""
+        host_address = "https://1.1.1.1:1111"
+        token = "0123456789abcdef"
+        quotas = [
+            {
+                "metadata": {"namespace": "team-{}".format(i), "name": "compute"},
+                "status": {
+                    "hard": {
+                        "requests.cpu": "2",
+                        "requests.memory": "4Gi",
+                        "pods": "0",
+                    },
+                    "used": {"requests.cpu": cpu, "requests.memory": "1Gi"},
+                },
+            }
+            for i, cpu in enumerate(["500m", "1700m", "1950m"])
+        ]
+        mock_http_pool_manager.return_value.request.return_value = mock.MagicMock(
+            status=200, data=json.dumps({"metadata": {}, "items": quotas}).encode()
+        )
+        check_kubernetes_api.parse_quantity.cache_clear()
+        status, message = check_kubernetes_api.check_kubernetes_quotas(
+            host_address, token, True, top=1
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "2 quota resources above 80% (team-1: 1, team-2: 1); "
+            "most saturated: team-2/compute requests.cpu 98% "
+            "| quotas=6 saturated=2 max=97.5%;80;95",
+        )
+        # the limits shared by the quotas are only parsed once
+        self.assertGreaterEqual(
+            check_kubernetes_api.parse_quantity.cache_info().hits, 6
+        )
+
+        status, message = check_kubernetes_api.check_kubernetes_quotas(
+            host_address, token, True, warn=98, crit=99
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_OK)
+        self.assertTrue(message.startswith("All 6 quota resources below 98%"))
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_capacity(self, mock_http_pool_manager):
+        """Test pod requests against allocatable, sharing the node list."""
+        nodes = [
+            {
+                "metadata": {"name": "node-{}".format(i)},
+                "status": {
+                    "allocatable": {"cpu": "4", "memory": "8Gi"},
+                    "conditions": [{"type": "Ready", "status": "True"}],
+                },
+            }
+            for i in range(3)
+        ]
+
+        def pod(node, cpu, memory="1Gi", init_cpu="0"):
+            return {
+                "spec": {
+                    "nodeName": node,
+                    "containers": [
+                        {"resources": {"requests": {"cpu": cpu, "memory": memory}}},
+                        {"resources": {}},
+                    ],
+                    "initContainers": [{"resources": {"requests": {"cpu": init_cpu}}}],
+                }
+            }
+
+        pods = [
+            pod("node-0", "3900m", init_cpu="1"),
+            pod("node-1", "500m", init_cpu="2"),
+            pod(None, "4"),
+        ]
+
+        def list_response(method, url, fields, headers, **kwargs):
+            if url.endswith("/pods"):
+                self.assertEqual(
+                    fields["fieldSelector"],
+                    "status.phase!=Succeeded,status.phase!=Failed",
+                )
+            items = pods if url.endswith("/pods") else nodes
+            return mock.MagicMock(
+                status=200, data=json.dumps({"metadata": {}, "items": items}).encode()
+            )
+
+        mock_http_pool_manager.return_value.request.side_effect = list_response
+        args = check_kubernetes_api.build_parser().parse_args(
+            ["-H", "1.1.1.1", "-P", "1111", "--checks", "nodes,capacity"]
+        )
+        status, message = check_kubernetes_api.run_check(args)
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_WARNING)
+        self.assertIn(
+            "[WARNING] capacity: Requested cpu 49% memory 8% of allocatable, "
+            "1 nodes above 85%: node-0 (cpu 98%, memory 12%)",
+            message,
+        )
+        self.assertIn("[OK] nodes: All Nodes Ready", message)
+        # the node list is fetched once for both checks
+        urls = [
+            c[0][1] for c in mock_http_pool_manager.return_value.request.call_args_list
+        ]
+        self.assertEqual(urls.count("https://1.1.1.1:1111/api/v1/nodes"), 1)
+
+        status, _ = check_kubernetes_api.check_kubernetes_capacity(
+            "https://1.1.1.1:1111", "token", True, warn=40, crit=45
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+
+    def test_map_pages(self):
+        """Test list pages parsed on worker processes match in-process parsing."""
+        pages = [
+            {
+                "kind": "PodList",
+                "metadata": {"continue": str(page + 1) if page < 4 else ""},
+                "items": [
+                    {
+                        "spec": {
+                            "nodeName": "node-{}".format(i % 3),
+                            "containers": [
+                                {"resources": {"requests": {"cpu": "100m"}}}
+                            ],
+                        }
+                    }
+                    for i in range(10)
+                ],
+            }
+            for page in range(5)
+        ]
+        http = mock.MagicMock()
+        http.request.side_effect = lambda method, url, fields, headers: mock.MagicMock(
+            status=200,
+            data=json.dumps(pages[int(fields.get("continue", 0))]).encode(),
+        )
+        results = []
+        for processes in (0, 2):
+            with check_kubernetes_api.CheckEngine(False, processes=processes) as engine:
+                names, cpu, memory = check_kubernetes_api._requested_per_node(
+                    http, "https://1.1.1.1:1111", "token", engine
+                )
+            results.append((names, [round(c, 6) for c in cpu], list(memory)))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(
+            results[0], (["node-0", "node-1", "node-2"], [2.0, 1.5, 1.5], [0.0] * 3)
+        )
+        self.assertEqual(http.request.call_count, 10)
+
+    def test_aggregate_results(self):
+        """Test child results are combined check_multi style."""
+        status, message = check_kubernetes_api.aggregate_results(
+            [
+                ("health", 0, "Kubernetes readyz 'ok'"),
+                ("nodes", 2, "Nodes NotReady: a | nodes=3 not_ready=1"),
+                ("events", 1, "12 new Warning events | events=12"),
+            ]
+        )
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message.split("\n"),
+            [
+                "3 checks, 1 critical, 1 warning, 0 unknown, 1 ok "
+                "| nodes::nodes=3 nodes::not_ready=1 events::events=12",
+                "[OK] health: Kubernetes readyz 'ok'",
+                "[CRITICAL] nodes: Nodes NotReady: a",
+                "[WARNING] events: 12 new Warning events",
+            ],
+        )
+        self.assertEqual(
+            check_kubernetes_api.worst_status([0, 3, 1]),
+            check_kubernetes_api.NAGIOS_STATUS_WARNING,
+        )
+
+    @mock.patch("check_kubernetes_api.check_kubernetes_nodes")
+    @mock.patch("check_kubernetes_api.check_kubernetes_health")
+    def test_run_checks(self, mock_health, mock_nodes):
+        """Test --checks runs every check in one process."""
+        mock_health.return_value = (0, "Kubernetes readyz 'ok'")
+        mock_nodes.side_effect = RuntimeError("boom")
+        args = check_kubernetes_api.build_parser().parse_args(
+            ["-H", "1.1.1.1", "-P", "1111", "--checks", "health,nodes"]
+        )
+        status, message = check_kubernetes_api.run_check(args)
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_UNKNOWN)
+        self.assertIn("[UNKNOWN] nodes: RuntimeError: boom", message)
+        mock_health.assert_called_once_with(
+            "https://1.1.1.1:1111",
+            None,
+            False,
+            engine=mock.ANY,
+            endpoint="readyz",
+            exclude=[],
+        )
+        self.assertRaises(
+            SystemExit,
+            check_kubernetes_api.build_parser().parse_args,
+            ["-H", "1.1.1.1", "-P", "1111", "--checks", "health,bogus"],
+        )
+
+    def test_check_engine(self):
+        """Test the engine runs requests concurrently and enforces deadlines."""
+
+        def request(seconds):
+            time.sleep(seconds)
+            return seconds
+
+        with check_kubernetes_api.CheckEngine(False, timeout=0.5) as engine:
+            start = time.monotonic()
+            results = engine.run_checks(
+                {
+                    "fan-out": lambda: (
+                        0,
+                        engine.gather(*((request, 0.2) for _ in range(4))),
+                    ),
+                    "slow": lambda: (0, request(2)),
+                }
+            )
+            # bounded by the slowest request and the deadline, not their sum
+            self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(results["fan-out"], (0, [0.2, 0.2, 0.2, 0.2]))
+        self.assertEqual(
+            results["slow"],
+            (
+                check_kubernetes_api.NAGIOS_STATUS_UNKNOWN,
+                "Check slow timed out after 0.5s",
+            ),
+        )
+
+    def test_engine_bounded_connections(self):
+        """Test the engine requests wait for one of its `concurrency` connections."""
+        with check_kubernetes_api.CheckEngine(False, concurrency=3) as engine:
+            pool = engine.http.connection_from_url("https://1.1.1.1:1111")
+            self.assertEqual(pool.pool.maxsize, 3)
+            self.assertTrue(pool.block)
+
+        # a response left unread is closed before its connection is returned
+        resp = mock.MagicMock()
+        with self.assertRaises(ValueError):
+            with check_kubernetes_api.released(resp):
+                raise ValueError("bad line")
+        resp.close.assert_called_once()
+        resp.release_conn.assert_called_once()
+
+    def test_check_deadline(self):
+        """Test an expired check stops sending requests."""
+        http = mock.MagicMock()
+        timeouts = []
+
+        def request(
+            method, url, fields=None, headers=None, timeout=None, pool_timeout=None
+        ):
+            # waiting for a connection is bounded by the deadline too
+            self.assertEqual(pool_timeout, timeout.total)
+            timeouts.append(timeout.total)
+            time.sleep(0.05)
+            page = {"metadata": {"continue": "next"}, "items": [{}]}
+            return mock.MagicMock(status=200, data=json.dumps(page).encode())
+
+        http.request.side_effect = request
+        engine = check_kubernetes_api.CheckEngine(False, timeout=0.3)
+        with engine:
+            results = engine.run_checks(
+                {
+                    "list": lambda: (
+                        0,
+                        len(list(check_kubernetes_api.list_resources(http, "u", "t"))),
+                    )
+                }
+            )
+        self.assertEqual(
+            results["list"].status, check_kubernetes_api.NAGIOS_STATUS_UNKNOWN
+        )
+        # the paginated list stops at the deadline, each request bounded by it
+        engine.checks.shutdown(wait=True)
+        self.assertTrue(1 <= len(timeouts) <= 7)
+        self.assertTrue(all(0 < t <= 0.3 for t in timeouts))
+        self.assertEqual(timeouts, sorted(timeouts, reverse=True))
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_kubernetes_nodes_summarised(self, mock_http_pool_manager):
+        """Test long NotReady lists are counted by group and saved in full."""
+        nodes = [
+            {
+                "metadata": {
+                    "name": "node-{}".format(i),
+                    "labels": {
+                        "node-role.kubernetes.io/worker": "",
+                        "topology.kubernetes.io/zone": "zone-{}".format(i % 2),
+                        "rack": "rack-{}".format(i // 100),
+                    },
+                },
+                "status": {
+                    "conditions": [
+                        {"type": "Ready", "status": "True" if i < 200 else "Unknown"}
+                    ]
+                },
+            }
+            for i in range(500)
+        ]
+        mock_http_pool_manager.return_value.request.return_value = mock.MagicMock(
+            status=200, data=json.dumps({"items": nodes}).encode()
+        )
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+
+        status, message = check_kubernetes_api.check_kubernetes_nodes(
+            "https://1.1.1.1:1111",
+            "token",
+            False,
+            state_dir=state_dir.name,
+            listed=3,
+            group_label="rack",
+        )
+        detail = os.path.join(state_dir.name, "nodes_not_ready.json")
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(
+            message,
+            "300 of 500 Nodes NotReady (role worker: 300; "
+            "zone zone-0: 150, zone-1: 150; rack rack-2: 100, rack-3: 100, "
+            "rack-4: 100): node-200, node-201, node-202, +297 more "
+            "(full list in {}) | nodes=500 not_ready=300".format(detail),
+        )
+        with open(detail) as f:
+            saved = json.load(f)["nodes"]
+        self.assertEqual(len(saved), 300)
+        self.assertEqual(
+            saved[0],
+            {"name": "node-200", "role": "worker", "zone": "zone-0", "rack": "rack-2"},
+        )
+
+    def test_nagios_output_truncated(self):
+        """Test long messages are truncated, keeping their performance data."""
+        message = check_kubernetes_api.with_perfdata(
+            "Nodes NotReady: " + ", ".join("node-{}".format(i) for i in range(5000)),
+            {"nodes": 5000, "not_ready": 5000},
+        )
+        output = check_kubernetes_api.nagios_output(2, message + "\n[OK] health")
+        self.assertLessEqual(
+            len(output.encode()), check_kubernetes_api.NAGIOS_OUTPUT_LIMIT
+        )
+        self.assertTrue(output.startswith("CRITICAL: Nodes NotReady: node-0, node-1"))
+        self.assertTrue(output.endswith(" ... | nodes=5000 not_ready=5000"))
+        self.assertEqual(
+            check_kubernetes_api.nagios_output(0, "ok | a=1\nb"), "OK: ok | a=1\nb"
+        )
+
+    @mock.patch("check_kubernetes_api.sys.exit")
+    @mock.patch("check_kubernetes_api.print")
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_json_output(self, mock_http_pool_manager, mock_print, mock_sys_exit):
+        """Test --output json and --output-file report the structured result."""
+        nodes = {
+            "items": [
+                {
+                    "metadata": {"name": name},
+                    "status": {"conditions": [{"type": "Ready", "status": ready}]},
+                }
+                for name, ready in (("a", "True"), ("b", "Unknown"))
+            ]
+        }
+        mock_http_pool_manager.return_value.request.return_value = mock.MagicMock(
+            status=200, data=json.dumps(nodes).encode()
+        )
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        path = os.path.join(output_dir.name, "results", "checks.json")
+        args = check_kubernetes_api.build_parser().parse_args(
+            ["-H", "1.1.1.1", "-P", "1111", "--checks", "nodes,capacity"]
+            + ["--output", "json", "--output-file", path, "--timings"]
+        )
+        result = check_kubernetes_api.run_check(args)
+        status, _ = result
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+
+        check_kubernetes_api.output_result(args, result)
+        mock_sys_exit.assert_called_with(status)
+        printed = json.loads(mock_print.call_args[0][0])
+        with open(path) as f:
+            saved = json.load(f)
+        self.assertIn("timestamp", saved)
+        self.assertEqual(printed["checks"], saved["checks"])
+        self.assertEqual(printed["status"], "CRITICAL")
+        nodes_result, capacity_result = printed["checks"]
+        self.assertEqual(nodes_result["check"], "nodes")
+        self.assertEqual(nodes_result["message"], "Nodes NotReady: b")
+        self.assertEqual(nodes_result["counts"], {"nodes": 2.0, "not_ready": 1.0})
+        self.assertIn("request", nodes_result["timings"])
+        self.assertEqual(
+            nodes_result["findings"],
+            [{"node": "b", "role": "<none>", "zone": "<none>", "problem": "NotReady"}],
+        )
+        # the node list is fetched once and shared between the checks
+        self.assertEqual(
+            {
+                nodes_result["flags"]["nodes_cached"],
+                capacity_result["flags"]["nodes_cached"],
+            },
+            {False, True},
+        )
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_record_and_replay(self, mock_http_pool_manager):
+        """Test recorded responses replay through the checks without the API."""
+        node = {
+            "metadata": {"name": "node-a"},
+            "status": {"conditions": [{"type": "Ready", "status": "False"}]},
+        }
+        mock_http_pool_manager.return_value.request.side_effect = [
+            mock.MagicMock(
+                status=200,
+                data=json.dumps(
+                    {"items": [node], "metadata": {"continue": "page-2"}}
+                ).encode(),
+            ),
+            mock.MagicMock(status=200, data=json.dumps({"items": []}).encode()),
+        ]
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        archive = os.path.join(archive_dir.name, "nodes.zip")
+        parser = check_kubernetes_api.build_parser()
+
+        recorded = check_kubernetes_api.run_check(
+            parser.parse_args(
+                ["-H", "1.1.1.1", "-P", "1111", "--check", "nodes", "--record", archive]
+            )
+        )
+        self.assertEqual(recorded[0], check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertEqual(mock_http_pool_manager.return_value.request.call_count, 2)
+
+        mock_http_pool_manager.return_value.request.reset_mock()
+        argv = ["-H", "replay", "-P", "1", "--check", "nodes", "--replay", archive]
+        replayed = check_kubernetes_api.run_check(parser.parse_args(argv))
+        self.assertEqual(replayed, recorded)
+        mock_http_pool_manager.return_value.request.assert_not_called()
+
+        # requests missing from the archive are reported, not sent
+        argv[argv.index("nodes")] = "storage"
+        status, message = check_kubernetes_api.run_check(parser.parse_args(argv))
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_CRITICAL)
+        self.assertIn("No recorded response for GET /api/v1/", message)
+
+    @mock.patch("check_kubernetes_api.urllib3.PoolManager")
+    def test_timings_and_profile(self, mock_http_pool_manager):
+        """Test --timings appends phase timings and --profile dumps profiles."""
+        mock_http_pool_manager.return_value.request.return_value = mock.MagicMock(
+            status=200, data=json.dumps({"items": []}).encode()
+        )
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        argv = ["-H", "1.1.1.1", "-P", "1111", "--check", "nodes"]
+
+        _, message = check_kubernetes_api.run_check(
+            check_kubernetes_api.build_parser().parse_args(argv)
+        )
+        self.assertNotIn("time_", message)
+
+        with mock.patch.dict(os.environ, {"KSC_PROFILE": "timings,cprofile"}):
+            args = check_kubernetes_api.build_parser().parse_args(
+                argv + ["--profile-dir", profile_dir.name]
+            )
+        for _ in range(check_kubernetes_api.PROFILE_KEEP + 2):
+            _, message = check_kubernetes_api.run_check(args)
+        _, perfdata = check_kubernetes_api.split_perfdata(message)
+        self.assertEqual(
+            [label for label in perfdata if label.startswith("time_")],
+            ["time_request", "time_parse", "time_evaluate"],
+        )
+        dumps = os.listdir(profile_dir.name)
+        self.assertEqual(len(dumps), check_kubernetes_api.PROFILE_KEEP)
+        self.assertTrue(all(dump.endswith("-nodes.prof") for dump in dumps))
+
+
+class TestKSCScheduler(unittest.TestCase):
+    """Test cases for the Kubernetes Service Checks scheduler."""
+
+    def setUp(self):
+        """Prepare a scheduler with a fake clock and results directory."""
+        self.results_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.results_dir.cleanup)
+        self.now = 1000.0
+        self.config = {
+            "interval": 60,
+            "concurrency": 2,
+            "results_dir": self.results_dir.name,
+            "jobs": [
+                {"name": "k8s_api_health", "argv": ["-H", "a", "-P", "1"]},
+                {"name": "k8s_api_b_health", "argv": ["-H", "b", "-P", "1"]},
+            ],
+        }
+
+    @mock.patch("ksc_scheduler.check_kubernetes_api.run_check")
+    def test_scheduler_spreads_jobs(self, mock_run_check):
+        """Test each job runs once per interval at its own offset."""
+        mock_run_check.return_value = (0, "ok")
+        scheduler = ksc_scheduler.Scheduler(self.config, clock=lambda: self.now)
+        offsets, names = zip(
+            *sorted(
+                (ksc_scheduler.job_offset(job["name"], 60), job["name"])
+                for job in self.config["jobs"]
+            )
+        )
+        self.assertNotEqual(offsets[0], offsets[1])
+
+        self.assertEqual(scheduler.tick(), offsets[0])
+        mock_run_check.assert_not_called()
+
+        self.now += offsets[0]
+        scheduler.tick()
+        scheduler.executor.shutdown(wait=True)
+        self.assertEqual(mock_run_check.call_count, 1)
+        self.assertEqual(scheduler.tick(), offsets[1] - offsets[0])
+
+        status, message = ksc_scheduler.read_result(self.config, names[0])
+        self.assertEqual((status, message), (0, "ok"))
+
+    @mock.patch("ksc_scheduler.check_kubernetes_api.run_check")
+    def test_scheduler_submits_batches(self, mock_run_check):
+        """Test passive results are pushed in batches to the spool."""
+        mock_run_check.return_value = (2, "Nodes NotReady: a\n[OK] more")
+        spool_dir = os.path.join(self.results_dir.name, "spool")
+        self.config.update(
+            hostname="juju-ksc-0",
+            batch_size=2,
+            submitter={"type": "spool", "target": spool_dir},
+        )
+        for job in self.config["jobs"]:
+            job["service"] = "juju-ksc-0[{0}] {0}".format(job["name"])
+        scheduler = ksc_scheduler.Scheduler(self.config, clock=lambda: self.now)
+        self.assertIsInstance(scheduler.submitter, ksc_scheduler.SpoolSubmitter)
+
+        self.now += 60
+        scheduler.tick()
+        scheduler.executor.shutdown(wait=True)
+        self.assertFalse(os.path.exists(spool_dir))
+
+        # both results are submitted as one batch
+        scheduler.tick()
+        self.assertEqual(scheduler.pending, [])
+        (batch,) = os.listdir(spool_dir)
+        with open(os.path.join(spool_dir, batch)) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertRegex(
+            lines[0],
+            r"^\[\d+\] PROCESS_SERVICE_CHECK_RESULT;juju-ksc-0;"
+            r"juju-ksc-0\[k8s_api_\w+\] k8s_api_\w+;2;Nodes NotReady: a\\n\[OK\] more$",
+        )
+
+    def test_spool_prune(self):
+        """Test spool files left unread past max_age are pruned."""
+        spool_dir = os.path.join(self.results_dir.name, "spool")
+        os.makedirs(spool_dir)
+        old = os.path.join(spool_dir, "old.cmd")
+        open(old, "w").close()
+        os.utime(old, (time.time() - 700, time.time() - 700))
+        submitter = ksc_scheduler.make_submitter(
+            {"type": "spool", "target": spool_dir, "max_age": 600}
+        )
+        result = {"service": "s", "status": 0, "message": "ok", "timestamp": 0}
+        submitter.submit("juju-ksc-0", [result])
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(len(os.listdir(spool_dir)), 1)
+
+    @mock.patch("ksc_scheduler.check_kubernetes_api.run_check")
+    def test_scheduler_group_job(self, mock_run_check):
+        """Test the checks of a group job run once and are saved apart."""
+        mock_run_check.return_value = check_kubernetes_api.CheckResult(
+            2,
+            "CRITICAL",
+            checks={
+                "nodes": check_kubernetes_api.CheckResult(0, "All Nodes Ready"),
+                "skew": check_kubernetes_api.CheckResult(2, "kubelet too old"),
+            },
+        )
+        job = {
+            "name": "k8s_api_nodes",
+            "argv": ["-H", "a", "-P", "1", "--checks", "nodes,skew"],
+            "checks": {
+                "nodes": {"name": "k8s_api_nodes", "service": "nodes"},
+                "skew": {"name": "k8s_api_skew", "service": "skew"},
+            },
+        }
+        results = ksc_scheduler.run_job(job, self.results_dir.name)
+        mock_run_check.assert_called_once()
+        self.assertEqual(
+            [(result["service"], result["status"]) for result in results],
+            [("nodes", 0), ("skew", 2)],
+        )
+        self.assertEqual(
+            ksc_scheduler.read_result(self.config, "k8s_api_skew"),
+            (2, "kubelet too old"),
+        )
+
+        # a failed run is reported for every check of the group
+        mock_run_check.side_effect = ValueError("boom")
+        results = ksc_scheduler.run_job(job, self.results_dir.name)
+        self.assertEqual([result["status"] for result in results], [3, 3])
+
+    def test_scheduler_collect_worst_status(self):
+        """Test a group job adapts to the worst status of its checks."""
+        scheduler = ksc_scheduler.Scheduler(self.config, clock=lambda: self.now)
+        name = self.config["jobs"][0]["name"]
+        future = concurrent.futures.Future()
+        future.set_result(
+            [
+                {"service": "a", "status": 3, "message": "unknown"},
+                {"service": "b", "status": 2, "message": "critical"},
+            ]
+        )
+        scheduler.running[name] = future
+        scheduler.adapt = mock.MagicMock()
+        scheduler.collect(self.now)
+        scheduler.adapt.assert_called_once_with(name, 2, self.now)
+
+    def test_scheduler_keeps_failed_batches(self):
+        """Test results are kept for a later attempt when submitting fails."""
+        submitter = mock.MagicMock()
+        submitter.submit.side_effect = IOError("unreachable")
+        scheduler = ksc_scheduler.Scheduler(
+            self.config, clock=lambda: self.now, submitter=submitter
+        )
+        scheduler.pending = [{"service": "a", "status": 0, "message": "ok"}]
+        scheduler.submit(self.now)
+        self.assertEqual(len(scheduler.pending), 1)
+        submitter.submit.side_effect = None
+        scheduler.submit(self.now)
+        submitter.submit.assert_called_with(
+            None, [{"service": "a", "status": 0, "message": "ok"}]
+        )
+        self.assertEqual(scheduler.pending, [])
+
+    @mock.patch("ksc_scheduler.check_kubernetes_api.run_check")
+    def test_scheduler_adaptive_intervals(self, mock_run_check):
+        """Test list checks back off while stable and tighten on a change."""
+        self.config.update(min_interval=30, max_interval=240)
+        self.config["jobs"] = [
+            {"name": "k8s_api_health", "argv": [], "cluster": "", "check": "health"},
+            {
+                "name": "k8s_api_nodes",
+                "argv": [],
+                "cluster": "",
+                "check": "nodes",
+                "backoff": True,
+            },
+            {
+                "name": "k8s_api_b_nodes",
+                "argv": [],
+                "cluster": "b",
+                "check": "nodes",
+                "backoff": True,
+            },
+        ]
+        scheduler = ksc_scheduler.Scheduler(self.config, clock=lambda: self.now)
+        ok = check_kubernetes_api.NAGIOS_STATUS_OK
+        crit = check_kubernetes_api.NAGIOS_STATUS_CRITICAL
+        for _ in range(3):
+            scheduler.adapt("k8s_api_nodes", ok, self.now)
+            scheduler.adapt("k8s_api_b_nodes", ok, self.now)
+            scheduler.adapt("k8s_api_health", ok, self.now)
+        self.assertEqual(
+            scheduler.intervals,
+            {"k8s_api_health": 60, "k8s_api_nodes": 240, "k8s_api_b_nodes": 240},
+        )
+
+        # a status change only tightens the changed check
+        scheduler.adapt("k8s_api_b_nodes", crit, self.now)
+        self.assertEqual(scheduler.intervals["k8s_api_b_nodes"], 30)
+        self.assertEqual(scheduler.next_run["k8s_api_b_nodes"], self.now + 30)
+        self.assertEqual(scheduler.intervals["k8s_api_nodes"], 240)
+
+        # a failed health check tightens every check of its cluster
+        scheduler.adapt("k8s_api_health", crit, self.now)
+        self.assertEqual(scheduler.intervals["k8s_api_health"], 30)
+        self.assertEqual(scheduler.intervals["k8s_api_nodes"], 30)
+
+        # the tightened interval is used to reschedule the job
+        mock_run_check.return_value = (ok, "ok")
+        scheduler.next_run = dict.fromkeys(scheduler.jobs, self.now + 1000)
+        scheduler.next_run["k8s_api_nodes"] = self.now
+        scheduler.tick()
+        scheduler.executor.shutdown(wait=True)
+        self.assertEqual(scheduler.next_run["k8s_api_nodes"], self.now + 30)
+
+        # once stable and OK again, the other checks return to the interval and
+        # the list checks back off anew
+        scheduler.adapt("k8s_api_health", ok, self.now)
+        scheduler.adapt("k8s_api_health", ok, self.now)
+        scheduler.adapt("k8s_api_nodes", ok, self.now)
+        self.assertEqual(scheduler.intervals["k8s_api_health"], 60)
+        self.assertEqual(scheduler.intervals["k8s_api_nodes"], 60)
+
+    def test_scheduler_adaptive_disabled(self):
+        """Test the intervals are left alone without an adaptive ceiling."""
+        self.config.update(min_interval=30)
+        self.config["jobs"] = [
+            {"name": "k8s_api_health", "argv": [], "cluster": "", "check": "health"},
+            {
+                "name": "k8s_api_nodes",
+                "argv": [],
+                "cluster": "",
+                "check": "nodes",
+                "backoff": True,
+            },
+        ]
+        scheduler = ksc_scheduler.Scheduler(self.config, clock=lambda: self.now)
+        next_run = dict(scheduler.next_run)
+        for status in (0, 2, 2, 1, 0, 0):
+            scheduler.adapt("k8s_api_health", status, self.now)
+            scheduler.adapt("k8s_api_nodes", status, self.now)
+        self.assertEqual(
+            scheduler.intervals, {"k8s_api_health": 60, "k8s_api_nodes": 60}
+        )
+        self.assertEqual(scheduler.next_run, next_run)
+
+    def test_read_result(self):
+        """Test missing and stale results are reported UNKNOWN."""
+        status, _ = ksc_scheduler.read_result(self.config, "k8s_api_health")
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_UNKNOWN)
+
+        check_kubernetes_api.save_state(
+            self.results_dir.name,
+            "k8s_api_health",
+            {"status": 2, "message": "Nodes NotReady: a", "timestamp": 0},
+        )
+        status, message = ksc_scheduler.read_result(self.config, "k8s_api_health")
+        self.assertEqual(status, check_kubernetes_api.NAGIOS_STATUS_UNKNOWN)
+        self.assertIn("Stale result", message)
+
+        # the staleness follows the ceiling of the adaptive polling
+        self.config["max_interval"] = 600
+        with mock.patch("ksc_scheduler.time.time", return_value=1000):
+            status, _ = ksc_scheduler.read_result(self.config, "k8s_api_health")
+        self.assertEqual(status, 2)